@@ -1,10 +1,11 @@
 # game_controller.py
-from database.models import Game, db, Protagonist, AlbumTheme
+from database.models import Game, GameRound, db, Protagonist, AlbumTheme
 from typing import Optional, Dict, Any
 import json
 from datetime import datetime
 # from generate.qinghua_completions import init_game_plot
 import generate.qinghua_completions as gpt_completions
+from controllers.prompt_template_controller import get_prompt_template_messages, find_or_add_prompt_template
 
 
 def add_game(user_id, protagonist_id, theme_id,
@@ -130,29 +131,76 @@ def get_game(id: int) -> dict:
 
     # 根据查询结果返回相应的值
     if game:
-        return {
-            "id": game.id,
-            "user_id": game.user_id,
-            "theme_id": game.theme_id,
-            "protagonist_id": game.protagonist_id,
-            "content": game.content,
-            "created_at": game.created_at,
-            "updated_at": game.updated_at,
-            "valid": game.valid,
-            "if_finish": game.if_finish,
-            "prompt_history": game.prompt_history,
-        }
+        # 旧数据的回合记录由 tools/migrate_game_rounds.py 回填，读取时不写库（并发读取会重复回填）
+        return _game_to_dict(game, get_game_rounds(game.id))
     else:
         return {}
 
 
+def get_game_rounds(game_id: int) -> list:
+    """
+    获取游戏当前有效的回合记录，按生成顺序排列。
+    """
+    return GameRound.query.filter_by(game_id=game_id, valid=True).order_by(GameRound.id).all()
+
+
+def get_game_prompt(game: dict) -> list:
+    """
+    组装与大模型交互的完整 prompt：模板内容（进程级缓存）+ 本局游戏自己的对话。
+    """
+    return get_prompt_template_messages(game.get('template_id')) + json.loads(game['prompt_history'])
+
+
+def add_game_round(game_id: int, round_data: dict, user_input: str) -> Dict[str, Any]:
+    """
+    追加一个新回合，每回合只插入一行。
+
+    参数:
+    - game_id: 游戏ID
+    - round_data: 大模型生成的回合内容 {round, chapter, content, choice}
+    - user_input: 生成该回合时用户的输入
+
+    返回:
+    - 游戏的最新数据
+    """
+    db.session.add(_new_game_round(game_id, round_data, user_input))
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    return _game_to_dict(Game.query.get(game_id), get_game_rounds(game_id), timestamps=False)
+
+
+def replace_last_game_round(game_id: int, round_data: dict) -> Dict[str, Any]:
+    """
+    换一换：把当前最后一个回合标记为无效，并插入重新生成的回合。
+    """
+    last_round = GameRound.query.filter_by(game_id=game_id, valid=True).order_by(GameRound.id.desc()).first()
+    user_input = None
+    if last_round:
+        last_round.valid = False
+        # 沿用原来的用户输入，还原出来的对话历史保持「输入 -> 当前回合」
+        user_input = last_round.user_input
+
+    db.session.add(_new_game_round(game_id, round_data, user_input))
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    return _game_to_dict(Game.query.get(game_id), get_game_rounds(game_id), timestamps=False)
+
+
 def edit_game(id: int,
               user_id: Optional[int] = None,
               protagonist_id: Optional[int] = None,
               theme_id: Optional[int] = None,
-              content: Optional[str] = None,
-              if_finish: Optional[str] = None,
-              prompt_history: Optional[str] = None) -> Dict[str, Any]:
+              if_finish: Optional[str] = None) -> Dict[str, Any]:
     game_query = Game.query
     if id:
         game_query = game_query.filter_by(id=id, valid='1')
@@ -169,25 +217,10 @@ def edit_game(id: int,
             game.theme_id = theme_id
         if if_finish:
             game.if_finish = if_finish
-        if content:
-            game.content = content
-        if prompt_history:
-            game.prompt_history = prompt_history
 
         db.session.commit()
 
-        return {
-            "id": game.id,
-            "user_id": game.user_id,
-            "theme_id": game.theme_id,
-            "protagonist_id": game.protagonist_id,
-            "content": game.content,
-            # "created_at": game.created_at,
-            # "updated_at": game.updated_at,
-            "valid": game.valid,
-            "if_finish": game.if_finish,
-            "prompt_history": game.prompt_history,
-        }
+        return _game_to_dict(game, get_game_rounds(game.id), timestamps=False)
     else:
         return {}
 
@@ -197,35 +230,19 @@ def del_game():
 
 
 def reset_game_plot(game_id):
-    game_query = Game.query
-    if game_id:
-        game_query = game_query.filter_by(id=game_id, valid='1')
-
-    game = game_query.first()
+    game = get_game(game_id)
 
     # 根据查询结果返回相应的值
     if game:
-        content_arr = json.loads(game.content)
-        prompt_history_arr = json.loads(game.prompt_history)
-        # print(content_arr)
-        # print(prompt_history_arr)
-        game.content = json.dumps([content_arr[0]], ensure_ascii=False)
-        game.prompt_history = json.dumps(prompt_history_arr[:2], ensure_ascii=False)
-
-        db.session.commit()
-
-        return {
-            "id": game.id,
-            "user_id": game.user_id,
-            "theme_id": game.theme_id,
-            "protagonist_id": game.protagonist_id,
-            "content": game.content,
-            "created_at": game.created_at,
-            "updated_at": game.updated_at,
-            "valid": game.valid,
-            "if_finish": game.if_finish,
-            "prompt_history": game.prompt_history,
-        }
+        rounds = get_game_rounds(game_id)
+        # 只保留第一个回合，其余回合标记为无效
+        if rounds:
+            GameRound.query.filter(GameRound.game_id == game_id,
+                                   GameRound.valid.is_(True),
+                                   GameRound.id != rounds[0].id).update({'valid': False}, synchronize_session=False)
+            db.session.commit()
+
+        return get_game(game_id)
     else:
         return {}
 
@@ -238,45 +255,71 @@ def is_json(myjson):
     return True
 
 
-def save_game_data(user_id, theme, protagonist, game_data):
-    theme = json.loads(theme)
-    protagonist = json.loads(protagonist)
-    prompt_history = json.loads(game_data)
-    # print('history:',prompt_history)
-
-    new_game = Game(
-        user_id=user_id,
-        protagonist_id=protagonist['id'],
-        theme_id=theme['id'],
-        content=json.dumps([json.loads(prompt_history[-1]['content'])], ensure_ascii=False),
-        prompt_history=json.dumps(prompt_history, ensure_ascii=False),
-        created_at=datetime.utcnow(),
-        updated_at=datetime.utcnow(),
-        valid=True,
-        if_finish=False
-    )
-
-    # 添加到数据库
-    db.session.add(new_game)
-    db.session.commit()
+def save_game_data(user_id, theme, protagonist, game_data, template_id=None):
+    new_game = _create_game(user_id, theme, protagonist, game_data, template_id)
     print(new_game.id)
 
     # 返回新创建的游戏的ID
     return new_game.id
 
 
-def save_game_first_time(user_id, theme, protagonist, game_data):
+def save_game_first_time(user_id, theme, protagonist, game_data, template_id=None):
+    new_game = _create_game(user_id, theme, protagonist, game_data, template_id)
+
+    # 返回新创建的游戏
+    return _game_to_dict(new_game, get_game_rounds(new_game.id), timestamps=False)
+
+
+def backfill_game_rounds(game: Game) -> list:
+    """
+    把旧数据的 prompt_history 拆成回合记录写入 game_round 表。只在 tools/migrate_game_rounds.py 中调用，
+    不检查是否已有回合记录，不能并发执行。
+
+    对话开头不是回合内容的部分（游戏规则）会归到 prompt 模板中：与当前规则模板一致的使用规则模板，
+    否则按内容新建一个 legacy_game 模板版本。
+    """
+    history = json.loads(game.prompt_history)
+
+    if game.template_id is None:
+        # 找到第一条回合内容对应的用户输入，之前的对话都是游戏规则
+        first_round_index = len(history)
+        for index in range(1, len(history), 2):
+            if _parse_round(history[index].get('content')) is not None:
+                first_round_index = index - 1
+                break
+        preamble = history[:first_round_index]
+        if preamble == gpt_completions.GAME_RULES_PROMPT:
+            game.template_id = gpt_completions.get_game_rules_template_id()
+        elif preamble:
+            game.template_id = find_or_add_prompt_template('legacy_game', preamble)
+        history = history[first_round_index:]
+
+    for user_input, round_data in _rounds_from_turns(history):
+        db.session.add(_new_game_round(game.id, round_data, user_input))
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    return get_game_rounds(game.id)
+
+
+def _create_game(user_id, theme, protagonist, game_data, template_id=None) -> Game:
     theme = json.loads(theme)
     protagonist = json.loads(protagonist)
     prompt_history = json.loads(game_data)
     # print('history:',prompt_history)
+    # 模板部分不再随每局游戏保存
+    if template_id:
+        prompt_history = prompt_history[len(get_prompt_template_messages(template_id)):]
 
     new_game = Game(
         user_id=user_id,
         protagonist_id=protagonist['id'],
         theme_id=theme['id'],
-        content=json.dumps([json.loads(prompt_history[-1]['content'])], ensure_ascii=False),
-        prompt_history=json.dumps(prompt_history, ensure_ascii=False),
+        template_id=template_id,
         created_at=datetime.utcnow(),
         updated_at=datetime.utcnow(),
         valid=True,
@@ -285,17 +328,102 @@ def save_game_first_time(user_id, theme, protagonist, game_data):
 
     # 添加到数据库
     db.session.add(new_game)
-    db.session.commit()
+    db.session.flush()  # 使得新的 Game 对象的 ID 可用
+
+    for user_input, round_data in _rounds_from_turns(prompt_history):
+        db.session.add(_new_game_round(new_game.id, round_data, user_input))
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    return new_game
+
+
+def _rounds_from_turns(turns: list) -> list:
+    """
+    把 [用户输入, 回合内容, 用户输入, 回合内容, ...] 形式的对话还原为 [(用户输入, 回合内容), ...]，
+    换一换会替换掉上一个回合。
+    """
+    rounds = []
+    for index in range(0, len(turns) - 1, 2):
+        user_input = turns[index].get('content')
+        round_data = _parse_round(turns[index + 1].get('content'))
+        if round_data is None:
+            continue
+        if user_input == '换一换' and rounds:
+            rounds[-1] = (rounds[-1][0], round_data)
+        else:
+            rounds.append((user_input, round_data))
+    return rounds
+
+
+def _parse_round(reply):
+    try:
+        round_data = json.loads(reply)
+    except (TypeError, json.JSONDecodeError):
+        return None
+    return round_data if isinstance(round_data, dict) and 'content' in round_data else None
+
+
+def _new_game_round(game_id: int, round_data: dict, user_input: Optional[str]) -> GameRound:
+    return GameRound(
+        game_id=game_id,
+        round=_to_int(round_data.get('round')),
+        chapter=round_data.get('chapter'),
+        content=round_data.get('content'),
+        choices=json.dumps(round_data.get('choice') or [], ensure_ascii=False),
+        user_input=user_input,
+        created_at=datetime.utcnow(),
+        valid=True
+    )
 
-    # 返回新创建的游戏的ID
-    return {
-            "id": new_game.id,
-            "user_id": new_game.user_id,
-            "theme_id": new_game.theme_id,
-            "protagonist_id": new_game.protagonist_id,
-            "content": new_game.content,
-            "valid": new_game.valid,
-            "if_finish": new_game.if_finish,
-            "prompt_history": new_game.prompt_history,
-        }
 
+def _round_to_dict(game_round: GameRound) -> dict:
+    return {
+        "round": game_round.round,
+        "chapter": game_round.chapter,
+        "content": game_round.content,
+        "choice": json.loads(game_round.choices) if game_round.choices else [],
+    }
+
+
+def _game_to_dict(game: Game, rounds: list, timestamps: bool = True) -> dict:
+    """
+    由回合记录还原出原来的接口格式：content 为回合数组，prompt_history 为模板之后的对话。
+    流式接口直接 json.dumps 返回结果，timestamps=False 时不返回时间字段。
+    """
+    content = []
+    prompt_history = []
+    for game_round in rounds:
+        round_data = _round_to_dict(game_round)
+        content.append(round_data)
+        prompt_history.append({'role': 'user', 'content': game_round.user_input})
+        prompt_history.append({'role': 'assistant', 'content': json.dumps(round_data, ensure_ascii=False)})
+
+    result = {
+        "id": game.id,
+        "user_id": game.user_id,
+        "theme_id": game.theme_id,
+        "protagonist_id": game.protagonist_id,
+        "content": json.dumps(content, ensure_ascii=False),
+        "created_at": game.created_at,
+        "updated_at": game.updated_at,
+        "valid": game.valid,
+        "if_finish": game.if_finish,
+        "prompt_history": json.dumps(prompt_history, ensure_ascii=False),
+        "template_id": game.template_id,
+    }
+    if not timestamps:
+        result.pop("created_at")
+        result.pop("updated_at")
+    return result
+
+
+def _to_int(value):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,47 @@
+from database.models import ImageCache, db
+from typing import Optional, Dict, Any, List
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+import json
+
+
+def get_cached_image_urls(param_hash: str) -> Optional[List[str]]:
+    """
+    按生成参数的 hash 查找已生成的图片，命中时累加命中次数。
+
+    返回:
+    - 图片地址数组，没有缓存时返回 None
+    """
+    cached = ImageCache.query.filter_by(param_hash=param_hash).first()
+    if not cached:
+        return None
+
+    ImageCache.query.filter_by(id=cached.id) \
+        .update({'hits': ImageCache.hits + 1, 'last_used_at': datetime.utcnow()}, synchronize_session=False)
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+    return json.loads(cached.image_urls)
+
+
+def add_cached_image_urls(param_hash: str, params: Dict[str, Any], image_urls: List[str]) -> None:
+    """
+    保存生成参数对应的图片地址；相同参数已有缓存时（并发生成）保留先保存的记录。
+    """
+    db.session.add(ImageCache(
+        param_hash=param_hash,
+        params=json.dumps(params, ensure_ascii=False, sort_keys=True),
+        image_urls=json.dumps(image_urls),
+        hits=0,
+        created_at=datetime.utcnow(),
+        last_used_at=datetime.utcnow(),
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        raise e
@@ -1,5 +1,6 @@
 from database.models import Image, db
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
+from datetime import datetime
 
 
 def add_image(image_url: str,
@@ -147,3 +148,66 @@ def add_plot_image(image_url: str,
         raise e
 
 
+def _plot_image_to_dict(image: Image) -> Dict[str, Any]:
+    return {
+        'id': image.id,
+        'image_url': image.image_url,
+        'game_id': image.game_id,
+        'plot_description': image.plot_description,
+        'user_id': image.user_id,
+        'image_description': image.image_description,
+        'cost': image.cost,
+        'chosen': image.chosen,
+        'valid': image.valid
+    }
+
+
+def add_plot_image_candidates(image_urls: List[str],
+                              plot_description: Optional[str] = None,
+                              game_id: Optional[int] = None,
+                              user_id: Optional[int] = None,
+                              image_description: Optional[str] = None) -> int:
+    """
+    保存换一张时一次生成的多张候选图片，候选图片在取用前不展示给用户。
+
+    返回:
+    - 保存的数量
+    """
+    for image_url in image_urls:
+        db.session.add(Image(image_url=image_url,
+                             game_id=game_id,
+                             user_id=user_id,
+                             plot_description=plot_description,
+                             image_description=image_description,
+                             chosen='0',
+                             shown=False))
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+    return len(image_urls)
+
+
+def take_plot_image_candidate(game_id: int, plot_description: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    取出一张该剧情未展示的候选图片并标记为已展示，没有可用的返回 None。
+    多个请求同时取用时，以条件更新的结果为准，同一张图片只会被一个请求取到。
+    """
+    while True:
+        candidate = Image.query.filter_by(game_id=game_id, plot_description=plot_description,
+                                          shown=False, valid=True) \
+            .order_by(Image.id).first()
+        if not candidate:
+            return None
+
+        claimed = Image.query.filter_by(id=candidate.id, shown=False) \
+            .update({'shown': True, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise e
+
+        if claimed:
+            return _plot_image_to_dict(candidate)
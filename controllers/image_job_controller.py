@@ -0,0 +1,177 @@
+from database.models import ImageJob, db
+from typing import Optional, Dict, Any, List
+from datetime import datetime, timedelta
+import json
+
+# 任务状态
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+def _job_to_dict(job: ImageJob) -> Dict[str, Any]:
+    return {
+        'id': job.id,
+        'job_type': job.job_type,
+        'priority': job.priority,
+        'status': job.status,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'attempts': job.attempts,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def _commit():
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+
+def add_image_job(job_type: str, params: Dict[str, Any], priority: int = 0,
+                  user_id: Optional[int] = None, dedupe_key: Optional[str] = None) -> Dict[str, Any]:
+    """
+    新增一个待执行的图片生成任务。
+
+    参数:
+    - job_type: 任务类型
+    - params: 任务参数
+    - priority: 优先级，数字越小越先执行
+    - user_id: 提交任务的用户ID
+    - dedupe_key: 相同请求的 key
+
+    返回:
+    - 任务信息
+    """
+    job = ImageJob(
+        job_type=job_type,
+        params=json.dumps(params, ensure_ascii=False),
+        priority=priority,
+        status=JOB_PENDING,
+        attempts=0,
+        dedupe_key=dedupe_key,
+        user_id=user_id,
+        created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow(),
+    )
+    db.session.add(job)
+    _commit()
+    return _job_to_dict(job)
+
+
+def get_image_job(job_id: int) -> Optional[Dict[str, Any]]:
+    # 每次查询读取最新状态，不使用会话中缓存的对象
+    db.session.expire_all()
+    job = db.session.get(ImageJob, job_id)
+    return _job_to_dict(job) if job else None
+
+
+def find_image_job(dedupe_key: str, finished_within: int = 0) -> Optional[Dict[str, Any]]:
+    """
+    查找相同请求的任务：未完成的任务，或 finished_within 秒内成功完成的任务。
+    """
+    jobs = ImageJob.query.filter_by(dedupe_key=dedupe_key) \
+        .filter(ImageJob.status.in_([JOB_PENDING, JOB_RUNNING, JOB_DONE])) \
+        .order_by(ImageJob.id.desc()).limit(1).all()
+    if not jobs:
+        return None
+    job = jobs[0]
+    if job.status == JOB_DONE and \
+            (not job.finished_at or datetime.utcnow() - job.finished_at > timedelta(seconds=finished_within)):
+        return None
+    return _job_to_dict(job)
+
+
+def claim_image_job(job_id: int, owner: str) -> Optional[Dict[str, Any]]:
+    """
+    把待执行的任务标记为由 owner 执行中，返回任务类型和参数；任务已被其他进程取走时返回 None。
+    """
+    now = datetime.utcnow()
+    claimed = ImageJob.query.filter_by(id=job_id, status=JOB_PENDING) \
+        .update({'status': JOB_RUNNING, 'owner': owner, 'started_at': now, 'updated_at': now,
+                 'attempts': ImageJob.attempts + 1}, synchronize_session=False)
+    _commit()
+    if not claimed:
+        return None
+
+    job = db.session.get(ImageJob, job_id)
+    db.session.refresh(job)
+    return {'id': job.id, 'job_type': job.job_type, 'params': json.loads(job.params),
+            'priority': job.priority, 'attempts': job.attempts}
+
+
+def heartbeat_image_jobs(job_ids: List[int], owner: str) -> None:
+    """
+    更新 owner 正在执行的任务的 updated_at，表示执行的进程仍然存活。
+    """
+    if not job_ids:
+        return
+    ImageJob.query.filter(ImageJob.id.in_(job_ids), ImageJob.status == JOB_RUNNING, ImageJob.owner == owner) \
+        .update({'updated_at': datetime.utcnow()}, synchronize_session=False)
+    _commit()
+
+
+def finish_image_job(job_id: int, owner: str, result: Any) -> bool:
+    """
+    记录任务结果；任务已被回收（不再由 owner 执行）时不修改，返回 False。
+    """
+    updated = ImageJob.query.filter_by(id=job_id, status=JOB_RUNNING, owner=owner).update(
+        {'status': JOB_DONE, 'result': json.dumps(result, ensure_ascii=False, default=str),
+         'error': None, 'owner': None, 'finished_at': datetime.utcnow(), 'updated_at': datetime.utcnow()},
+        synchronize_session=False)
+    _commit()
+    return bool(updated)
+
+
+def fail_image_job(job_id: int, owner: str, error: str, retry: bool = False) -> bool:
+    """
+    记录任务失败；retry 为 True 时任务回到待执行状态。任务已被回收（不再由 owner 执行）时不修改，返回 False。
+    """
+    values = {'error': error, 'owner': None, 'updated_at': datetime.utcnow()}
+    if retry:
+        values['status'] = JOB_PENDING
+    else:
+        values.update({'status': JOB_FAILED, 'finished_at': datetime.utcnow()})
+    updated = ImageJob.query.filter_by(id=job_id, status=JOB_RUNNING, owner=owner) \
+        .update(values, synchronize_session=False)
+    _commit()
+    return bool(updated)
+
+
+def count_pending_image_jobs() -> int:
+    return ImageJob.query.filter_by(status=JOB_PENDING).count()
+
+
+def reclaim_image_jobs(lease_seconds: int) -> List[Dict[str, Any]]:
+    """
+    回收中断的任务：执行中但超过 lease_seconds 秒没有心跳的任务（执行的进程已退出），改回待执行。
+    正常执行中的任务由执行的进程定时更新 updated_at，不会被回收，与执行了多久无关。
+
+    返回:
+    - 回收的任务的 {id, priority}
+    """
+    expired = datetime.utcnow() - timedelta(seconds=lease_seconds)
+    jobs = ImageJob.query.filter(ImageJob.status == JOB_RUNNING, ImageJob.updated_at < expired).all()
+    reclaimed = []
+    for job in jobs:
+        # 按查询到的 owner 和心跳时间条件更新，期间恢复心跳或已结束的任务不会被改回
+        updated = ImageJob.query.filter_by(id=job.id, status=JOB_RUNNING, owner=job.owner) \
+            .filter(ImageJob.updated_at < expired) \
+            .update({'status': JOB_PENDING, 'owner': None, 'updated_at': datetime.utcnow()},
+                    synchronize_session=False)
+        if updated:
+            reclaimed.append({'id': job.id, 'priority': job.priority})
+    _commit()
+    return reclaimed
+
+
+def list_pending_image_jobs() -> List[Dict[str, Any]]:
+    """
+    所有待执行任务的 {id, priority}，按优先级和提交顺序排列。
+    """
+    jobs = ImageJob.query.filter_by(status=JOB_PENDING).order_by(ImageJob.priority, ImageJob.id).all()
+    return [{'id': job.id, 'priority': job.priority} for job in jobs]
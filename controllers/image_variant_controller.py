@@ -0,0 +1,42 @@
+from database.models import ImageVariant, db
+from typing import Dict, Any, List
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+import hashlib
+
+
+def source_hash(source_url: str) -> str:
+    return hashlib.sha256(source_url.encode('utf-8')).hexdigest()
+
+
+def add_image_variant(source_url: str, width: int, height: int, format: str, url: str, size: int) -> None:
+    """
+    保存原图的一个衍生尺寸，相同原图、宽度和格式已存在时忽略。
+    """
+    db.session.add(ImageVariant(
+        source_hash=source_hash(source_url),
+        source_url=source_url,
+        width=width,
+        height=height,
+        format=format,
+        url=url,
+        size=size,
+        created_at=datetime.utcnow(),
+    ))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+
+def get_image_variants(source_url: str) -> List[Dict[str, Any]]:
+    """
+    获取原图的所有衍生尺寸，按宽度从小到大排列。
+    """
+    variants = ImageVariant.query.filter_by(source_hash=source_hash(source_url)) \
+        .order_by(ImageVariant.width).all()
+    return [{'width': variant.width, 'height': variant.height, 'format': variant.format,
+             'url': variant.url, 'size': variant.size} for variant in variants]
@@ -0,0 +1,84 @@
+from database.models import OpeningRound, AlbumTheme, Protagonist, db
+from typing import List, Optional, Tuple
+from datetime import datetime
+
+
+def add_opening_round(theme_id: int, protagonist_id: int, template_id: int, content: str) -> int:
+    """
+    保存一个预生成的开局回合。
+
+    参数:
+    - theme_id: 主题ID
+    - protagonist_id: 主角ID
+    - template_id: 生成时使用的 prompt 模板ID
+    - content: 大模型返回的第一回合 json 字符串
+
+    返回:
+    - 新记录的ID
+    """
+    new_opening = OpeningRound(
+        theme_id=theme_id,
+        protagonist_id=protagonist_id,
+        template_id=template_id,
+        content=content,
+        created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow(),
+        valid=True
+    )
+    db.session.add(new_opening)
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    return new_opening.id
+
+
+def take_opening_round(theme_id: int, protagonist_id: int, template_id: int) -> Optional[str]:
+    """
+    取出一个可用的开局回合并标记为无效，没有可用的返回 None。
+    多个请求同时取用时，以条件更新的结果为准，同一条记录只会被一个请求取到。
+    """
+    while True:
+        opening = OpeningRound.query.filter_by(theme_id=theme_id, protagonist_id=protagonist_id,
+                                               template_id=template_id, valid=True) \
+            .order_by(OpeningRound.id).first()
+        if not opening:
+            return None
+
+        claimed = OpeningRound.query.filter_by(id=opening.id, valid=True) \
+            .update({'valid': False, 'updated_at': datetime.utcnow()}, synchronize_session=False)
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise e
+
+        if claimed:
+            return opening.content
+
+
+def count_opening_rounds(theme_id: int, protagonist_id: int, template_id: int) -> int:
+    """
+    统计主题 × 主角当前可用的开局回合数量。
+    """
+    return OpeningRound.query.filter_by(theme_id=theme_id, protagonist_id=protagonist_id,
+                                        template_id=template_id, valid=True).count()
+
+
+def get_preset_pairs() -> List[Tuple[dict, dict]]:
+    """
+    获取所有预设主题 × 预设角色的组合。
+    """
+    themes = AlbumTheme.query.filter_by(valid='1', preset='1').all()
+    protagonists = Protagonist.query.filter_by(valid='1', preset='1').all()
+
+    return [
+        ({'id': theme.id, 'description': theme.description, 'theme': theme.theme, 'preset': theme.preset},
+         {'id': protagonist.id, 'description': protagonist.description, 'name': protagonist.name,
+          'race': protagonist.race, 'feature': protagonist.feature, 'preset': protagonist.preset,
+          'valid': protagonist.valid})
+        for theme in themes for protagonist in protagonists
+    ]
@@ -0,0 +1,113 @@
+from database.models import PromptTemplate, db
+from typing import List, Dict, Optional
+from datetime import datetime
+from sqlalchemy.exc import IntegrityError
+import threading
+import json
+
+# 进程级缓存：模板内容不可变（修改即新增版本），按 id 缓存后无需再查库
+_messages_cache: Dict[int, tuple] = {}
+# 模板名称 -> 最新版本的 id
+_latest_cache: Dict[str, int] = {}
+_cache_lock = threading.Lock()
+
+
+def add_prompt_template(name: str, messages: List[dict]) -> int:
+    """
+    新增一个 prompt 模板版本。其他进程同时新增了相同版本号时抛出 IntegrityError（name + version 唯一）。
+
+    参数:
+    - name: 模板名称
+    - messages: prompt 消息数组
+
+    返回:
+    - 新模板的ID
+    """
+    latest = PromptTemplate.query.filter_by(name=name).order_by(PromptTemplate.version.desc()).first()
+
+    new_template = PromptTemplate(
+        name=name,
+        version=latest.version + 1 if latest else 1,
+        messages=json.dumps(messages, ensure_ascii=False),
+        created_at=datetime.utcnow(),
+        updated_at=datetime.utcnow(),
+        valid=True
+    )
+    db.session.add(new_template)
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    with _cache_lock:
+        _messages_cache[new_template.id] = tuple(messages)
+        _latest_cache[name] = new_template.id
+
+    return new_template.id
+
+
+def get_prompt_template_messages(template_id: Optional[int]) -> List[dict]:
+    """
+    获取模板的 prompt 消息数组，返回新的 list，调用方可以直接在后面追加本局对话。
+    """
+    if not template_id:
+        return []
+
+    messages = _messages_cache.get(template_id)
+    if messages is None:
+        template = PromptTemplate.query.filter_by(id=template_id).first()
+        if not template:
+            return []
+        messages = tuple(json.loads(template.messages))
+        with _cache_lock:
+            _messages_cache[template_id] = messages
+
+    return list(messages)
+
+
+def get_latest_prompt_template(name: str, default_messages: Optional[List[dict]] = None) -> Optional[int]:
+    """
+    获取指定名称模板最新版本的ID，不存在且提供了默认内容时自动创建第一个版本。
+    """
+    template_id = _latest_cache.get(name)
+    if template_id:
+        return template_id
+
+    latest = PromptTemplate.query.filter_by(name=name, valid='1').order_by(PromptTemplate.version.desc()).first()
+    if latest:
+        with _cache_lock:
+            _latest_cache[name] = latest.id
+        return latest.id
+
+    if default_messages is None:
+        return None
+
+    try:
+        return add_prompt_template(name, default_messages)
+    except IntegrityError:
+        # 多个进程同时创建第一个版本，使用先保存的版本
+        return get_latest_prompt_template(name)
+
+
+def find_or_add_prompt_template(name: str, messages: List[dict]) -> int:
+    """
+    查找内容完全一致的模板版本，不存在则新增一个版本。
+    """
+    template_id = _find_prompt_template(name, messages)
+    if template_id:
+        return template_id
+
+    try:
+        return add_prompt_template(name, messages)
+    except IntegrityError:
+        # 其他进程同时新增了相同版本号：内容相同时直接使用，否则按新的版本号再新增一次
+        return _find_prompt_template(name, messages) or add_prompt_template(name, messages)
+
+
+def _find_prompt_template(name: str, messages: List[dict]) -> Optional[int]:
+    for template in PromptTemplate.query.filter_by(name=name).all():
+        if json.loads(template.messages) == messages:
+            return template.id
+    return None
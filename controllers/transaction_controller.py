@@ -1,10 +1,86 @@
 from database.models import Transaction, db
+from typing import List, Dict, Any
+from sqlalchemy import func
+
+# 交易类型：0 代表生文 1 代表生图
+TRANSACTION_TYPE_TEXT = '0'
+TRANSACTION_TYPE_IMAGE = '1'
 
 
 def add_transaction():
     return ""
 
 
+def add_transactions(records: List[Dict[str, Any]]) -> int:
+    """
+    批量写入消费记录，一次提交。
+
+    参数:
+    - records: 消费记录数组，key 与 Transaction 字段一致
+
+    返回:
+    - 写入的条数
+    """
+    if not records:
+        return 0
+
+    db.session.bulk_insert_mappings(Transaction, records)
+
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    return len(records)
+
+
+def _usage_summary(query) -> Dict[str, Any]:
+    # 按模型汇总调用次数、token 数、费用及平均耗时
+    rows = query.with_entities(
+        Transaction.model,
+        func.count(Transaction.id),
+        func.sum(Transaction.prompt_tokens),
+        func.sum(Transaction.completion_tokens),
+        func.sum(Transaction.total_tokens),
+        func.sum(Transaction.amount),
+        func.avg(Transaction.latency),
+    ).group_by(Transaction.model).all()
+
+    by_model = [{
+        'model': model,
+        'calls': calls,
+        'prompt_tokens': int(prompt_tokens or 0),
+        'completion_tokens': int(completion_tokens or 0),
+        'total_tokens': int(total_tokens or 0),
+        'amount': float(amount or 0),
+        'avg_latency': float(avg_latency or 0),
+    } for model, calls, prompt_tokens, completion_tokens, total_tokens, amount, avg_latency in rows]
+
+    return {
+        'calls': sum(item['calls'] for item in by_model),
+        'total_tokens': sum(item['total_tokens'] for item in by_model),
+        'amount': sum(item['amount'] for item in by_model),
+        'by_model': by_model,
+    }
+
+
+def get_user_llm_usage(user_id: int) -> Dict[str, Any]:
+    """
+    用户的大模型调用用量汇总。
+    """
+    return _usage_summary(Transaction.query.filter_by(user_id=user_id, transaction_type=TRANSACTION_TYPE_TEXT,
+                                                      valid=True))
+
+
+def get_game_llm_usage(game_id: int) -> Dict[str, Any]:
+    """
+    单局游戏的大模型调用用量汇总（包含后台预生成的调用）。
+    """
+    return _usage_summary(Transaction.query.filter_by(game_id=game_id, transaction_type=TRANSACTION_TYPE_TEXT,
+                                                      valid=True))
+
+
 def get_transaction():
     return ''
 
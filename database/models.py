@@ -131,6 +131,8 @@ class Image(db.Model):
     valid = db.Column(db.Boolean, default=True)
     # 是否被选中
     chosen = db.Column(db.String(255), default='0')
+    # 是否已展示给用户（换一张时一次生成的多张候选图片，未展示的为 False）
+    shown = db.Column(db.Boolean, default=True)
 
 
 # 剧情图片描述表
@@ -148,10 +150,16 @@ class Description(db.Model):
 # 消费表
 class Transaction(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # 外键指向用户表的id
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # 外键指向用户表的id，后台预生成等无归属用户时为空
     transaction_type = db.Column(db.String(50), nullable=False)  # 0 代表生文 1 代表生图
     target_id = db.Column(db.Integer, db.ForeignKey('image.id'))  # 外键指向图片表的id
     amount = db.Column(db.Float, nullable=False)
+    game_id = db.Column(db.Integer, db.ForeignKey('game.id'), nullable=True, index=True)  # 外键指向游戏表的id
+    model = db.Column(db.String(64), nullable=True)  # 大模型名称
+    prompt_tokens = db.Column(db.Integer, nullable=True)  # 输入 token 数
+    completion_tokens = db.Column(db.Integer, nullable=True)  # 输出 token 数
+    total_tokens = db.Column(db.Integer, nullable=True)  # 总 token 数
+    latency = db.Column(db.Float, nullable=True)  # 调用耗时（秒）
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     valid = db.Column(db.Boolean, default=True)
@@ -167,12 +175,105 @@ class Game(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # 外键指向用户表的id
     protagonist_id = db.Column(db.Integer, db.ForeignKey('protagonist.id'), nullable=False)  # 外键指向主角表的id
     theme_id = db.Column(db.Integer, db.ForeignKey('album_theme.id'), nullable=False)  # 外键指向主题表的id
-    content = db.Column(db.Text)  # 使用文本字段来存储序列化后的整数数组
+    content = db.Column(db.Text)  # 旧数据：序列化后的回合数组，新数据改为保存在 game_round 表
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     valid = db.Column(db.Boolean, default=True)
     if_finish = db.Column(db.Boolean, default=False)
-    prompt_history = db.Column(db.Text)
+    prompt_history = db.Column(db.Text)  # 旧数据：序列化后的对话历史，新数据由 game_round 表还原
+    template_id = db.Column(db.Integer, db.ForeignKey('prompt_template.id'), nullable=True)  # 外键指向 prompt 模板表的id
+
+
+# 游戏回合表（每回合一行，只追加；换一换、重置只把旧回合标记为无效）
+class GameRound(db.Model):
+    __tablename__ = 'game_round'  # 表名
+
+    id = db.Column(db.Integer, primary_key=True)
+    game_id = db.Column(db.Integer, db.ForeignKey('game.id'), nullable=False, index=True)  # 外键指向游戏表的id
+    round = db.Column(db.Integer, nullable=True)  # 回合数
+    chapter = db.Column(db.String(64), nullable=True)  # 章节名
+    content = db.Column(db.Text, nullable=True)  # 故事内容
+    choices = db.Column(db.Text, nullable=True)  # 序列化后的故事选项数组
+    user_input = db.Column(db.Text, nullable=True)  # 生成该回合时用户的输入（选项、自定义内容或开局信息）
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    valid = db.Column(db.Boolean, default=True)
+
+
+# prompt 模板表（同名模板按版本递增，修改模板即新增一个版本，老游戏仍指向原版本）
+class PromptTemplate(db.Model):
+    __tablename__ = 'prompt_template'  # 表名
+    __table_args__ = (db.UniqueConstraint('name', 'version'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)  # 模板名称
+    version = db.Column(db.Integer, nullable=False, default=1)  # 模板版本
+    messages = db.Column(db.Text, nullable=False)  # 序列化后的 prompt 消息数组
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    valid = db.Column(db.Boolean, default=True)
+
+
+# 预生成开局回合表（预设主题 × 预设角色的第一回合，取用后标记为无效）
+class OpeningRound(db.Model):
+    __tablename__ = 'opening_round'  # 表名
+    __table_args__ = (db.Index('ix_opening_round_pair', 'theme_id', 'protagonist_id', 'template_id', 'valid'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    theme_id = db.Column(db.Integer, db.ForeignKey('album_theme.id'), nullable=False)  # 外键指向主题表的id
+    protagonist_id = db.Column(db.Integer, db.ForeignKey('protagonist.id'), nullable=False)  # 外键指向主角表的id
+    template_id = db.Column(db.Integer, db.ForeignKey('prompt_template.id'), nullable=False)  # 外键指向 prompt 模板表的id
+    content = db.Column(db.Text, nullable=False)  # 大模型返回的第一回合 json 字符串
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    valid = db.Column(db.Boolean, default=True)
+
+
+# 图片生成任务表（提交后立即返回任务ID，由后台线程执行；服务重启后未完成的任务重新执行）
+class ImageJob(db.Model):
+    __tablename__ = 'image_job'  # 表名
+    __table_args__ = (db.Index('ix_image_job_status', 'status', 'priority'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(64), nullable=False)  # 任务类型，对应后台的处理函数
+    params = db.Column(db.Text, nullable=False)  # 序列化后的任务参数
+    priority = db.Column(db.Integer, nullable=False, default=0)  # 优先级，数字越小越先执行
+    status = db.Column(db.String(16), nullable=False, default='pending')  # pending / running / done / failed
+    result = db.Column(db.Text, nullable=True)  # 序列化后的任务结果
+    error = db.Column(db.Text, nullable=True)  # 失败原因
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # 已执行次数
+    dedupe_key = db.Column(db.String(64), nullable=True, index=True)  # 相同请求的 key，用于合并重复提交
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # 外键指向用户表的id
+    owner = db.Column(db.String(128), nullable=True)  # 正在执行任务的进程（主机名:进程号）
+    started_at = db.Column(db.DateTime, nullable=True)  # 最近一次开始执行的时间
+    finished_at = db.Column(db.DateTime, nullable=True)  # 完成时间
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)  # 执行中的任务定时更新（心跳）
+
 
+# 图片生成缓存表（相同的生成参数直接返回已生成的图片，不再重复调用 Stability）
+class ImageCache(db.Model):
+    __tablename__ = 'image_cache'  # 表名
 
+    id = db.Column(db.Integer, primary_key=True)
+    param_hash = db.Column(db.String(64), nullable=False, unique=True)  # 生成参数的 sha256
+    params = db.Column(db.Text, nullable=False)  # 序列化后的生成参数
+    image_urls = db.Column(db.Text, nullable=False)  # 序列化后的图片地址数组
+    hits = db.Column(db.Integer, nullable=False, default=0)  # 命中次数
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow)  # 最近一次命中的时间
 
+
+# 图片衍生尺寸表（按宽度缩小并转为 WebP/JPEG 的图片，列表等场景按需要的尺寸返回，不下载原图）
+class ImageVariant(db.Model):
+    __tablename__ = 'image_variant'  # 表名
+    __table_args__ = (db.UniqueConstraint('source_hash', 'width', 'format'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    source_hash = db.Column(db.String(64), nullable=False, index=True)  # 原图地址的 sha256
+    source_url = db.Column(db.Text, nullable=False)  # 原图地址
+    width = db.Column(db.Integer, nullable=False)  # 宽度（像素）
+    height = db.Column(db.Integer, nullable=False)  # 高度（像素）
+    format = db.Column(db.String(8), nullable=False)  # webp / jpeg
+    url = db.Column(db.Text, nullable=False)  # 图片地址
+    size = db.Column(db.Integer, nullable=False)  # 文件大小（字节）
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
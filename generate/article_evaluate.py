@@ -0,0 +1,149 @@
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cachetools import TTLCache
+from dotenv import load_dotenv
+from generate import llm_client
+from tools import metrics
+from tools.single_flight import SingleFlight
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 作文评价结果缓存：最多缓存的数量（超出时淘汰最久未使用的）及有效期（秒）
+ARTICLE_CACHE_SIZE = int(os.environ.get('ARTICLE_CACHE_SIZE') or 2000)
+ARTICLE_CACHE_TTL = int(os.environ.get('ARTICLE_CACHE_TTL') or 86400)
+# 批量评价：同时评价的作文数量、单次最多提交的作文数量
+ARTICLE_BATCH_WORKERS = int(os.environ.get('ARTICLE_BATCH_WORKERS') or 4)
+ARTICLE_BATCH_MAX = int(os.environ.get('ARTICLE_BATCH_MAX') or 100)
+
+# 作文评分标准，评价时在后面追加作文内容
+ARTICLE_EVALUATE_PROMPT = (
+    {"role": "user",
+     "content": "中国小学各年级作文要求如下，请你牢记。"
+                "一年级：主要是让学生学会运用简单的词语和句子表达自己的思想和感受，培养写作的兴趣。一般要求写句子、短文，内容可以是自己身边的事物、人物，也可以是想象中的事物。"
+                "二年级：在一年级的基础上，二年级的作文要求学生能够运用更加丰富的词汇和句式进行表达，能写简单的记叙文和说明文。内容可以包括生活琐事、人物、景物等。"
+                "三年级：三年级的学生需要在掌握基本语法和句式的基础上，学会进行合理的分段和连段成篇。能够写一些简单的记叙文、说明文和应用文，如书信、日记等。"
+                "四年级：开始学习写作的篇章结构，如开头、结尾的写法，学会使用恰当的过渡语。在内容上，可以尝试写一些观察日记、读书笔记、游记等。"
+                "五年级：要求学生能够独立构思和写作，能写一些复杂的记叙文、说明文和应用文。此外，还需要学会对文章进行修改和润色。"
+                "六年级：六年级的作文要求学生能够熟练掌握各种文体的写作方法，如议论文、散文等。此外，还需要提高自己的审美和批判能力，学会对自己和他人的文章进行评价。"},
+    {"role": "assistant",
+     "content": "收到，我已经记住了。请告诉我接下来需要我提供什么帮助。"},
+    {"role": "user",
+     "content": "接下来我会向你提供一篇小学作文，你需要给这篇作为进行评分，给出ABCD四种评分，并说明为什么。然后结合小学作文要求，给这篇作文提供评价及改进方向。你的改进方向需要具体一点"},
+    {"role": "assistant",
+     "content": "收到，我已经明白了，请你把文章发给我。"},
+)
+
+_cache = TTLCache(maxsize=ARTICLE_CACHE_SIZE, ttl=ARTICLE_CACHE_TTL)
+_cache_lock = threading.Lock()
+# 同时提交的相同作文只评价一次
+_flight = SingleFlight('article_evaluate', ttl=0)
+_batch_executor = ThreadPoolExecutor(max_workers=ARTICLE_BATCH_WORKERS, thread_name_prefix='article-batch')
+
+_BLANK_LINES = re.compile(r'\n{2,}')
+_SPACES = re.compile(r'[ \t　]+')
+
+
+def article_key(article: str) -> str:
+    """
+    作文内容的 key：统一全角半角、换行及空白后取 sha256，只有排版不同的同一篇作文得到相同的 key。
+    """
+    text = unicodedata.normalize('NFKC', article or '').replace('\r\n', '\n').replace('\r', '\n')
+    text = _SPACES.sub(' ', text)
+    text = '\n'.join(line.strip() for line in text.split('\n'))
+    text = _BLANK_LINES.sub('\n', text).strip()
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def _build_prompt(article):
+    return list(ARTICLE_EVALUATE_PROMPT) + [{"role": "user", "content": article}]
+
+
+def get_cached_evaluation(article: str):
+    with _cache_lock:
+        result = _cache.get(article_key(article))
+    metrics.incr('article_cache.hit' if result is not None else 'article_cache.miss')
+    return result
+
+
+def _save_evaluation(article, result):
+    if result:
+        with _cache_lock:
+            _cache[article_key(article)] = result
+
+
+def stream_article_evaluation(article: str):
+    """
+    流式评价作文，命中缓存时直接返回缓存的结果。生成完整结束时才写入缓存，中途关闭生成器（客户端断开后取消）时不缓存。
+
+    产出:
+    - ('generate', 新增的文本)
+    - ('finish', 完整的评价)
+    - ('error', 错误信息) 或 ('unknown', 事件数据)
+    """
+    cached = get_cached_evaluation(article)
+    if cached is not None:
+        yield 'generate', cached
+        yield 'finish', cached
+        return
+
+    response = llm_client.sse_invoke(
+        model="chatglm_pro",
+        prompt=_build_prompt(article),
+        temperature=0.9,
+        top_p=0.7,
+    )
+    chunks = []
+    for event in response.events():
+        if event.event == "add":
+            chunks.append(event.data)
+            yield 'generate', event.data
+        elif event.event == "finish":
+            full_text = ''.join(chunks)
+            _save_evaluation(article, full_text)
+            yield 'finish', full_text
+        elif event.event == "error" or event.event == "interrupted":
+            yield 'error', event.data
+        else:
+            yield 'unknown', event.data
+
+
+def _evaluate(article):
+    result = llm_client.complete(model="chatglm_pro", prompt=_build_prompt(article), temperature=0.9, top_p=0.7)
+    _save_evaluation(article, result)
+    return result
+
+
+def evaluate_article(article: str):
+    """
+    评价一篇作文，返回 (评价内容, 是否命中缓存)，出错时抛出 LLMError。
+    """
+    cached = get_cached_evaluation(article)
+    if cached is not None:
+        return cached, True
+    return _flight.do(article_key(article), _evaluate, article), False
+
+
+def evaluate_articles(articles):
+    """
+    批量评价作文，最多 ARTICLE_BATCH_WORKERS 篇同时进行，按完成顺序产出结果。
+
+    参数:
+    - articles: 作文内容数组
+
+    产出:
+    - {index, status, content, cached} 或 {index, status: 'error', message}
+    """
+    futures = {_batch_executor.submit(evaluate_article, article): index for index, article in enumerate(articles)}
+    for future in as_completed(futures):
+        index = futures[future]
+        try:
+            content, cached = future.result()
+        except Exception as e:
+            yield {'index': index, 'status': 'error', 'message': str(e)}
+            continue
+        yield {'index': index, 'status': 'finish', 'content': content, 'cached': cached,
+               'checksum': hashlib.sha256(content.encode('utf-8')).hexdigest()}
@@ -1,12 +1,10 @@
-import requests
 from dotenv import load_dotenv
 import os
+from generate import llm_client
 
 
 def get_lan_response():
     load_dotenv()
-    api_key = os.environ['GPT_KEY']
-    url = os.environ['OPEN_AI_HOST']
     model = os.environ['OPEN_AI_MODEL']
     chapter = []
 
@@ -23,28 +21,13 @@ def get_lan_response():
              'towering under a blue alien sky, masterful, ghibli}' \
              '4、按照上述参考例子格式，更改一下内容，并且组装成一个标准化json进行输出{content:xxxx,name:xxxx,type:xxxx,traits:xxxx,img:xxxx}'
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        'model': model,
-        'messages': [{'role': 'user', 'content': prompt}]
-    }
-    url = url
-
     try:
-        response = requests.post(url, headers=headers, json=data)
-        response_data = response.json()
+        message_content = llm_client.complete(model=model, prompt=prompt, provider='openai')
 
         # 打印完整的响应
-        print(response_data)
-
-        # 判断response是否包含所需的字段
-        if 'choices' in response_data and len(response_data['choices']) > 0:
-            message_content = response_data['choices'][0]['message']['content']
+        print(message_content)
 
-    except requests.RequestException as error:
+    except llm_client.LLMError as error:
         print(f"Error occurred: {error}")
 
     return message_content
@@ -0,0 +1,201 @@
+import itertools
+import os
+import queue
+import socket
+import threading
+import time
+from dotenv import load_dotenv
+from app_instance import app
+from controllers.image_job_controller import add_image_job, get_image_job, find_image_job, claim_image_job, \
+    finish_image_job, fail_image_job, count_pending_image_jobs, heartbeat_image_jobs, reclaim_image_jobs, \
+    list_pending_image_jobs, JOB_DONE, JOB_FAILED
+from tools import metrics
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 图片任务执行线程数；最多排队的任务数，超过时拒绝新任务
+IMAGE_JOB_WORKERS = int(os.environ.get('IMAGE_JOB_WORKERS') or 4)
+IMAGE_JOB_MAX_PENDING = int(os.environ.get('IMAGE_JOB_MAX_PENDING') or 200)
+# 每个任务最多执行几次（失败后重试）
+IMAGE_JOB_MAX_ATTEMPTS = int(os.environ.get('IMAGE_JOB_MAX_ATTEMPTS') or 2)
+# 执行中的任务每隔多少秒更新一次心跳；超过多少秒没有心跳视为执行的进程已中断，由其他进程回收重新执行
+IMAGE_JOB_HEARTBEAT = int(os.environ.get('IMAGE_JOB_HEARTBEAT') or 30)
+IMAGE_JOB_LEASE = int(os.environ.get('IMAGE_JOB_LEASE') or 300)
+# 长轮询最长等待时间（秒）
+IMAGE_JOB_MAX_WAIT = float(os.environ.get('IMAGE_JOB_MAX_WAIT') or 30)
+
+# 任务优先级，数字越小越先执行：用户正在等待的图片优先于换一张
+PRIORITY_INTERACTIVE = 0
+PRIORITY_REFRESH = 10
+PRIORITY_BACKGROUND = 20
+
+# 任务类型 -> 处理函数，处理函数的返回值作为任务结果（需要能序列化为 json）
+handlers = {}
+
+# (优先级, 提交顺序, 任务ID)
+_queue = queue.PriorityQueue()
+_sequence = itertools.count()
+# 任务结束时通知长轮询的请求
+_finished = threading.Condition()
+_started = False
+_start_lock = threading.Lock()
+# 本进程正在执行的任务ID，由心跳线程定时更新
+_running = set()
+_running_lock = threading.Lock()
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+def _enqueue(job_id: int, priority: int):
+    _queue.put((priority, next(_sequence), job_id))
+
+
+def _owner() -> str:
+    # 多进程部署时进程在导入后才 fork，每次取当前的进程号
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def start():
+    """
+    启动任务执行线程和心跳线程并恢复未完成的任务，只在第一次调用时生效，需要在 app context 中调用。
+    """
+    global _started
+    if _started:
+        return
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+        try:
+            reclaimed = reclaim_image_jobs(IMAGE_JOB_LEASE)
+            pending = list_pending_image_jobs()
+        except Exception as e:
+            print('Recover image jobs failed:', e)
+            reclaimed, pending = [], []
+        for job in pending:
+            _enqueue(job['id'], job['priority'])
+        metrics.incr('image_job.recovered', len(reclaimed))
+
+        for index in range(IMAGE_JOB_WORKERS):
+            threading.Thread(target=_worker, daemon=True, name=f'image-job-{index}').start()
+        threading.Thread(target=_heartbeat, daemon=True, name='image-job-heartbeat').start()
+
+
+def submit(job_type: str, params: dict, priority: int = PRIORITY_INTERACTIVE,
+           user_id: int = None, dedupe_key: str = None, dedupe_ttl: int = 0) -> dict:
+    """
+    提交图片生成任务，立即返回任务信息。需要在 app context 中调用。
+
+    参数:
+    - job_type: 任务类型，需要已注册到 handlers
+    - params: 处理函数的参数
+    - priority: 优先级，数字越小越先执行
+    - user_id: 提交任务的用户ID
+    - dedupe_key: 相同请求的 key；相同请求未完成或 dedupe_ttl 秒内已完成时直接返回已有任务
+    - dedupe_ttl: 见 dedupe_key
+
+    返回:
+    - 任务信息，排队的任务过多时抛出 JobQueueFull
+    """
+    if job_type not in handlers:
+        raise ValueError(f'Unknown image job type: {job_type}')
+    start()
+
+    if dedupe_key:
+        existing = find_image_job(dedupe_key, dedupe_ttl)
+        if existing:
+            metrics.incr('image_job.deduplicated')
+            return existing
+
+    if _queue.qsize() >= IMAGE_JOB_MAX_PENDING or count_pending_image_jobs() >= IMAGE_JOB_MAX_PENDING:
+        metrics.incr('image_job.rejected')
+        raise JobQueueFull()
+
+    job = add_image_job(job_type, params, priority=priority, user_id=user_id, dedupe_key=dedupe_key)
+    _enqueue(job['id'], priority)
+    metrics.incr('image_job.submitted')
+    return job
+
+
+def wait(job_id: int, timeout: float = 0) -> dict:
+    """
+    查询任务，任务未结束时最多等待 timeout 秒（长轮询）。需要在 app context 中调用。
+    任务可能由其他进程执行，等待期间每秒重新查询一次。
+    """
+    deadline = time.time() + min(timeout, IMAGE_JOB_MAX_WAIT)
+    while True:
+        job = get_image_job(job_id)
+        remaining = deadline - time.time()
+        if job is None or job['status'] in (JOB_DONE, JOB_FAILED) or remaining <= 0:
+            return job
+        with _finished:
+            _finished.wait(min(remaining, 1))
+
+
+def _worker():
+    while True:
+        _, _, job_id = _queue.get()
+        try:
+            with app.app_context():
+                _run(job_id)
+        except Exception as e:
+            print('Image job worker failed:', e)
+        finally:
+            with _finished:
+                _finished.notify_all()
+
+
+def _heartbeat():
+    """
+    定时更新本进程正在执行的任务的心跳，并回收其他进程中断的任务（执行中但心跳已过期）。
+    """
+    while True:
+        time.sleep(IMAGE_JOB_HEARTBEAT)
+        with _running_lock:
+            running = list(_running)
+        try:
+            with app.app_context():
+                heartbeat_image_jobs(running, _owner())
+                reclaimed = reclaim_image_jobs(IMAGE_JOB_LEASE)
+        except Exception as e:
+            print('Image job heartbeat failed:', e)
+            continue
+        for job in reclaimed:
+            _enqueue(job['id'], job['priority'])
+        metrics.incr('image_job.recovered', len(reclaimed))
+
+
+def _run(job_id: int):
+    owner = _owner()
+    job = claim_image_job(job_id, owner)
+    if job is None:
+        # 已被其他进程执行，或是重复入队
+        return
+
+    with _running_lock:
+        _running.add(job_id)
+    start = time.perf_counter()
+    try:
+        result = handlers[job['job_type']](**job['params'])
+        if result is None:
+            raise RuntimeError('图片生成失败')
+    except Exception as e:
+        retry = job['attempts'] < IMAGE_JOB_MAX_ATTEMPTS
+        metrics.incr('image_job.retried' if retry else 'image_job.failed')
+        print(f"Image job {job_id} failed:", e)
+        if fail_image_job(job_id, owner, str(e), retry=retry) and retry:
+            _enqueue(job_id, job['priority'])
+        return
+    finally:
+        with _running_lock:
+            _running.discard(job_id)
+
+    if not finish_image_job(job_id, owner, result):
+        # 心跳中断期间任务已被回收，以重新执行的结果为准
+        metrics.incr('image_job.lost')
+        return
+    metrics.incr('image_job.done')
+    metrics.incr('image_job.run_ms', int((time.perf_counter() - start) * 1000))
@@ -1,6 +1,5 @@
 import os
 from flask import url_for
-from stability_sdk import client
 import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
 from PIL import Image
 import io
@@ -8,6 +7,7 @@ from dotenv import load_dotenv
 import random
 import warnings
 from datetime import datetime
+from tools.stability_pool import get_stability_client
 
 load_dotenv()
 engine_id = os.environ['ENGINE_ID']
@@ -32,11 +32,7 @@ def generate_and_stream(img_path, dir_url):
         img_data = f.read()
     init_image = Image.open(io.BytesIO(img_data))
 
-    stability_api = client.StabilityInference(
-        key=api_key,
-        verbose=True,
-        engine=engine_id,
-    )
+    stability_api = get_stability_client(engine_id)
 
     answers = stability_api.generate(
         prompt="masterpiece,high quality,best quality,",
@@ -0,0 +1,309 @@
+import abc
+import asyncio
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+import aiohttp
+from dotenv import load_dotenv
+from zhipuai.utils.jwt_token import generate_token
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 连接池及超时配置（秒）
+LLM_POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE') or 100)
+LLM_KEEPALIVE_TIMEOUT = float(os.environ.get('LLM_KEEPALIVE_TIMEOUT') or 60)
+LLM_CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT') or 5)
+LLM_READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT') or 30)
+LLM_TOTAL_TIMEOUT = float(os.environ.get('LLM_TOTAL_TIMEOUT') or 180)
+
+ZHIPUAI_MODEL_API_URL = os.environ.get('ZHIPUAI_MODEL_API_URL') or 'https://open.bigmodel.cn/api/paas/v3/model-api'
+DASHSCOPE_API_URL = os.environ.get('DASHSCOPE_API_URL') or \
+    'https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation'
+
+
+class LLMError(Exception):
+    pass
+
+
+class LLMEvent:
+    """
+    流式生成的事件，字段与 zhipuai sse_invoke 的事件保持一致：
+    - event: add / finish / error / interrupted
+    - data: 新增的文本或错误信息
+    - meta: finish 时的用量等信息
+    """
+
+    def __init__(self, event, data='', meta=None):
+        self.event = event
+        self.data = data
+        self.meta = meta or {}
+
+
+def _to_messages(prompt):
+    if isinstance(prompt, str):
+        return [{'role': 'user', 'content': prompt}]
+    return prompt
+
+
+async def _iter_sse(response):
+    """
+    解析 text/event-stream 响应，逐个产出 {字段名: 值} 形式的事件。
+    """
+    fields = {}
+    async for raw_line in response.content:
+        line = raw_line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            if fields:
+                yield fields
+                fields = {}
+            continue
+        if line.startswith(':'):
+            continue
+        name, _, value = line.partition(':')
+        if value.startswith(' ') and name != 'data':
+            value = value[1:]
+        # 同一事件有多行 data 时按换行拼接
+        if name in fields and name == 'data':
+            fields[name] += '\n' + value
+        else:
+            fields[name] = value
+    if fields:
+        yield fields
+
+
+class LLMProvider(abc.ABC):
+    """
+    大模型服务商接口：stream 以异步迭代的方式产出 LLMEvent。
+    """
+    name = ''
+
+    @abc.abstractmethod
+    def stream(self, session, model, prompt, **params):
+        """
+        调用服务商的流式接口，返回产出 LLMEvent 的异步迭代器（子类用 async 生成器实现）。
+        """
+
+
+class ZhipuProvider(LLMProvider):
+    name = 'zhipu'
+
+    async def stream(self, session, model, prompt, **params):
+        url = f"{ZHIPUAI_MODEL_API_URL}/{model}/sse-invoke"
+        headers = {
+            'Authorization': generate_token(os.environ['QINGHUA_API_KEY']),
+            'Accept': 'text/event-stream',
+        }
+        body = dict(params, prompt=prompt, incremental=True)
+
+        async with session.post(url, headers=headers, json=body) as response:
+            if response.status != 200:
+                yield LLMEvent('error', await response.text())
+                return
+            async for fields in _iter_sse(response):
+                meta = fields.get('meta')
+                yield LLMEvent(fields.get('event', 'add'), fields.get('data', ''),
+                               json.loads(meta) if meta else None)
+
+
+class DashscopeProvider(LLMProvider):
+    name = 'dashscope'
+
+    async def stream(self, session, model, prompt, **params):
+        headers = {
+            'Authorization': f"Bearer {os.environ['DASHSCOPE_API_KEY']}",
+            'Accept': 'text/event-stream',
+            'X-DashScope-SSE': 'enable',
+        }
+        body = {
+            'model': model,
+            'input': {'messages': _to_messages(prompt)},
+            'parameters': dict(params, incremental_output=True),
+        }
+
+        async with session.post(DASHSCOPE_API_URL, headers=headers, json=body) as response:
+            if response.status != 200:
+                yield LLMEvent('error', await response.text())
+                return
+            async for fields in _iter_sse(response):
+                if fields.get('event') == 'error':
+                    yield LLMEvent('error', fields.get('data', ''))
+                    return
+                payload = json.loads(fields.get('data') or '{}')
+                output = payload.get('output', {})
+                if output.get('text'):
+                    yield LLMEvent('add', output['text'])
+                if output.get('finish_reason') not in (None, 'null'):
+                    yield LLMEvent('finish', '', {'usage': payload.get('usage', {}),
+                                                  'request_id': payload.get('request_id')})
+                    return
+
+
+class OpenAIProvider(LLMProvider):
+    name = 'openai'
+
+    async def stream(self, session, model, prompt, **params):
+        headers = {
+            'Authorization': f"Bearer {os.environ['GPT_KEY']}",
+            'Content-Type': 'application/json',
+        }
+        body = dict(params, model=model or os.environ['OPEN_AI_MODEL'], messages=_to_messages(prompt), stream=True)
+
+        async with session.post(os.environ['OPEN_AI_HOST'], headers=headers, json=body) as response:
+            if response.status != 200:
+                yield LLMEvent('error', await response.text())
+                return
+            usage = {}
+            async for fields in _iter_sse(response):
+                data = fields.get('data', '').strip()
+                if data == '[DONE]':
+                    break
+                payload = json.loads(data)
+                usage = payload.get('usage') or usage
+                for choice in payload.get('choices', []):
+                    delta = choice.get('delta', {}).get('content')
+                    if delta:
+                        yield LLMEvent('add', delta)
+            yield LLMEvent('finish', '', {'usage': usage})
+
+
+# 调用完成时的用量回调：listener(meta, usage)，meta 为 finish 事件的信息，usage 为调用方传入的归属信息
+# 回调在事件循环线程中执行，不能有阻塞操作
+usage_listeners = []
+
+
+def _notify_usage(meta, usage):
+    for listener in usage_listeners:
+        try:
+            listener(meta, usage or {})
+        except Exception as e:
+            print('Usage listener failed:', e)
+
+
+PROVIDERS = {
+    'zhipu': ZhipuProvider(),
+    'dashscope': DashscopeProvider(),
+    'openai': OpenAIProvider(),
+}
+
+# 所有请求共用一个事件循环和连接池，事件循环跑在后台线程中
+_loop = None
+_session = None
+_loop_lock = threading.Lock()
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='llm-client-loop', daemon=True).start()
+            _loop = loop
+    return _loop
+
+
+async def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=LLM_POOL_SIZE, keepalive_timeout=LLM_KEEPALIVE_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(total=LLM_TOTAL_TIMEOUT, connect=LLM_CONNECT_TIMEOUT,
+                                        sock_read=LLM_READ_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+@atexit.register
+def _close_session():
+    # 进程退出时关闭连接池
+    if _loop is not None and _session is not None and not _session.closed:
+        try:
+            asyncio.run_coroutine_threadsafe(_session.close(), _loop).result(timeout=5)
+        except Exception:
+            pass
+
+
+async def astream(model, prompt, provider='zhipu', usage=None, **params):
+    """
+    异步流式调用大模型，产出 LLMEvent；网络错误及超时以 error 事件返回。
+
+    参数:
+    - model: 模型名称
+    - prompt: 消息数组或字符串
+    - provider: zhipu / dashscope / openai
+    - usage: 用量归属信息（如 user_id、game_id），不发送给大模型，完成时传给 usage_listeners
+    - params: temperature、top_p 等生成参数
+    """
+    start = time.perf_counter()
+    try:
+        session = await _get_session()
+        async for event in PROVIDERS[provider].stream(session, model, prompt, **params):
+            if event.event == 'finish':
+                event.meta.setdefault('latency', time.perf_counter() - start)
+                event.meta.setdefault('model', model)
+                _notify_usage(event.meta, usage)
+            yield event
+    except asyncio.TimeoutError:
+        yield LLMEvent('error', f'{provider} request timeout')
+    except aiohttp.ClientError as e:
+        yield LLMEvent('error', f'{provider} request failed: {e}')
+
+
+async def acomplete(model, prompt, provider='zhipu', usage=None, **params) -> str:
+    """
+    异步调用大模型并返回完整文本，出错时抛出 LLMError。
+    """
+    chunks = []
+    async for event in astream(model, prompt, provider, usage, **params):
+        if event.event == 'add':
+            chunks.append(event.data)
+        elif event.event in ('error', 'interrupted'):
+            raise LLMError(event.data)
+    return ''.join(chunks)
+
+
+class SyncStream:
+    """
+    同步适配器：在后台事件循环中运行 astream，Flask 路由中以 events() 同步迭代。
+    """
+
+    def __init__(self, model, prompt, provider='zhipu', usage=None, **params):
+        self._queue = queue.Queue()
+        self._future = asyncio.run_coroutine_threadsafe(self._pump(model, prompt, provider, usage, params),
+                                                        _get_loop())
+
+    async def _pump(self, model, prompt, provider, usage, params):
+        try:
+            async for event in astream(model, prompt, provider, usage, **params):
+                self._queue.put(event)
+        except Exception as e:
+            self._queue.put(LLMEvent('error', str(e)))
+        finally:
+            self._queue.put(None)
+
+    def events(self):
+        try:
+            while True:
+                event = self._queue.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            # 调用方提前停止迭代时取消上游请求
+            self._future.cancel()
+
+
+def sse_invoke(model, prompt, provider='zhipu', usage=None, **params) -> SyncStream:
+    """
+    与 zhipuai.model_api.sse_invoke 用法一致的同步流式调用：sse_invoke(...).events()
+    """
+    return SyncStream(model, prompt, provider, usage, **params)
+
+
+def complete(model, prompt, provider='zhipu', usage=None, **params) -> str:
+    """
+    同步调用大模型并返回完整文本，出错时抛出 LLMError。
+    """
+    return asyncio.run_coroutine_threadsafe(acomplete(model, prompt, provider, usage, **params),
+                                            _get_loop()).result()
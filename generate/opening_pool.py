@@ -0,0 +1,91 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from app_instance import app
+from generate import llm_client
+from generate.round_parser import parse_round_or_reask, dump_round
+from controllers.opening_round_controller import add_opening_round, take_opening_round, count_opening_rounds
+from tools import metrics
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 开局回合池配置：默认关闭；每个预设组合保留的数量，以及低于多少时触发补充
+OPENING_POOL_ENABLED = (os.environ.get('OPENING_POOL_ENABLED') or 'false').lower() == 'true'
+OPENING_POOL_SIZE = int(os.environ.get('OPENING_POOL_SIZE') or 5)
+OPENING_POOL_REFILL_THRESHOLD = int(os.environ.get('OPENING_POOL_REFILL_THRESHOLD') or 2)
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='opening-pool')
+# 正在补充的组合，避免重复提交
+_refilling = set()
+_lock = threading.Lock()
+
+
+def _is_preset_pair(theme: dict, protagonist: dict) -> bool:
+    return bool(theme.get('preset')) and bool(protagonist.get('preset'))
+
+
+def generate_opening(prompt) -> str:
+    """
+    调用大模型生成第一回合，返回其中的 json 字符串，无法解析时抛出 RoundParseError。
+    """
+    full_text = llm_client.complete(model="chatglm_pro", prompt=prompt, temperature=0.9, top_p=0.7)
+    return dump_round(parse_round_or_reask(full_text, prompt))
+
+
+def refill_opening_pool(theme_id: int, protagonist_id: int, template_id: int, prompt) -> int:
+    """
+    把主题 × 主角的开局回合补充到 OPENING_POOL_SIZE 个，返回新生成的数量。需要在 app context 中调用。
+    """
+    added = 0
+    for _ in range(OPENING_POOL_SIZE - count_opening_rounds(theme_id, protagonist_id, template_id)):
+        try:
+            add_opening_round(theme_id, protagonist_id, template_id, generate_opening(prompt))
+        except Exception as e:
+            metrics.incr('opening_pool.refill_error')
+            print('Opening pool refill failed:', e)
+            break
+        metrics.incr('opening_pool.refill')
+        added += 1
+    return added
+
+
+def _refill_in_background(key, prompt):
+    try:
+        with app.app_context():
+            refill_opening_pool(*key, prompt)
+    finally:
+        with _lock:
+            _refilling.discard(key)
+
+
+def _schedule_refill(key, prompt):
+    with _lock:
+        if key in _refilling:
+            return
+        _refilling.add(key)
+    _executor.submit(_refill_in_background, key, prompt)
+
+
+def take_opening(theme: dict, protagonist: dict, template_id: int, prompt):
+    """
+    为预设主题 × 预设角色取出一个预生成的第一回合 json 字符串，没有可用的返回 None。
+    剩余数量低于阈值时在后台补充。
+
+    参数:
+    - theme: get_theme 返回的主题信息
+    - protagonist: get_protagonist 返回的主角信息
+    - template_id: 游戏规则模板ID
+    - prompt: 生成第一回合的完整 prompt，补充时使用
+    """
+    if not OPENING_POOL_ENABLED or not template_id or not _is_preset_pair(theme, protagonist):
+        return None
+
+    key = (theme['id'], protagonist['id'], template_id)
+    content = take_opening_round(*key)
+    metrics.incr('opening_pool.hit' if content else 'opening_pool.miss')
+
+    if count_opening_rounds(*key) < OPENING_POOL_REFILL_THRESHOLD:
+        _schedule_refill(key, list(prompt))
+
+    return content
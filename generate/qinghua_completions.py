@@ -2,60 +2,216 @@ import json
 import zhipuai
 import os
 import controllers.game_controller as game_controller
-# from controllers.game_controller import get_game, edit_game
+# from controllers.game_controller import get_game, add_game_round
 from dotenv import load_dotenv
-import json
-import re
 from flask import Response
+from tools.stream_parser import JsonFieldExtractor
+from generate import llm_client, speculative, reroll_buffer, opening_pool
+from generate.round_parser import parse_round, parse_round_or_reask, dump_round, RoundParseError
+from tools.single_flight import SingleFlight, content_key
+from controllers.prompt_template_controller import get_latest_prompt_template, get_prompt_template_messages
 
 
 load_dotenv()  # 加载 .env 文件中的变量
 
 zhipuai.api_key = os.environ['QINGHUA_API_KEY']
 
-
-# 随机换一换剧情
-def get_random_plot(game_id):
-    game = game_controller.get_game(id=game_id)
-    content = json.loads(game['content'])
-    prompt = json.loads(game['prompt_history'])
-    new_entry = {
-        'role': 'user',
-        'content': f'换一换'
-
-    }
-    prompt.append(new_entry)
-    response = zhipuai.model_api.sse_invoke(
+# 相同故事内容的生图描述合并生成，并缓存一段时间（秒）
+IMG_PROMPT_CACHE_TTL = int(os.environ.get('IMG_PROMPT_CACHE_TTL') or 300)
+_img_prompt_flight = SingleFlight('img_prompt', ttl=IMG_PROMPT_CACHE_TTL)
+
+# 冒险游戏规则模板名称
+GAME_RULES_TEMPLATE = 'adventure_game'
+
+# 冒险游戏规则的固定对话，所有游戏共用，保存在 prompt 模板表中
+GAME_RULES_PROMPT = [
+    {"role": "user",
+     "content": "我希望你扮演一个基于文本的冒险游戏，游戏主题：（稍后提供），游戏主角：（稍后提供）。如果你明白了就回复“收到”，之后我会给你介绍这个游戏的规则。"},
+    {"role": "assistant",
+     "content": " 收到，我已经明白了。请告诉我这个游戏的规则。"},
+    {"role": "user",
+     "content": "游戏总共 8 回合，每一个回合你都需要生成故事内容和a、b、c三个选项。如果你明白了就回复“收到”，之后我会给你介绍每个回合生成内容的规则。"},
+    {"role": "assistant",
+     "content": "收到，我已经明白了。请告诉我每个回合生成内容的规则。"},
+    {"role": "user",
+     "content": "每个回合都包含以下的字段，分别是：回合数，章节名，故事内容，故事选项。如果你明白了就回复“收到”，之后我会给你介绍每个字段的规则。"},
+    {"role": "assistant",
+     "content": "收到，我已经明白了。请告诉我每个字段的规则。"},
+    {"role": "user",
+     "content": "1、回合数：记录当前回合数，整数类型，从0开始增加，到8终止；2、章节名：记录当前章节名字，枚举类型，分别是：故事的开端，情节推进，矛盾产生，关键决策，情节发展，高潮冲突，结局逼近，最终结局，章节名分别与回合数一一对应，回合1对应故事的开端，回合2对应情节推进，回合3对应矛盾产生，回合4对应关键决策，回合5对应情节发展，回合6对应高潮冲突，回合7对应结局逼近，回合8对应最终结局；3、故事内容：根据当前章节名的剧情提示，生成与上一个回合内容及选项相关的故事内容；4、故事选项：根据当前故事内容，生成3个相关的会影响故事发展的选项；如果你明白了就回复“收到”，之后我会给你介绍这个游戏的玩法。"},
+    {"role": "assistant",
+     "content": "收到，我已经明白了。请告诉我这个游戏的玩法。"},
+    {"role": "user",
+     "content": "1、你需要根据我提供的游戏主题和游戏主角，先生成第一回合的所有内容给我；2、如果我回复游戏选项里的其中一个，你需要根据我回复的选项，生成下一个回合的所有内容给我；3、如果我回复“自定义”，你需要根据我回复的自定义内容，生成下一个回合的所有内容给我；4、如果我回复“换一换”，你需要重新生成当前回合的所有内容给我；如果你明白了就回复“收到”，之后我会给你介绍这个游戏的限制。"},
+    {"role": "assistant",
+     "content": "收到，我已经明白了。请告诉我这个游戏的限制。"},
+    {"role": "user",
+     "content": "1、每个回合的故事内容必须控制在 80 字以内，游戏在第8回合结束；2、你给我生成的故事内容和故事选项需要是有趣搞怪一点的，前后逻辑有联系的，不要太拘泥于常规的内容，虚幻，古代，现实的题材都可以；3、每个回合的情节结构必须和章节名对应，8个回合8个情节循序渐进，缺一不可；如果你明白了就回复“收到”，之后我会给你介绍你回复的格式要求。"},
+    {"role": "assistant",
+     "content": "收到，我已经明白了。请告诉我回复的格式要求。"},
+    {"role": "user",
+     "content": "回复的格式必须要json格式，key的对应关系如下：round对应回合数，chapter对应章节名，content对应故事内容，choice对应故事选项；参考示例：{\"round\":\"xxx\",\"chapter\":\"xxx\",\"content\":\"xxx\",\"choice\":[\"a.xxx\",\"b.xxx\",\"c.xxx\"]}；如果你明白了就回复“收到”，之后我就会给你发送游戏主题和游戏主角，然后游戏开始。"},
+    {"role": "assistant",
+     "content": "收到，我已经明白了。请发送游戏主题和游戏主角，我将开始游戏。"},
+]
+
+
+# 获取冒险游戏规则模板的ID，模板不存在时自动创建
+def get_game_rules_template_id():
+    return get_latest_prompt_template(GAME_RULES_TEMPLATE, GAME_RULES_PROMPT)
+
+
+# 流式生成一个回合，边生成边返回故事内容
+def stream_plot_content(prompt, usage=None):
+    """
+    调用大模型流式生成一个回合的内容。
+
+    参数:
+    - prompt: 与大模型交互的完整 prompt
+    - usage: 用量归属信息 {user_id, game_id}
+
+    产出:
+    - ('generate', 新增的故事内容)：故事内容有新增时产出，调用方自行拼接
+    - ('finish', 完整的生成文本)
+    - ('error', 错误信息) 或 ('unknown', 事件数据)
+    """
+    response = llm_client.sse_invoke(
         model="chatglm_pro",
         prompt=prompt,
+        usage=usage,
         temperature=0.9,
         top_p=0.7,
-        incremental=True
     )
-    full_text = ""
+    # 增量提取 content 字段，每个事件只扫描新增的片段
+    extractor = JsonFieldExtractor('content')
+    chunks = []
 
     for event in response.events():
         if event.event == "add":
-            full_text += event.data
+            chunks.append(event.data)
+            delta = extractor.feed(event.data)
+            if delta:
+                yield 'generate', delta
         elif event.event == "finish":
-            meta_info = event.meta  # 假设 event.meta 是一个字典，包含了 "task_status"、"usage" 等字段
+            yield 'finish', ''.join(chunks)
         elif event.event == "error" or event.event == "interrupted":
-            print('Error or interrupted:', event.data)
+            yield 'error', event.data
         else:
-            print('Unknown event:', event.data)
+            yield 'unknown', event.data
+
+
+# 游戏的用量归属信息
+def game_usage(game):
+    return {'user_id': game.get('user_id'), 'game_id': game.get('id')}
+
+
+# 开局的 prompt：游戏规则模板 + 主题及主角信息
+def get_game_start_prompt(theme, protagonist, template_id):
+    re_start_str = f"游戏主题：{theme['description']}，游戏主角：{protagonist['name'] + '，' + protagonist['description']}"
+    prompt = get_prompt_template_messages(template_id)
+    prompt.append({"role": "user", "content": re_start_str})
+    return prompt
+
+
+# 生成第一回合，预设主题 × 预设角色优先使用开局池，产出格式与 stream_plot_content 一致
+def stream_opening_round(theme, protagonist, template_id, prompt, user_id=None):
+    json_content = opening_pool.take_opening(theme, protagonist, template_id, prompt)
+    if json_content is None:
+        yield from stream_plot_content(prompt, usage={'user_id': user_id})
+        return
 
-    json_match = re.search(r'\{.*?\}', full_text, re.DOTALL)
-    json_content = json_match.group(0)
+    delta = JsonFieldExtractor('content').feed(json_content)
+    if delta:
+        yield 'generate', delta
+    yield 'finish', json_content
+
+
+# 回合保存后，在后台预生成各选项的下一回合及换一换的备选剧情
+def prefetch_next_rounds(game):
+    speculative.speculate_next_rounds(game)
+    reroll_buffer.fill_reroll_buffer(game)
+
+
+# 游戏被重置时丢弃所有预生成结果
+def discard_prefetched_rounds(game_id):
+    speculative.discard_speculation(game_id)
+    reroll_buffer.discard_reroll_buffer(game_id)
+
+
+# 取出已完成的预生成结果，没有或失败时返回 None
+def _prefetched_text(future):
+    if future is None:
+        return None
+    try:
+        # 预生成仍在进行时直接等待其完成，不再重新调用大模型
+        return future.result(timeout=llm_client.LLM_TOTAL_TIMEOUT)
+    except Exception as e:
+        print('Prefetched generation failed:', e)
+        return None
+
+
+# 取出玩家选项对应的预生成结果，没有或失败时返回 None
+def _speculated_text(game, user_input):
+    return _prefetched_text(speculative.take_speculation(game, user_input))
+
+
+# 生成下一回合，优先使用预生成结果，产出格式与 stream_plot_content 一致
+def stream_next_round(game, prompt, user_input):
+    full_text = _speculated_text(game, user_input)
+    if full_text is None:
+        yield from stream_plot_content(prompt, usage=game_usage(game))
+        return
+
+    delta = JsonFieldExtractor('content').feed(full_text)
+    if delta:
+        yield 'generate', delta
+    yield 'finish', full_text
+
+
+# 随机换一换剧情
+def get_random_plot(game_id):
+    game = game_controller.get_game(id=game_id)
+    prompt = game_controller.get_game_prompt(game)
+    new_entry = {
+        'role': 'user',
+        'content': f'换一换'
 
-    new_response = {
-        'role': 'assistant',
-        'content': json_content
     }
-    prompt.append(new_response)
-    content[-1] = json.loads(json_content)
-    # 保存最新生成内容到game
-    result = game_controller.edit_game(id=game_id, prompt_history=json.dumps(prompt,ensure_ascii=False),
-                       content=json.dumps(content,ensure_ascii=False))
+    prompt.append(new_entry)
+
+    # 优先使用缓存的备选剧情，缓存为空时再实时生成
+    round_data = None
+    full_text = _prefetched_text(reroll_buffer.take_reroll(game))
+    if full_text:
+        try:
+            round_data = parse_round(full_text)
+        except RoundParseError as e:
+            print('Prefetched reroll is not a valid round:', e)
+    if round_data is None:
+        response = llm_client.sse_invoke(
+            model="chatglm_pro",
+            prompt=prompt,
+            usage=game_usage(game),
+            temperature=0.9,
+            top_p=0.7,
+        )
+        full_text = ""
+
+        for event in response.events():
+            if event.event == "add":
+                full_text += event.data
+            elif event.event == "finish":
+                pass
+            elif event.event == "error" or event.event == "interrupted":
+                print('Error or interrupted:', event.data)
+            else:
+                print('Unknown event:', event.data)
+
+        round_data = parse_round_or_reask(full_text, prompt, usage=game_usage(game))
+
+    # 替换当前回合为最新生成的内容
+    result = game_controller.replace_last_game_round(game_id=game_id, round_data=round_data)
+    prefetch_next_rounds(result)
 
     return result
 
@@ -63,51 +219,57 @@ def get_random_plot(game_id):
 # 提交选项并更新剧情
 def submit_plot_choice(game_id, choice):
     game = game_controller.get_game(id=game_id)
-    content = json.loads(game['content'])
-    prompt = json.loads(game['prompt_history'])
+    prompt = game_controller.get_game_prompt(game)
     new_entry = {
         'role': 'user',
         'content': choice
     }
     prompt.append(new_entry)
 
-    response = zhipuai.model_api.sse_invoke(
-        model="chatglm_pro",
-        prompt=prompt,
-        temperature=0.9,
-        top_p=0.7,
-        incremental=True
-    )
-    full_text = ""
-
-    for event in response.events():
-        if event.event == "add":
-            full_text += event.data
-        elif event.event == "finish":
-            meta_info = event.meta  # 假设 event.meta 是一个字典，包含了 "task_status"、"usage" 等字段
-        elif event.event == "error" or event.event == "interrupted":
-            print('Error or interrupted:', event.data)
-        else:
-            print('Unknown event:', event.data)
-
-    json_match = re.search(r'\{.*?\}', full_text, re.DOTALL)
-    json_content = json_match.group(0)
-
-    new_response = {
-        'role': 'assistant',
-        'content': json_content
-    }
-    prompt.append(new_response)
-    content.append(json.loads(json_content))
-    # 保存最新生成内容到game
-    result = game_controller.edit_game(id=game_id, prompt_history=json.dumps(prompt, ensure_ascii=False),
-                       content=json.dumps(content, ensure_ascii=False))
+    # 优先使用预生成的结果
+    full_text = _speculated_text(game, choice)
+    if full_text is None:
+        response = llm_client.sse_invoke(
+            model="chatglm_pro",
+            prompt=prompt,
+            usage=game_usage(game),
+            temperature=0.9,
+            top_p=0.7,
+        )
+        full_text = ""
+
+        for event in response.events():
+            if event.event == "add":
+                full_text += event.data
+            elif event.event == "finish":
+                pass
+            elif event.event == "error" or event.event == "interrupted":
+                print('Error or interrupted:', event.data)
+            else:
+                print('Unknown event:', event.data)
+
+    round_data = parse_round_or_reask(full_text, prompt, usage=game_usage(game))
+
+    # 保存最新生成的回合到game
+    result = game_controller.add_game_round(game_id=game_id, round_data=round_data, user_input=choice)
+    # 后台预生成下一回合
+    prefetch_next_rounds(result)
 
     return result
 
 
 # 获取创建图片的描述语
 def create_img_prompt(content):
+    # 重试、连点等同时到达的相同内容只调用一次大模型
+    key = content_key('img_prompt', content)
+    result = _img_prompt_flight.do(key, _create_img_prompt, content)
+    if not result:
+        # 生成失败的空结果不缓存
+        _img_prompt_flight.forget(key)
+    return result
+
+
+def _create_img_prompt(content):
     prompt = f"1、故事内容原文{content}" \
              f"2、现在你是一个对接ai生图模型的角色，根据上述content的故事描述及choice内容，想象一个图片画面来表达。" \
              f"3、图片画面尽量丰富，故事内容强相关。然后你需要把这个画面用文字来表达出来，让ai生图模型能看得懂。" \
@@ -115,12 +277,11 @@ def create_img_prompt(content):
              f"5、描述示例：a boy stands against a scaly dragon in a mysterious lair, aiming to rescue a terrified Snow " \
              f"White,The scene is filled with a mix of sunlight and torchlight, surrounded by dense forests"
 
-    response = zhipuai.model_api.sse_invoke(
+    response = llm_client.sse_invoke(
         model="chatglm_pro",
         prompt=prompt,
         temperature=0.7,
         top_p=0.7,
-        incremental=True
     )
     full_text = ""
 
@@ -128,7 +289,7 @@ def create_img_prompt(content):
         if event.event == "add":
             full_text += event.data
         elif event.event == "finish":
-            meta_info = event.meta  # 假设 event.meta 是一个字典，包含了 "task_status"、"usage" 等字段
+            pass
         elif event.event == "error" or event.event == "interrupted":
             print('Error or interrupted:', event.data)
         else:
@@ -139,19 +300,18 @@ def create_img_prompt(content):
 
 def create_plot(choice, game_id):
     game = game_controller.get_game(id=game_id)
-    game_content = json.loads(game['content'])
-    prompt = json.loads(game['prompt_history'])
+    prompt = game_controller.get_game_prompt(game)
     new_entry = {
         'role': 'user',
         'content': f'自定义：{choice}'
     }
     prompt.append(new_entry)
-    response = zhipuai.model_api.sse_invoke(
+    response = llm_client.sse_invoke(
         model="chatglm_pro",
         prompt=prompt,
+        usage=game_usage(game),
         temperature=0.9,
         top_p=0.7,
-        incremental=True
     )
     full_text = ""
 
@@ -159,86 +319,53 @@ def create_plot(choice, game_id):
         if event.event == "add":
             full_text += event.data
         elif event.event == "finish":
-            meta_info = event.meta  # 假设 event.meta 是一个字典，包含了 "task_status"、"usage" 等字段
+            pass
         elif event.event == "error" or event.event == "interrupted":
             print('Error or interrupted:', event.data)
         else:
             print('Unknown event:', event.data)
 
-    json_match = re.search(r'\{.*?\}', full_text, re.DOTALL)
-    json_content = json_match.group(0)
+    round_data = parse_round_or_reask(full_text, prompt, usage=game_usage(game))
 
-    new_response = {
-        'role': 'assistant',
-        'content': json_content
-    }
-    prompt.append(new_response)
-    game_content.append(json.loads(json_content))
-    # 保存最新生成内容到game
-    result = game_controller.edit_game(id=game['id'], prompt_history=json.dumps(prompt, ensure_ascii=False),
-                       content=json.dumps(game_content, ensure_ascii=False))
+    # 保存最新生成的回合到game
+    result = game_controller.add_game_round(game_id=game['id'], round_data=round_data,
+                                            user_input=new_entry['content'])
+    prefetch_next_rounds(result)
 
     return result
 
 
 # 初始化故事的第一话，生成故事所需要内容
-def init_game_data(theme, protagonist):
+def init_game_data(theme, protagonist, user_id=None):
     theme = json.loads(theme)
     protagonist = json.loads(protagonist)
-    re_start_str = f"游戏主题：{theme['description']}，游戏主角：{protagonist['name'] + '，' + protagonist['description']}"
-    prompt = [
-        {"role": "user",
-         "content": "我希望你扮演一个基于文本的冒险游戏，游戏主题：（稍后提供），游戏主角：（稍后提供）。如果你明白了就回复“收到”，之后我会给你介绍这个游戏的规则。"},
-        {"role": "assistant",
-         "content": " 收到，我已经明白了。请告诉我这个游戏的规则。"},
-        {"role": "user",
-         "content": "游戏总共 8 回合，每一个回合你都需要生成故事内容和a、b、c三个选项。如果你明白了就回复“收到”，之后我会给你介绍每个回合生成内容的规则。"},
-        {"role": "assistant",
-         "content": "收到，我已经明白了。请告诉我每个回合生成内容的规则。"},
-        {"role": "user",
-         "content": "每个回合都包含以下的字段，分别是：回合数，章节名，故事内容，故事选项。如果你明白了就回复“收到”，之后我会给你介绍每个字段的规则。"},
-        {"role": "assistant",
-         "content": "收到，我已经明白了。请告诉我每个字段的规则。"},
-        {"role": "user",
-         "content": "1、回合数：记录当前回合数，整数类型，从0开始增加，到8终止；2、章节名：记录当前章节名字，枚举类型，分别是：故事的开端，情节推进，矛盾产生，关键决策，情节发展，高潮冲突，结局逼近，最终结局，章节名分别与回合数一一对应，回合1对应故事的开端，回合2对应情节推进，回合3对应矛盾产生，回合4对应关键决策，回合5对应情节发展，回合6对应高潮冲突，回合7对应结局逼近，回合8对应最终结局；3、故事内容：根据当前章节名的剧情提示，生成与上一个回合内容及选项相关的故事内容；4、故事选项：根据当前故事内容，生成3个相关的会影响故事发展的选项；如果你明白了就回复“收到”，之后我会给你介绍这个游戏的玩法。"},
-        {"role": "assistant",
-         "content": "收到，我已经明白了。请告诉我这个游戏的玩法。"},
-        {"role": "user",
-         "content": "1、你需要根据我提供的游戏主题和游戏主角，先生成第一回合的所有内容给我；2、如果我回复游戏选项里的其中一个，你需要根据我回复的选项，生成下一个回合的所有内容给我；3、如果我回复“自定义”，你需要根据我回复的自定义内容，生成下一个回合的所有内容给我；4、如果我回复“换一换”，你需要重新生成当前回合的所有内容给我；如果你明白了就回复“收到”，之后我会给你介绍这个游戏的限制。"},
-        {"role": "assistant",
-         "content": "收到，我已经明白了。请告诉我这个游戏的限制。"},
-        {"role": "user",
-         "content": "1、每个回合的故事内容必须控制在 80 字以内，游戏在第8回合结束；2、你给我生成的故事内容和故事选项需要是有趣搞怪一点的，前后逻辑有联系的，不要太拘泥于常规的内容，虚幻，古代，现实的题材都可以；3、每个回合的情节结构必须和章节名对应，8个回合8个情节循序渐进，缺一不可；如果你明白了就回复“收到”，之后我会给你介绍你回复的格式要求。"},
-        {"role": "assistant",
-         "content": "收到，我已经明白了。请告诉我回复的格式要求。"},
-        {"role": "user",
-         "content": "回复的格式必须要json格式，key的对应关系如下：round对应回合数，chapter对应章节名，content对应故事内容，choice对应故事选项；参考示例：{\"round\":\"xxx\",\"chapter\":\"xxx\",\"content\":\"xxx\",\"choice\":[\"a.xxx\",\"b.xxx\",\"c.xxx\"]}；如果你明白了就回复“收到”，之后我就会给你发送游戏主题和游戏主角，然后游戏开始。"},
-        {"role": "assistant",
-         "content": "收到，我已经明白了。请发送游戏主题和游戏主角，我将开始游戏。"},
-        {"role": "user",
-         "content": re_start_str}]
-    response = zhipuai.model_api.sse_invoke(
-        model="chatglm_pro",
-        prompt=prompt,
-        temperature=0.9,
-        top_p=0.7,
-        incremental=True
-    )
-
-    full_text = ""
-
-    for event in response.events():
-        if event.event == "add":
-            full_text += event.data
-        elif event.event == "finish":
-            meta_info = event.meta
-        elif event.event == "error" or event.event == "interrupted":
-            print('Error or interrupted:', event.data)
-        else:
-            print('Unknown event:', event.data)
-
-    json_match = re.search(r'\{.*?\}', full_text, re.DOTALL)
-    json_content = json_match.group(0)
+    template_id = get_game_rules_template_id()
+    prompt = get_game_start_prompt(theme, protagonist, template_id)
+
+    # 预设主题 × 预设角色优先使用预生成的开局
+    json_content = opening_pool.take_opening(theme, protagonist, template_id, prompt)
+    if json_content is None:
+        response = llm_client.sse_invoke(
+            model="chatglm_pro",
+            prompt=prompt,
+            usage={'user_id': user_id},
+            temperature=0.9,
+            top_p=0.7,
+        )
+
+        full_text = ""
+
+        for event in response.events():
+            if event.event == "add":
+                full_text += event.data
+            elif event.event == "finish":
+                pass
+            elif event.event == "error" or event.event == "interrupted":
+                print('Error or interrupted:', event.data)
+            else:
+                print('Unknown event:', event.data)
+
+        json_content = dump_round(parse_round_or_reask(full_text, prompt, usage={'user_id': user_id}))
 
     prompt_history = [
         {'role': 'assistant',
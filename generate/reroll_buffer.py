@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from generate import llm_client
+import controllers.game_controller as game_controller
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 换一换备选剧情配置：默认关闭；每回合缓存的备选数量、最多保留的游戏数及有效期（秒）
+REROLL_PREFETCH_ENABLED = (os.environ.get('REROLL_PREFETCH_ENABLED') or 'false').lower() == 'true'
+REROLL_BUFFER_SIZE = int(os.environ.get('REROLL_BUFFER_SIZE') or 2)
+REROLL_MAX_GAMES = int(os.environ.get('REROLL_MAX_GAMES') or 100)
+REROLL_TTL = int(os.environ.get('REROLL_TTL') or 600)
+
+REROLL_INPUT = '换一换'
+
+# 低优先级：单独的单线程池，排队执行，不占用实时生成和选项预生成的线程
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reroll-prefetch')
+# game_id -> {'slot': 回合位置, 'prompt': 换一换的prompt, 'usage': 用量归属, 'created_at': 创建时间, 'alternatives': [Future]}
+_buffers = OrderedDict()
+_lock = threading.Lock()
+
+
+def _generate(prompt, usage):
+    # 与实时换一换使用相同的模型参数
+    return llm_client.complete(model="chatglm_pro", prompt=prompt, usage=usage, temperature=0.9, top_p=0.7)
+
+
+def _round_slot(game: dict) -> str:
+    """
+    当前回合的位置：最后一个回合之前的对话历史。
+    换一换只替换最后一个回合，位置不变，同一位置的备选剧情可以继续使用。
+    """
+    history = json.loads(game['prompt_history'])
+    return hashlib.md5(json.dumps(history[:-1], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def _discard(entry):
+    for future in entry['alternatives']:
+        future.cancel()
+
+
+def _top_up(entry):
+    # 补齐到缓存数量，调用方持有 _lock
+    entry['alternatives'] = [future for future in entry['alternatives'] if not future.cancelled()]
+    while len(entry['alternatives']) < REROLL_BUFFER_SIZE:
+        entry['alternatives'].append(_executor.submit(_generate, entry['prompt'], entry['usage']))
+
+
+def fill_reroll_buffer(game: dict):
+    """
+    回合生成后，在后台为当前回合预生成换一换的备选剧情；同一回合位置已有备选时只补齐数量。
+
+    参数:
+    - game: get_game 返回的游戏数据
+    """
+    if not REROLL_PREFETCH_ENABLED or REROLL_BUFFER_SIZE <= 0 or not game:
+        return
+    if not json.loads(game['content']):
+        return
+
+    slot = _round_slot(game)
+    with _lock:
+        entry = _buffers.get(game['id'])
+        if entry and entry['slot'] == slot and time.time() - entry['created_at'] <= REROLL_TTL:
+            _buffers.move_to_end(game['id'])
+        else:
+            if entry:
+                _discard(entry)
+            prompt = game_controller.get_game_prompt(game) + [{'role': 'user', 'content': REROLL_INPUT}]
+            entry = {'slot': slot, 'prompt': prompt, 'usage': {'user_id': game.get('user_id'), 'game_id': game['id']},
+                     'created_at': time.time(), 'alternatives': []}
+            _buffers[game['id']] = entry
+        _top_up(entry)
+
+        # 超出预算时淘汰最早的游戏
+        while len(_buffers) > REROLL_MAX_GAMES:
+            _, evicted = _buffers.popitem(last=False)
+            _discard(evicted)
+
+
+def take_reroll(game: dict):
+    """
+    取出一个备选剧情（Future）并在后台补齐缓存；没有可用备选时返回 None。
+    优先取已生成完的，其次取正在生成的，仍在排队的不取。
+    """
+    if not REROLL_PREFETCH_ENABLED or not game:
+        return None
+
+    with _lock:
+        entry = _buffers.get(game['id'])
+        if not entry:
+            return None
+        if entry['slot'] != _round_slot(game) or time.time() - entry['created_at'] > REROLL_TTL:
+            _discard(_buffers.pop(game['id']))
+            return None
+
+        future = next((f for f in entry['alternatives'] if f.done() and not f.cancelled()), None)
+        if future is None:
+            future = next((f for f in entry['alternatives'] if f.running()), None)
+        if future is None:
+            return None
+
+        entry['alternatives'].remove(future)
+        _top_up(entry)
+
+    return future
+
+
+def discard_reroll_buffer(game_id: int):
+    """
+    游戏被重置时丢弃备选剧情。
+    """
+    with _lock:
+        entry = _buffers.pop(game_id, None)
+    if entry:
+        _discard(entry)
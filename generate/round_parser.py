@@ -0,0 +1,258 @@
+import json
+import os
+import re
+from dotenv import load_dotenv
+from generate import llm_client
+from tools import metrics
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 回合内容无法修复时，最多重新请求大模型的次数
+ROUND_MAX_REASK = int(os.environ.get('ROUND_MAX_REASK') or 1)
+
+# 章节名与回合数一一对应
+CHAPTERS = ['故事的开端', '情节推进', '矛盾产生', '关键决策', '情节发展', '高潮冲突', '结局逼近', '最终结局']
+# 最终结局之前的每个回合都要有 a、b、c 三个选项
+CHOICE_COUNT = 3
+_CHINESE_NUMBERS = {'一': 1, '二': 2, '三': 3, '四': 4, '五': 5, '六': 6, '七': 7, '八': 8, '九': 9, '十': 10}
+
+REASK_PROMPT = '你上一条回复不完整或不是合法的json格式。请严格按照 {"round":"xxx","chapter":"xxx","content":"xxx",' \
+               '"choice":["a.xxx","b.xxx","c.xxx"]} 的格式重新回复当前回合的内容，不要输出json以外的任何内容。'
+
+# json 结构外出现的全角符号
+_FULLWIDTH = {'，': ',', '：': ':', '｛': '{', '｝': '}', '［': '[', '］': ']', '【': '[', '】': ']'}
+_OPENERS = {'{': '}', '[': ']'}
+_QUOTES = '"“”＂'
+_FULLWIDTH_QUOTES = '“”＂'
+# 字符串结束引号之后应该出现的字符；全角逗号、冒号在内容中也很常见，之后还要紧跟 json 结构才算
+_AFTER_STRING = ',:}]｝］】'
+_AFTER_STRING_FULLWIDTH = '，：'
+_VALUE_START = '"“”＂{[｛［【-0123456789tfn'
+_ESCAPES = '"\\/bfnrtu'
+_CONTROL = {'\n': '\\n', '\r': '\\r', '\t': '\\t'}
+_CHOICE_SPLIT = re.compile(r'\s*\n\s*|\s+(?=[a-cA-C][.、．])')
+
+
+class RoundParseError(ValueError):
+    pass
+
+
+def _skip_whitespace(text, index):
+    while index < len(text) and text[index] in ' \t\r\n':
+        index += 1
+    return index
+
+
+def _closes_string(text, index):
+    # index 处的引号之后是 json 结构（或回复结束）时，才是字符串的结束引号
+    index = _skip_whitespace(text, index + 1)
+    if index >= len(text) or text[index] in _AFTER_STRING:
+        return True
+    if text[index] in _AFTER_STRING_FULLWIDTH:
+        index = _skip_whitespace(text, index + 1)
+        return index >= len(text) or text[index] in _VALUE_START
+    return False
+
+
+def _normalize(text):
+    """
+    从大模型回复中截取第一个完整的 json 对象并做本地修复，一次扫描完成：
+    - 按括号配对截取，忽略前后的说明文字和代码块标记，字符串中的括号不计入
+    - 结构外的全角逗号、冒号、括号、引号改为半角，去掉 } ] 前多余的逗号
+    - 字符串中未转义的引号、换行及非法转义改为转义形式
+
+    回复被截断（结束时字符串或括号未闭合）时内容不完整，抛出 RoundParseError，不做补齐。
+
+    返回:
+    - (修复后的 json 字符串, 原始截取片段)，找不到 json 对象时返回 (None, None)
+    """
+    start = -1
+    for index, ch in enumerate(text):
+        if ch in '{｛':
+            start = index
+            break
+    if start < 0:
+        return None, None
+
+    out = []
+    stack = []
+    in_string = False
+    fullwidth_string = False
+    index = start
+    while index < len(text):
+        ch = text[index]
+        if in_string:
+            if ch == '\\':
+                following = text[index + 1] if index + 1 < len(text) else ''
+                if following and following in _ESCAPES:
+                    out.append(ch + following)
+                    index += 2
+                    continue
+                out.append('\\\\')
+            elif ch == '"' or (fullwidth_string and ch in _FULLWIDTH_QUOTES):
+                if _closes_string(text, index):
+                    out.append('"')
+                    in_string = False
+                else:
+                    # 字符串内容里的引号
+                    out.append('\\"')
+            elif ch in _CONTROL:
+                out.append(_CONTROL[ch])
+            else:
+                out.append(ch)
+        else:
+            ch = _FULLWIDTH.get(ch, ch)
+            if ch in _QUOTES:
+                out.append('"')
+                in_string = True
+                fullwidth_string = ch != '"'
+            elif ch in _OPENERS:
+                out.append(ch)
+                stack.append(_OPENERS[ch])
+            elif ch in '}]':
+                # 去掉结尾多余的逗号
+                while out and out[-1] in ' \t\r\n':
+                    out.pop()
+                if out and out[-1] == ',':
+                    out.pop()
+                out.append(stack.pop() if stack else ch)
+                if not stack:
+                    return ''.join(out), text[start:index + 1]
+            else:
+                out.append(ch)
+        index += 1
+
+    # 回复被截断：故事内容或选项可能只有一半，交给调用方重新生成
+    raise RoundParseError('reply is truncated')
+
+
+def _to_round_number(value, chapter):
+    if isinstance(value, bool):
+        value = None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        digits = re.search(r'\d+', value)
+        if digits:
+            return int(digits.group(0))
+        for ch in value:
+            if ch in _CHINESE_NUMBERS:
+                return _CHINESE_NUMBERS[ch]
+    if chapter in CHAPTERS:
+        return CHAPTERS.index(chapter) + 1
+    return None
+
+
+def _validate(data):
+    """
+    校验并规整回合内容 {round, chapter, content, choice[]}，返回 (回合内容, 是否有修改)。
+    """
+    if not isinstance(data, dict):
+        raise RoundParseError('round is not a json object')
+
+    content = data.get('content')
+    if not isinstance(content, str) or not content.strip():
+        raise RoundParseError('round content is empty')
+
+    changed = False
+    chapter = data.get('chapter')
+    round_number = _to_round_number(data.get('round'), chapter)
+    if round_number is None:
+        raise RoundParseError(f"invalid round: {data.get('round')!r}")
+    if round_number != data.get('round'):
+        changed = True
+    if not isinstance(chapter, str) or not chapter:
+        if not 1 <= round_number <= len(CHAPTERS):
+            raise RoundParseError('round chapter is missing')
+        chapter = CHAPTERS[round_number - 1]
+        changed = True
+
+    choice = data.get('choice')
+    if choice is None:
+        if round_number < len(CHAPTERS):
+            raise RoundParseError('round choice is missing')
+        # 最终结局没有选项
+        choice = []
+        changed = True
+    elif isinstance(choice, str):
+        choice = [item for item in _CHOICE_SPLIT.split(choice.strip()) if item]
+        changed = True
+    elif not isinstance(choice, list):
+        raise RoundParseError('round choice is not a list')
+    elif not all(isinstance(item, str) for item in choice):
+        choice = [str(item) for item in choice]
+        changed = True
+    if round_number < len(CHAPTERS) and len(choice) < CHOICE_COUNT:
+        raise RoundParseError(f'round has {len(choice)} choices, expected {CHOICE_COUNT}')
+
+    round_data = dict(data, round=round_number, chapter=chapter, content=content, choice=choice)
+    return round_data, changed
+
+
+def parse_round(text):
+    """
+    解析大模型回复的回合内容，能在本地修复的格式问题直接修复。
+
+    参数:
+    - text: 大模型的完整回复
+
+    返回:
+    - 回合内容 {round(int), chapter, content, choice[]}
+
+    无法修复时抛出 RoundParseError。
+    """
+    try:
+        normalized, raw = _normalize(text or '')
+        if normalized is None:
+            raise RoundParseError('no json object in reply')
+        round_data, changed = _validate(json.loads(normalized))
+    except (json.JSONDecodeError, RoundParseError) as e:
+        metrics.incr('round_parser.failed')
+        raise RoundParseError(str(e)) from e
+
+    if changed or normalized != raw:
+        metrics.incr('round_parser.repaired')
+    else:
+        metrics.incr('round_parser.ok')
+    return round_data
+
+
+def parse_round_or_reask(text, prompt, usage=None):
+    """
+    解析回合内容，无法修复时把原回复和格式要求发给大模型重新生成，最多 ROUND_MAX_REASK 次。
+
+    参数:
+    - text: 大模型的完整回复
+    - prompt: 生成该回复时的 prompt
+    - usage: 用量归属信息 {user_id, game_id}
+
+    返回:
+    - 回合内容，重试后仍无法解析时抛出 RoundParseError
+    """
+    try:
+        return parse_round(text)
+    except RoundParseError as e:
+        error = e
+
+    for _ in range(ROUND_MAX_REASK):
+        metrics.incr('round_parser.reask')
+        reask_prompt = list(prompt) + [{'role': 'assistant', 'content': text},
+                                       {'role': 'user', 'content': REASK_PROMPT}]
+        try:
+            text = llm_client.complete(model="chatglm_pro", prompt=reask_prompt, usage=usage,
+                                       temperature=0.9, top_p=0.7)
+            round_data = parse_round(text)
+        except (RoundParseError, llm_client.LLMError) as e:
+            error = e
+            continue
+        metrics.incr('round_parser.reask_ok')
+        return round_data
+
+    raise RoundParseError(f'unrepairable round reply: {error}')
+
+
+def dump_round(round_data):
+    """
+    回合内容序列化为保存在对话历史中的 json 字符串。
+    """
+    return json.dumps(round_data, ensure_ascii=False)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from generate import llm_client
+import controllers.game_controller as game_controller
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 预生成配置：默认关闭；同时进行的预生成数量、最多保留的游戏数及结果有效期（秒）
+SPECULATIVE_ENABLED = (os.environ.get('SPECULATIVE_ENABLED') or 'false').lower() == 'true'
+SPECULATIVE_MAX_WORKERS = int(os.environ.get('SPECULATIVE_MAX_WORKERS') or 3)
+SPECULATIVE_MAX_GAMES = int(os.environ.get('SPECULATIVE_MAX_GAMES') or 50)
+SPECULATIVE_TTL = int(os.environ.get('SPECULATIVE_TTL') or 600)
+
+# 游戏最后一个回合，不再预生成
+LAST_ROUND = 8
+
+_executor = ThreadPoolExecutor(max_workers=SPECULATIVE_MAX_WORKERS, thread_name_prefix='speculative')
+# game_id -> {'state': 当前回合状态, 'created_at': 创建时间, 'branches': {选项: Future}}
+_speculations = OrderedDict()
+_lock = threading.Lock()
+
+
+def _generate(prompt, usage):
+    # 与实时生成使用相同的模型参数
+    return llm_client.complete(model="chatglm_pro", prompt=prompt, usage=usage, temperature=0.9, top_p=0.7)
+
+
+def _game_state(game: dict) -> str:
+    # 对话历史变化（新回合、换一换、重置）后，之前的预生成结果即失效
+    return hashlib.md5(game['prompt_history'].encode('utf-8')).hexdigest()
+
+
+def _choice_key(choice: str) -> str:
+    """
+    选项统一按序号匹配：'a'、'A'、'a.xxx'、'a. xxx' 都视为选项 a。
+    """
+    choice = (choice or '').strip()
+    if choice and choice[0].lower() in 'abc' and (len(choice) == 1 or choice[1] in '.、．:： '):
+        return choice[0].lower()
+    return choice
+
+
+def _discard(entry):
+    # 未开始的预生成直接取消，已开始的让其结束后丢弃结果
+    for future in entry['branches'].values():
+        future.cancel()
+
+
+def speculate_next_rounds(game: dict):
+    """
+    回合保存后，在后台为当前回合的每个选项预生成下一回合。
+
+    参数:
+    - game: get_game 返回的游戏数据
+    """
+    if not SPECULATIVE_ENABLED or not game:
+        return
+
+    content = json.loads(game['content'])
+    if not content:
+        return
+    last_round = content[-1]
+    choices = last_round.get('choice') or []
+    if not choices or str(last_round.get('round')).strip() == str(LAST_ROUND):
+        return
+
+    prompt = game_controller.get_game_prompt(game)
+    usage = {'user_id': game.get('user_id'), 'game_id': game['id']}
+    branches = {}
+    for choice in choices:
+        branch_prompt = prompt + [{'role': 'user', 'content': choice}]
+        branches[_choice_key(choice)] = _executor.submit(_generate, branch_prompt, usage)
+
+    with _lock:
+        old = _speculations.pop(game['id'], None)
+        if old:
+            _discard(old)
+        _speculations[game['id']] = {'state': _game_state(game), 'created_at': time.time(), 'branches': branches}
+        # 超出预算时淘汰最早的游戏
+        while len(_speculations) > SPECULATIVE_MAX_GAMES:
+            _, evicted = _speculations.popitem(last=False)
+            _discard(evicted)
+
+
+def take_speculation(game: dict, choice: str):
+    """
+    取出与玩家选项匹配的预生成结果（Future），没有可用结果时返回 None。
+    同一游戏的其他分支随之丢弃。
+    """
+    if not SPECULATIVE_ENABLED or not game:
+        return None
+
+    with _lock:
+        entry = _speculations.pop(game['id'], None)
+    if not entry:
+        return None
+
+    future = None
+    if entry['state'] == _game_state(game) and time.time() - entry['created_at'] <= SPECULATIVE_TTL:
+        future = entry['branches'].pop(_choice_key(choice), None)
+    _discard(entry)
+
+    if future is None or future.cancelled():
+        return None
+    return future
+
+
+def discard_speculation(game_id: int):
+    """
+    游戏状态被其他方式改变（换一换、重置）时丢弃预生成结果。
+    """
+    with _lock:
+        entry = _speculations.pop(game_id, None)
+    if entry:
+        _discard(entry)
@@ -1,18 +1,23 @@
 import os
 from flask import request, url_for
-from stability_sdk import client
 import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
 from PIL import Image
 import io
 from dotenv import load_dotenv
 import random
 import warnings
+import uuid
 from datetime import datetime
 from generate.image_to_image import generate_and_stream as img2img
 from tools.upscale import upscale_pic
-from tools.ali_oss import upload_pic
+from tools.ali_oss import upload_pic, upload_bytes, save_local_copy
+from tools.stability_pool import get_stability_client
+from tools.single_flight import content_key
+from tools import metrics
+from tools import image_variants
 from controllers.image_controller import add_image
 from controllers.protagonist_image_controller import add_protagonist_image
+from controllers.image_cache_controller import get_cached_image_urls, add_cached_image_urls
 from app_instance import app
 
 
@@ -31,15 +36,87 @@ samples = 3
 sampler = generation.SAMPLER_K_DPMPP_2M
 style_preset = 'pixel-art'
 
+# 相同的生成参数（prompt、seed、steps 等）直接返回已生成的图片，不再重复调用 Stability
+IMAGE_CACHE_ENABLED = (os.environ.get('IMAGE_CACHE_ENABLED') or 'true').lower() == 'true'
+
+
+def store_artifact(binary, img_name='image.png'):
+    """
+    保存生成的图片：Stability 返回的已经是 PNG，不再解码重新编码，直接上传到阿里云 oss；
+    本地 out 目录的副本由后台线程写入，不在请求的关键路径上。
+    :param binary: 图片内容（artifact.binary）
+    :param img_name: 文件名
+    :return: 图片的网络地址
+    """
+    # 同一秒内会生成多张图片，目录名加上随机后缀避免重名
+    dir_url = 'out/' + datetime.now().strftime("%Y%m%d%H%M%S") + '_' + uuid.uuid4().hex[:8]
+    save_local_copy(binary, os.path.join(dir_url, img_name))
+    oss_object_key = f'{dir_url}/{img_name}'
+    url = upload_bytes(binary, oss_object_key)
+    # 后台生成列表等场景使用的小尺寸图片
+    image_variants.on_upload(binary, oss_object_key, url)
+    return url
+
+
+def prompt_seed(prompt):
+    """
+    由 prompt 得到固定的 seed：相同的 prompt 在任何进程中都使用同一个 seed，生成的图片可以复用
+    """
+    return 100_000_000 + int(content_key('seed', prompt), 16) % 900_000_000
+
+
+def generate_image_urls(prompt, samples=1, force_new_seed=False):
+    """
+    生成图片并上传，依次产出图片地址；完全相同的生成参数生成过的图片直接从缓存返回。
+    :param prompt: 图片描述
+    :param samples: 生成的图片数量
+    :param force_new_seed: 换一张：使用新的随机 seed 重新生成，不读取缓存
+    """
+    seed = random.randint(100_000_000, 999_999_999) if force_new_seed else prompt_seed(prompt)
+    params = {
+        'prompt': prompt,
+        'seed': seed,
+        'steps': steps,
+        'cfg_scale': cfg_scale,
+        'width': width,
+        'height': height,
+        'samples': samples,
+        'sampler': sampler,
+        'style_preset': style_preset,
+    }
+    param_hash = content_key('text_to_image', engine_id, params)
+
+    if IMAGE_CACHE_ENABLED and not force_new_seed:
+        with app.app_context():
+            cached = get_cached_image_urls(param_hash)
+        if cached:
+            metrics.incr('image_cache.hit')
+            yield from cached
+            return
+        metrics.incr('image_cache.miss')
+
+    stability_api = get_stability_client(engine_id)
+    answers = stability_api.generate(**params)
+
+    image_urls = []
+    filtered = False
+    for resp in answers:
+        for artifact in resp.artifacts:
+            if artifact.finish_reason == generation.FILTER:
+                warnings.warn("Your request activated the API's safety filters and could not be processed.")
+                filtered = True
+            if artifact.type == generation.ARTIFACT_IMAGE:
+                # 直接上传生成的 PNG，本地副本在后台写入
+                image_urls.append(store_artifact(artifact.binary))
+                # 调用方取到需要的图片后可能不再继续迭代，全部生成后先保存缓存再产出最后一张
+                if IMAGE_CACHE_ENABLED and not filtered and len(image_urls) == samples:
+                    with app.app_context():
+                        add_cached_image_urls(param_hash, params, image_urls)
+                yield image_urls[-1]
 
-def test_generate_and_stream():
-    yield "Image generation started...\n"
 
-    stability_api = client.StabilityInference(
-        key=api_key,
-        verbose=True,
-        engine=engine_id,
-    )
+def test_generate_and_stream(force_new_seed=False):
+    yield "Image generation started...\n"
 
     # prompt = request.json.get('prompt')
     prompt = "a young hero, brandishing a sword and shield, stands before a massive dragon's lair, determined to " \
@@ -47,37 +124,8 @@ def test_generate_and_stream():
              "darkness of the lair and the light of the hero's determination.,master piece,cg,4k,best quality,"
     # print(prompt)
 
-    answers = stability_api.generate(
-        # prompt=prompt,
-        prompt=prompt,
-        seed=random_seed,
-        steps=steps,
-        cfg_scale=cfg_scale,
-        width=width,
-        height=height,
-        samples=1,
-        sampler=sampler,
-        style_preset=style_preset,
-    )
-
-    for resp in answers:
-        for artifact in resp.artifacts:
-            if artifact.finish_reason == generation.FILTER:
-                warnings.warn("Your request activated the API's safety filters and could not be processed.")
-            if artifact.type == generation.ARTIFACT_IMAGE:
-                img = Image.open(io.BytesIO(artifact.binary))
-                if not os.path.exists('out'):
-                    os.makedirs('out')
-                now = datetime.now()
-                datetime_string = now.strftime("%Y%m%d%H%M%S")
-                dir_url = 'out/' + datetime_string
-                os.makedirs(dir_url)
-                img_path = 'image.png'
-                full_img_path = os.path.join(dir_url, img_path)
-                img.save(full_img_path)
-                generate_result = upload_pic(img_path, dir_url)
-
-                yield f"Upscale Image generated successfully! FI-URL: {generate_result}\n"
+    for generate_result in generate_image_urls(prompt, samples=1, force_new_seed=force_new_seed):
+        yield f"Upscale Image generated successfully! FI-URL: {generate_result}\n"
 
     yield "done"
 
@@ -85,11 +133,7 @@ def test_generate_and_stream():
 def generate_and_stream(prompt):
     yield "Image generation started...\n"
 
-    stability_api = client.StabilityInference(
-        key=api_key,
-        verbose=True,
-        engine=engine_id,
-    )
+    stability_api = get_stability_client(engine_id)
 
     # prompt = request.json.get('prompt')
     prompt = "Hogwarts School of Witchcraft and Wizardry, a magical school with towering castles and buildings " \
@@ -158,212 +202,75 @@ def generate_and_stream(prompt):
     yield "done"
 
 
-def generate_and_stream_protagonist(prompt, protagonist_id):
+def generate_and_stream_protagonist(prompt, protagonist_id, force_new_seed=False):
     yield "Image generation started...\n"
 
-    stability_api = client.StabilityInference(
-        key=api_key,
-        verbose=True,
-        engine=engine_id,
-    )
-
     prompt = "There is a lively little elephant."
     protagonist_id = 1
 
-    answers = stability_api.generate(
-        prompt=prompt,
-        seed=random_seed,
-        steps=steps,
-        cfg_scale=cfg_scale,
-        width=width,
-        height=height,
-        samples=1,
-        sampler=sampler,
-        style_preset=style_preset,
-    )
-
-    for resp in answers:
-        for artifact in resp.artifacts:
-            if artifact.finish_reason == generation.FILTER:
-                warnings.warn("Your request activated the API's safety filters and could not be processed.")
-            if artifact.type == generation.ARTIFACT_IMAGE:
-                img = Image.open(io.BytesIO(artifact.binary))
-                if not os.path.exists('out'):
-                    os.makedirs('out')
-                now = datetime.now()
-                datetime_string = now.strftime("%Y%m%d%H%M%S")
-                dir_url = 'out/' + datetime_string
-                os.makedirs(dir_url)
-                img_path = 'image.png'
-                full_img_path = os.path.join(dir_url, img_path)
-                img.save(full_img_path)
-                generate_result = upload_pic(img_path, dir_url)
-                # 把生成图片存储到数据库
-                add_protagonist_image(image_url=generate_result, protagonist_id=protagonist_id, user_id=1)
-                # print(generate_result)
-                yield f"Upscale Image generated successfully! FI-URL: {generate_result}\n"
+    for generate_result in generate_image_urls(prompt, samples=1, force_new_seed=force_new_seed):
+        # 把生成图片存储到数据库
+        add_protagonist_image(image_url=generate_result, protagonist_id=protagonist_id, user_id=1)
+        # print(generate_result)
+        yield f"Upscale Image generated successfully! FI-URL: {generate_result}\n"
 
     yield "done"
 
 
-def generate_and_stream_plot_four_image(content):
+def generate_and_stream_plot_four_image(content, force_new_seed=False):
     yield "Image generation started...\n"
 
-    stability_api = client.StabilityInference(
-        key=api_key,
-        verbose=True,
-        engine=engine_id,
-    )
-
     prompt = content
 
-    answers = stability_api.generate(
-        prompt=prompt,
-        seed=random_seed,
-        steps=steps,
-        cfg_scale=cfg_scale,
-        width=width,
-        height=height,
-        samples=samples,
-        sampler=sampler,
-        style_preset=style_preset,
-    )
-
     # 图片数组
     images = []
 
-    for resp in answers:
-        for artifact in resp.artifacts:
-            if artifact.finish_reason == generation.FILTER:
-                warnings.warn("Your request activated the API's safety filters and could not be processed.")
-            if artifact.type == generation.ARTIFACT_IMAGE:
-                img = Image.open(io.BytesIO(artifact.binary))
-                if not os.path.exists('out'):
-                    os.makedirs('out')
-                now = datetime.now()
-                datetime_string = now.strftime("%Y%m%d%H%M%S")
-                dir_url = 'out/' + datetime_string
-                os.makedirs(dir_url)
-                img_path = 'image.png'
-                full_img_path = os.path.join(dir_url, img_path)
-                img.save(full_img_path)
-                # 把图片存储到阿里云oss
-                generate_result = upload_pic(img_path, dir_url)
-                # 把生成图片存储到数据库
-                add_image(image_url=generate_result, description=prompt, user_id=1)
-                images.append(generate_result)
+    for generate_result in generate_image_urls(prompt, samples=samples, force_new_seed=force_new_seed):
+        # 把生成图片存储到数据库
+        add_image(image_url=generate_result, description=prompt, user_id=1)
+        images.append(generate_result)
 
-                # print(images)
-                yield f"Upscale Image generated successfully! FI-URL: {images}\n"
+        # print(images)
+        yield f"Upscale Image generated successfully! FI-URL: {images}\n"
 
     yield "done"
 
 
-def generate_and_stream_plot_image(content):
+def generate_and_stream_plot_image(content, force_new_seed=False):
     yield "Image generation started...\n"
 
-    stability_api = client.StabilityInference(
-        key=api_key,
-        verbose=True,
-        engine=engine_id,
-    )
-
     prompt = content
 
-    answers = stability_api.generate(
-        prompt=prompt,
-        seed=random_seed,
-        steps=steps,
-        cfg_scale=cfg_scale,
-        width=width,
-        height=height,
-        samples=1,
-        sampler=sampler,
-        style_preset=style_preset,
-    )
-
-    for resp in answers:
-        for artifact in resp.artifacts:
-            if artifact.finish_reason == generation.FILTER:
-                warnings.warn("Your request activated the API's safety filters and could not be processed.")
-            if artifact.type == generation.ARTIFACT_IMAGE:
-                img = Image.open(io.BytesIO(artifact.binary))
-                if not os.path.exists('out'):
-                    os.makedirs('out')
-                now = datetime.now()
-                datetime_string = now.strftime("%Y%m%d%H%M%S")
-                dir_url = 'out/' + datetime_string
-                os.makedirs(dir_url)
-                img_path = 'image.png'
-                full_img_path = os.path.join(dir_url, img_path)
-                img.save(full_img_path)
-                # 把图片存储到阿里云oss
-                generate_result = upload_pic(img_path, dir_url)
-
-                yield generate_result
+    for generate_result in generate_image_urls(prompt, samples=1, force_new_seed=force_new_seed):
+        yield generate_result
 
     yield "done"
 
 
-def generate_and_save_plot_image(description, user_id, protagonist_id=None ):
+def generate_and_save_plot_image(description, user_id, protagonist_id=None, force_new_seed=False):
     yield "Image generation started...\n"
     # print("Image generation started...")  # 打印日志
 
-    stability_api = client.StabilityInference(
-        key=api_key,
-        verbose=True,
-        engine=engine_id,
-    )
-
     prompt = description
 
-    answers = stability_api.generate(
-        prompt=prompt,
-        seed=random.randint(100_000_000, 999_999_999),
-        steps=steps,
-        cfg_scale=cfg_scale,
-        width=width,
-        height=height,
-        samples=1,
-        sampler=sampler,
-        style_preset=style_preset,
-    )
-
-    for resp in answers:
-        for artifact in resp.artifacts:
-            if artifact.finish_reason == generation.FILTER:
-                warnings.warn("Your request activated the API's safety filters and could not be processed.")
-            if artifact.type == generation.ARTIFACT_IMAGE:
-                img = Image.open(io.BytesIO(artifact.binary))
-                if not os.path.exists('out'):
-                    os.makedirs('out')
-                now = datetime.now()
-                datetime_string = now.strftime("%Y%m%d%H%M%S")
-                dir_url = os.path.join('out', datetime_string)  # 使用 os.path.join 连接
-                os.makedirs(dir_url)
-                img_path = 'image.png'
-                full_img_path = os.path.join(dir_url, img_path)
-                img.save(full_img_path)
-
-                # 把图片存储到阿里云oss
-                generate_result = upload_pic(img_path, dir_url)
-                # 把图片存储到protagonist_image表
-                with app.app_context():
-                    image_id = add_protagonist_image(
-                        image_url=generate_result,
-                        image_description=description,
-                        protagonist_id = protagonist_id,
-                        user_id=user_id
-                    )
-
-
-                # 合并 generate_result 和 image_details 到一个字典中并返回
-                combined_result = {
-                    "generated_image_url": generate_result,
-                    "image_id": image_id
-                }
-                # print(f"Image generated, URL: {generate_result}")  # 打印日志
-                yield combined_result
+    for generate_result in generate_image_urls(prompt, samples=1, force_new_seed=force_new_seed):
+        # 把图片存储到protagonist_image表
+        with app.app_context():
+            image_id = add_protagonist_image(
+                image_url=generate_result,
+                image_description=description,
+                protagonist_id = protagonist_id,
+                user_id=user_id
+            )
+
+
+        # 合并 generate_result 和 image_details 到一个字典中并返回
+        combined_result = {
+            "generated_image_url": generate_result,
+            "image_id": image_id
+        }
+        # print(f"Image generated, URL: {generate_result}")  # 打印日志
+        yield combined_result
 
     # print("Done")  # 打印日志
     yield "done"
@@ -0,0 +1,126 @@
+import atexit
+import os
+import threading
+from collections import deque
+from datetime import datetime
+from dotenv import load_dotenv
+from app_instance import app
+from generate import llm_client
+from controllers.transaction_controller import add_transactions, TRANSACTION_TYPE_TEXT
+from tools import metrics
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 大模型用量记录：先写入内存环形缓冲区，由后台线程定时或攒够数量后批量写入 Transaction 表
+# 缓冲区容量（写库跟不上时丢弃最早的记录）、批量写入的条数阈值、定时写入的间隔（秒）
+USAGE_BUFFER_SIZE = int(os.environ.get('USAGE_BUFFER_SIZE') or 10000)
+USAGE_FLUSH_SIZE = int(os.environ.get('USAGE_FLUSH_SIZE') or 100)
+USAGE_FLUSH_INTERVAL = float(os.environ.get('USAGE_FLUSH_INTERVAL') or 10)
+# 每千 token 的价格，用于计算 amount
+LLM_PRICE_PER_1K_TOKENS = float(os.environ.get('LLM_PRICE_PER_1K_TOKENS') or 0)
+
+_buffer = deque(maxlen=USAGE_BUFFER_SIZE)
+_flush_event = threading.Event()
+_flush_lock = threading.Lock()
+_flusher = None
+_start_lock = threading.Lock()
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def record_usage(meta: dict, usage: dict):
+    """
+    记录一次大模型调用，只写内存不访问数据库。作为 llm_client 的 usage_listener 使用。
+
+    参数:
+    - meta: finish 事件的信息，包含 usage、latency、model
+    - usage: 调用方传入的归属信息 {user_id, game_id}
+    """
+    tokens = meta.get('usage') or {}
+    # 智谱、OpenAI 使用 prompt/completion，通义千问使用 input/output
+    prompt_tokens = _to_int(tokens.get('prompt_tokens', tokens.get('input_tokens')))
+    completion_tokens = _to_int(tokens.get('completion_tokens', tokens.get('output_tokens')))
+    total_tokens = _to_int(tokens.get('total_tokens'))
+    if total_tokens is None and (prompt_tokens is not None or completion_tokens is not None):
+        total_tokens = (prompt_tokens or 0) + (completion_tokens or 0)
+
+    if len(_buffer) == _buffer.maxlen:
+        metrics.incr('usage_ledger.dropped')
+    _buffer.append({
+        'user_id': usage.get('user_id'),
+        'game_id': usage.get('game_id'),
+        'transaction_type': TRANSACTION_TYPE_TEXT,
+        'amount': (total_tokens or 0) / 1000 * LLM_PRICE_PER_1K_TOKENS,
+        'model': meta.get('model'),
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': total_tokens,
+        'latency': meta.get('latency'),
+        'created_at': datetime.utcnow(),
+        'updated_at': datetime.utcnow(),
+        'valid': True,
+    })
+    metrics.incr('usage_ledger.recorded')
+
+    _ensure_flusher()
+    if len(_buffer) >= USAGE_FLUSH_SIZE:
+        _flush_event.set()
+
+
+def flush_usage() -> int:
+    """
+    把缓冲区中的记录批量写入数据库，返回写入的条数。写入失败时记录放回缓冲区，下次再写，
+    缓冲区放不下的部分丢弃并计入 usage_ledger.dropped。
+    """
+    with _flush_lock:
+        records = []
+        while _buffer:
+            records.append(_buffer.popleft())
+        if not records:
+            return 0
+
+        try:
+            with app.app_context():
+                add_transactions(records)
+        except Exception as e:
+            print('Usage ledger flush failed:', e)
+            metrics.incr('usage_ledger.flush_error')
+            # 放回缓冲区前面，下次再写；缓冲区放不下时与 record_usage 一样丢弃最早的记录并计数
+            room = _buffer.maxlen - len(_buffer)
+            dropped = max(len(records) - room, 0)
+            if dropped:
+                print(f'Usage ledger buffer full, dropped {dropped} records')
+                metrics.incr('usage_ledger.dropped', dropped)
+            _buffer.extendleft(reversed(records[dropped:]))
+            return 0
+
+        metrics.incr('usage_ledger.flushed', len(records))
+        return len(records)
+
+
+def _flush_loop():
+    while True:
+        _flush_event.wait(USAGE_FLUSH_INTERVAL)
+        _flush_event.clear()
+        flush_usage()
+
+
+def _ensure_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _start_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name='usage-ledger', daemon=True)
+            _flusher.start()
+
+
+# 进程退出前写入剩余的记录
+atexit.register(flush_usage)
+
+llm_client.usage_listeners.append(record_usage)
@@ -1,10 +1,13 @@
 # main.py
 import json
+import hashlib
+import time
+import tempfile
 from flask import Flask, render_template, request, stream_with_context, Response, jsonify
 import requests
 from dotenv import load_dotenv
 from generate.text_to_image import generate_and_stream, generate_and_stream_plot_image, generate_and_save_plot_image, \
-    test_generate_and_stream
+    test_generate_and_stream, generate_image_urls
 from generate.completions import get_lan_response
 from database.models import db
 import os
@@ -14,17 +17,28 @@ from controllers.protagonist_controller import get_preset_role, generate_role_im
 from controllers.story_plot_controller import get_random_story_plot
 from controllers.description_controller import get_description
 from controllers.album_controller import get_album, edit_album
-from controllers.game_controller import get_game, reset_game_plot, add_game, save_game_data, save_game_first_time, edit_game
-from controllers.image_controller import add_plot_image, get_image, edit_image
+from controllers.game_controller import get_game, reset_game_plot, add_game, save_game_data, save_game_first_time, \
+    get_game_prompt, add_game_round
+from controllers.image_controller import add_plot_image, get_image, edit_image, add_plot_image_candidates, \
+    take_plot_image_candidate
+from controllers.transaction_controller import get_user_llm_usage, get_game_llm_usage
 from controllers.theme_controller import get_theme_list, add_theme, get_theme
 from controllers.pro_and_alb_controller import create_pro_and_alb
 from generate.qinghua_completions import submit_plot_choice, get_random_plot, create_img_prompt, \
-    create_plot, init_game_data, test_fake_init
+    create_plot, init_game_data, test_fake_init, stream_plot_content, stream_next_round, get_game_rules_template_id, \
+    prefetch_next_rounds, discard_prefetched_rounds, get_game_start_prompt, stream_opening_round, game_usage
 from flask_jwt_extended import JWTManager, create_access_token
 from app_instance import app
-import zhipuai
-import re
-from service.baidu_orc import get_orc_content
+from generate import llm_client
+from generate.article_evaluate import stream_article_evaluation, evaluate_articles, ARTICLE_BATCH_MAX
+from generate.round_parser import parse_round_or_reask, dump_round, RoundParseError
+from generate import usage_ledger  # 注册大模型用量记录，批量写入消费表
+from tools import metrics
+from tools.single_flight import SingleFlight, content_key
+from tools import sse
+from generate import image_jobs
+from tools.image_variants import pick_variant
+from service.baidu_orc import get_orc_content, get_orc_text, image_to_base64
 
 load_dotenv()  # 加载 .env 文件中的变量
 CORS(app)
@@ -39,6 +53,15 @@ DATABASE_URI = f"mysql+pymysql://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABA
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
+# 生成剧情图片的请求合并：只合并进行中的相同请求，完成后再次请求会重新生成
+plot_image_flight = SingleFlight('plot_image', ttl=0)
+# 换一张时一次生成的候选图片数量，用完后再生成下一批
+REFRESH_IMAGE_SAMPLES = int(os.environ.get('REFRESH_IMAGE_SAMPLES') or 3)
+
+# OCR 图片上传：最大字节数，以及超过多少字节时写入磁盘临时文件而不是保存在内存中
+OCR_UPLOAD_MAX_BYTES = int(os.environ.get('OCR_UPLOAD_MAX_BYTES') or 20 * 1024 * 1024)
+OCR_UPLOAD_SPOOL_BYTES = int(os.environ.get('OCR_UPLOAD_SPOOL_BYTES') or 1024 * 1024)
+
 db.init_app(app)
 
 # JWT 配置
@@ -69,7 +92,7 @@ def get_story_plot():
     # print(chapter)
     theme_id = int(request.args.get('theme_id'))
     plot = get_random_story_plot(chapter, theme_id)
-    return jsonify(plot)
+    return jsonify([apply_size_hint(item) for item in plot])
 
 
 @app.route('/getPlotImage', methods=['POST'])
@@ -102,10 +125,17 @@ def change_plot_image():
     description = request.args.get('description')
     album_id = request.args.get('album_id', type=int)
     user_id = request.args.get('user_id', type=int)
-    result = generate_and_save_plot_image(description, album_id, user_id)
+    if is_async_request():
+        return submit_image_job('change_image', {'description': description, 'album_id': album_id, 'user_id': user_id},
+                                priority=image_jobs.PRIORITY_REFRESH, user_id=user_id)
+    return jsonify(apply_size_hint(_change_plot_image(description, album_id, user_id), 'generated_image_url'))
+
+
+def _change_plot_image(description, album_id, user_id):
+    # 换一张：使用新的 seed 重新生成，不使用缓存的图片
+    result = generate_and_save_plot_image(description, album_id, user_id, force_new_seed=True)
     next(result)
-    image_url = next(result)
-    return jsonify(image_url)
+    return next(result)
 
 
 @app.route('/saveAlbum', methods=['GET'])
@@ -123,7 +153,8 @@ def get_preset_role_route():
     preset_str = request.args.get('preset', default="false")
     preset = preset_str.lower() != "false"  # 如果 preset_str 不是 "false"，则 preset 为 True
     user_id = request.args.get('user_id', type=int)  # 获取 user_id 参数
-    return get_preset_role(user_id=user_id, preset=preset)
+    result = get_preset_role(user_id=user_id, preset=preset)
+    return apply_size_hint(result, 'image') if isinstance(result, dict) else result
 
 
 # 创建角色（Protagonist）和绘本（Album）并返回相关数据。
@@ -184,6 +215,18 @@ def create_plot_image():
     content = request.args.get('content')
     game_id = int(request.args.get('game_id'))
     user_id = int(request.args.get('user_id'))
+
+    # 同时到达的相同请求（重试、连点）只生成一次图片，共享同一条图片记录
+    key = content_key('createPlotImage', game_id, user_id, content)
+    if is_async_request():
+        return submit_image_job('create_plot_image', {'content': content, 'game_id': game_id, 'user_id': user_id},
+                                priority=image_jobs.PRIORITY_INTERACTIVE, user_id=user_id, dedupe_key=key)
+    result = plot_image_flight.do(key, _create_plot_image, content, game_id, user_id)
+    if result:
+        return jsonify(apply_size_hint(result))
+
+
+def _create_plot_image(content, game_id, user_id):
     prompt = create_img_prompt(content)
 
     if prompt:
@@ -195,28 +238,103 @@ def create_plot_image():
         result = add_plot_image(image_url=generated_image_url, plot_description=json.loads(content)['content'],
                                 game_id=game_id, user_id=user_id, image_description=prompt)
         # print(result)
-        return jsonify(result)
+        return result
 
 
 @app.route('/refreshPlotImage', methods=['GET'])
 def refresh_plot_image():
     content = request.args.get('content')
     image_id = int(request.args.get('image_id'))
-    prompt = create_img_prompt(content)
 
+    key = content_key('refreshPlotImage', image_id, content)
+    if is_async_request():
+        return submit_image_job('refresh_plot_image', {'content': content, 'image_id': image_id},
+                                priority=image_jobs.PRIORITY_REFRESH, dedupe_key=key)
+    result = plot_image_flight.do(key, _refresh_plot_image, content, image_id)
+    if result:
+        return jsonify(apply_size_hint(result))
+
+
+def _refresh_plot_image(content, image_id):
     # 获取图像内容
     image = get_image(image_id=image_id)
 
+    # 优先取用上次一起生成的候选图片，不需要等待生成
+    candidate = take_plot_image_candidate(image['game_id'], image['plot_description'])
+    if candidate:
+        metrics.incr('plot_image_candidate.hit')
+        return candidate
+
+    prompt = create_img_prompt(content)
+
     if prompt:
-        generator = generate_and_stream_plot_image(prompt)
-        next(generator)
-        generated_image_url = next(generator)
+        # 候选图片用完时，一次调用生成一批（换一张：使用新的 seed，不使用缓存的图片）
+        metrics.incr('plot_image_candidate.miss')
+        image_urls = list(generate_image_urls(prompt, samples=REFRESH_IMAGE_SAMPLES, force_new_seed=True))
+        if not image_urls:
+            return None
 
         # 保存图片数据
-        result = add_plot_image(image_url=generated_image_url, plot_description=image['plot_description'],
-                                game_id=image['game_id'], user_id=image['user_id'], image_description=prompt)
-        # print(result)
-        return jsonify(result)
+        add_plot_image_candidates(image_urls, plot_description=image['plot_description'], game_id=image['game_id'],
+                                  user_id=image['user_id'], image_description=prompt)
+        return take_plot_image_candidate(image['game_id'], image['plot_description'])
+
+
+# 图片生成任务：接口带上 async=true 时不等待生成完成，立即返回任务，之后通过 getImageJob 查询结果
+image_jobs.handlers.update({
+    'create_plot_image': _create_plot_image,
+    'refresh_plot_image': _refresh_plot_image,
+    'change_image': _change_plot_image,
+})
+
+
+@app.before_request
+def start_image_jobs():
+    # 在处理第一个请求时启动任务线程，并恢复重启前未完成的任务
+    image_jobs.start()
+
+
+def apply_size_hint(result, key='image_url'):
+    """
+    请求带有 size（需要的图片宽度，像素）时，把结果中的图片地址换成合适尺寸的 WebP/JPEG 图片，
+    原图地址保存在 original_<key> 中；可以用 format 参数指定 webp 或 jpeg。
+    """
+    size = request.args.get('size', type=int)
+    if not size or not isinstance(result, dict) or not result.get(key):
+        return result
+
+    variant = pick_variant(result[key], size, request.args.get('format'))
+    if variant['url'] == result[key]:
+        return result
+    result = dict(result)
+    result['original_' + key] = result[key]
+    result[key] = variant['url']
+    return result
+
+
+def is_async_request():
+    return request.args.get('async', 'false').lower() == 'true'
+
+
+def submit_image_job(job_type, params, priority, user_id=None, dedupe_key=None):
+    try:
+        job = image_jobs.submit(job_type, params, priority=priority, user_id=user_id, dedupe_key=dedupe_key)
+    except image_jobs.JobQueueFull:
+        return jsonify({'status': 'error', 'message': '图片生成任务过多，请稍后重试'}), 503
+    return jsonify(job), 202
+
+
+# 查询图片生成任务，wait 大于 0 时任务未结束会等待最多 wait 秒（长轮询）
+@app.route('/getImageJob', methods=['GET'])
+def get_image_job_route():
+    job_id = request.args.get('job_id', type=int)
+    wait = request.args.get('wait', default=0, type=float)
+    job = image_jobs.wait(job_id, wait)
+    if job is None:
+        return jsonify({'status': 'error', 'message': '任务不存在'}), 404
+    if isinstance(job['result'], dict):
+        job['result'] = apply_size_hint(apply_size_hint(job['result']), 'generated_image_url')
+    return jsonify(job)
 
 
 @app.route('/confirmChosenImage', methods=['GET'])
@@ -224,7 +342,7 @@ def confirm_chosen_image():
     image_id = int(request.args.get('image_id'))
     # 修改图像为已选择
     image = edit_image(image_id=image_id)
-    return jsonify(image)
+    return jsonify(apply_size_hint(image))
 
 
 @app.route('/createChoice', methods=['GET'])
@@ -239,6 +357,7 @@ def create_plot_content():
 def reset_game():
     game_id = int(request.args.get('game_id'))
     result = reset_game_plot(game_id)
+    discard_prefetched_rounds(game_id)
     # print(result)
     return jsonify(result)
 
@@ -340,10 +459,13 @@ def init_game_start_data():
     # 获取故事主题信息
     theme = get_theme(theme_id=theme_id)
     # 调用大模型，初始化故事的内容
-    init_story_result = init_game_data(theme=json.dumps(theme), protagonist=json.dumps(protagonist))
+    init_story_result = init_game_data(theme=json.dumps(theme), protagonist=json.dumps(protagonist), user_id=user_id)
     print(init_story_result)
     # 保存数据内容到数据库
-    result = save_game_data(user_id=user_id, theme=json.dumps(theme), protagonist=json.dumps(protagonist), game_data=json.dumps(init_story_result))
+    result = save_game_data(user_id=user_id, theme=json.dumps(theme), protagonist=json.dumps(protagonist),
+                            game_data=json.dumps(init_story_result), template_id=get_game_rules_template_id())
+    # 后台预生成下一回合
+    prefetch_next_rounds(get_game(result))
     return {'new_game_id': result, 'protagonist_id': protagonist_id}
 
 
@@ -355,6 +477,26 @@ def get_theme_data():
     return jsonify(result)
 
 
+# 用户的大模型用量汇总
+@app.route('/getUserUsage', methods=['GET'])
+def get_user_usage():
+    user_id = int(request.args.get('user_id'))
+    return jsonify(get_user_llm_usage(user_id))
+
+
+# 单局游戏的大模型用量汇总
+@app.route('/getGameUsage', methods=['GET'])
+def get_game_usage():
+    game_id = int(request.args.get('game_id'))
+    return jsonify(get_game_llm_usage(game_id))
+
+
+# 查看运行计数（缓存命中率等）
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return jsonify(metrics.snapshot())
+
+
 @app.route('/testFakeInit', methods=['GET'])
 def test_invoke():
     result = test_fake_init()
@@ -368,7 +510,7 @@ def test_stream_response():
             "role": "user",
             "content": "你好"
         }]
-        response = zhipuai.model_api.sse_invoke(
+        response = llm_client.sse_invoke(
             model="chatglm_pro",
             prompt=prompt,
             temperature=0.7,
@@ -387,12 +529,48 @@ def test_stream_response():
     return Response(stream_with_context(generate()), content_type='text/event-stream')
 
 
+def game_state(game):
+    """
+    故事当前进度的标识（已有回合的对话记录），作为回合 key 的一部分；故事不存在时返回 None。
+    """
+    return game['prompt_history'] if game else None
+
+
+def story_stream_response(generate, key=None, persist=True, content_type='application/json'):
+    """
+    故事生成的流式响应。生成作为独立的回合在回合执行线程中进行，客户端断开不影响生成和保存，输出写入回合的重放缓冲区：
+    - 请求头 Accept 包含 text/event-stream 时按 SSE 格式输出，事件 id 为 <turn_id>:<seq>
+    - 断线后带上 Last-Event-ID（请求头或 lastEventId 参数）重新请求，从缓冲区继续输出，不会再次调用大模型
+    - 其他请求保持原来的格式，直接拼接输出 generate 产出的字符串，content_type 为响应类型
+    - key 相同的重复提交（连点、重试）复用同一个回合；persist 为 False 的回合在没有连接时取消
+    """
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('lastEventId')
+    if last_event_id:
+        turn_id, seq = sse.parse_event_id(last_event_id)
+        turn = sse.get_turn(turn_id) if turn_id else None
+        if turn is None:
+            # 回合已过期：不再重新生成，客户端通过 getGameData 获取最新的游戏数据
+            expired = sse.format_event(json.dumps({'status': 'error', 'message': 'turn expired'}), event='error')
+            return Response(expired, content_type='text/event-stream')
+        return Response(sse.iter_sse(turn, seq), content_type='text/event-stream')
+
+    def produce():
+        with app.app_context():
+            yield from generate()
+
+    turn = sse.start_turn(produce, key=key, persist=persist)
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(sse.iter_sse(turn), content_type='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    return Response(sse.iter_raw(turn), content_type=content_type)
+
+
 @app.route('/generatePlot', methods=['POST'])
 def generate_game_data():
-    def generate():
-        # 解析请求体中的 JSON 数据
-        data = request.get_json()
+    # 解析请求体中的 JSON 数据
+    data = request.get_json()
 
+    def generate():
         # 提取前端传来的参数
         theme_id = int(data.get('theme_id'))
         user_id = int(data.get('user_id'))
@@ -408,66 +586,20 @@ def generate_game_data():
         # init_game_data(theme=json.dumps(theme), protagonist=json.dumps(protagonist))
 
         # 构建与大模型交互的prompt
-        re_start_str = f"游戏主题：{theme['description']}，游戏主角：{protagonist['name'] + '，' + protagonist['description']}"
-        prompt = [
-            {"role": "user",
-             "content": "我希望你扮演一个基于文本的冒险游戏，游戏主题：（稍后提供），游戏主角：（稍后提供）。如果你明白了就回复“收到”，之后我会给你介绍这个游戏的规则。"},
-            {"role": "assistant",
-             "content": " 收到，我已经明白了。请告诉我这个游戏的规则。"},
-            {"role": "user",
-             "content": "游戏总共 8 回合，每一个回合你都需要生成故事内容和a、b、c三个选项。如果你明白了就回复“收到”，之后我会给你介绍每个回合生成内容的规则。"},
-            {"role": "assistant",
-             "content": "收到，我已经明白了。请告诉我每个回合生成内容的规则。"},
-            {"role": "user",
-             "content": "每个回合都包含以下的字段，分别是：回合数，章节名，故事内容，故事选项。如果你明白了就回复“收到”，之后我会给你介绍每个字段的规则。"},
-            {"role": "assistant",
-             "content": "收到，我已经明白了。请告诉我每个字段的规则。"},
-            {"role": "user",
-             "content": "1、回合数：记录当前回合数，整数类型，从0开始增加，到8终止；2、章节名：记录当前章节名字，枚举类型，分别是：故事的开端，情节推进，矛盾产生，关键决策，情节发展，高潮冲突，结局逼近，最终结局，章节名分别与回合数一一对应，回合1对应故事的开端，回合2对应情节推进，回合3对应矛盾产生，回合4对应关键决策，回合5对应情节发展，回合6对应高潮冲突，回合7对应结局逼近，回合8对应最终结局；3、故事内容：根据当前章节名的剧情提示，生成与上一个回合内容及选项相关的故事内容；4、故事选项：根据当前故事内容，生成3个相关的会影响故事发展的选项；如果你明白了就回复“收到”，之后我会给你介绍这个游戏的玩法。"},
-            {"role": "assistant",
-             "content": "收到，我已经明白了。请告诉我这个游戏的玩法。"},
-            {"role": "user",
-             "content": "1、你需要根据我提供的游戏主题和游戏主角，先生成第一回合的所有内容给我；2、如果我回复游戏选项里的其中一个，你需要根据我回复的选项，生成下一个回合的所有内容给我；3、如果我回复“自定义”，你需要根据我回复的自定义内容，生成下一个回合的所有内容给我；4、如果我回复“换一换”，你需要重新生成当前回合的所有内容给我；如果你明白了就回复“收到”，之后我会给你介绍这个游戏的限制。"},
-            {"role": "assistant",
-             "content": "收到，我已经明白了。请告诉我这个游戏的限制。"},
-            {"role": "user",
-             "content": "1、每个回合的故事内容必须控制在 80 字以内，游戏在第8回合结束；2、你给我生成的故事内容和故事选项需要是有趣搞怪一点的，前后逻辑有联系的，不要太拘泥于常规的内容，虚幻，古代，现实的题材都可以；3、每个回合的情节结构必须和章节名对应，8个回合8个情节循序渐进，缺一不可；如果你明白了就回复“收到”，之后我会给你介绍你回复的格式要求。"},
-            {"role": "assistant",
-             "content": "收到，我已经明白了。请告诉我回复的格式要求。"},
-            {"role": "user",
-             "content": "回复的格式必须要json格式，key的对应关系如下：round对应回合数，chapter对应章节名，content对应故事内容，choice对应故事选项；参考示例：{\"round\":\"xxx\",\"chapter\":\"xxx\",\"content\":\"xxx\",\"choice\":[\"a.xxx\",\"b.xxx\",\"c.xxx\"]}；如果你明白了就回复“收到”，之后我就会给你发送游戏主题和游戏主角，然后游戏开始。"},
-            {"role": "assistant",
-             "content": "收到，我已经明白了。请发送游戏主题和游戏主角，我将开始游戏。"},
-            {"role": "user",
-             "content": re_start_str}]
-
-        # 调用大模型接口实现内容生成
-        response = zhipuai.model_api.sse_invoke(
-            model="chatglm_pro",
-            prompt=prompt,
-            temperature=0.9,
-            top_p=0.7,
-            incremental=True
-        )
-
-        # 定义变量记录生成过程的中间内容
-        full_text = ""
-
-        # 循环获取大模型生成的内容
-        for event in response.events():
-            if event.event == "add":
-                full_text += event.data
-                # 先把故事内容返回到前端使用
-                if '"content": "' in full_text:
-                    start_index = full_text.index('"content": "') + len('"content": "')
-                    recorded_content = full_text[start_index:]
-                    if '"' not in recorded_content:
-                        yield json.dumps({'status': 'generate', 'content': recorded_content})
-            elif event.event == "finish":
+        template_id = get_game_rules_template_id()
+        prompt = get_game_start_prompt(theme, protagonist, template_id)
+
+        # 调用大模型接口实现内容生成（预设组合优先使用开局池），循环获取大模型生成的内容
+        content = ''
+        for status, full_text in stream_opening_round(theme, protagonist, template_id, prompt, user_id=user_id):
+            if status == "generate":
+                # 先把故事内容返回到前端使用（产出的是新增部分，前端收到的仍是完整内容）
+                content += full_text
+                yield json.dumps({'status': 'generate', 'content': content})
+            elif status == "finish":
                 try:
-                    # 生成完毕后处理一下字符串转化成json格式
-                    json_match = re.search(r'\{.*?\}', full_text, re.DOTALL)
-                    json_content = json_match.group(0)
+                    # 生成完毕后处理一下字符串转化成json格式（格式有问题时先本地修复）
+                    json_content = dump_round(parse_round_or_reask(full_text, prompt, usage={'user_id': user_id}))
                     # 组装新的prompt history
                     prompt_history = {
                         'role': 'assistant',
@@ -477,7 +609,11 @@ def generate_game_data():
 
                     # 执行数据库操作
                     result = save_game_first_time(user_id=user_id, theme=json.dumps(theme),
-                                                  protagonist=json.dumps(protagonist), game_data=json.dumps(prompt))
+                                                  protagonist=json.dumps(protagonist), game_data=json.dumps(prompt),
+                                                  template_id=template_id)
+
+                    # 后台预生成下一回合
+                    prefetch_next_rounds(result)
 
                     # 构造要返回的字符串
                     response_str = json.dumps({'status': 'finish', 'game': result})
@@ -486,136 +622,105 @@ def generate_game_data():
                 except Exception as e:
                     print("数据库操作失败:", e)
                     yield json.dumps({'status': 'error', 'message': str(e)})
-            elif event.event == "error" or event.event == "interrupted":
+            elif status == "error":
                 yield "error"
             else:
                 yield "unknown"
-    return Response(stream_with_context(generate()), content_type='application/json')
+    return story_stream_response(generate, key=content_key('generatePlot', data))
 
 
 @app.route('/submitAnswerStream', methods=['POST'])
 def submit_answer_stream():
-    def generate():
-        # 解析请求体中的 JSON 数据
-        data = request.get_json()
+    # 解析请求体中的 JSON 数据
+    data = request.get_json()
+    # 提取前端传来的参数
+    choice = data.get('choice')
+    game_id = data.get('id')
+    # 获取故事信息
+    game = get_game(id=game_id)
 
-        # 提取前端传来的参数
-        choice = data.get('choice')
-        game_id = data.get('id')
-
-        # 获取故事信息
-        game = get_game(id=game_id)
-        content = json.loads(game['content'])
-        prompt = json.loads(game['prompt_history'])
+    def generate():
+        prompt = get_game_prompt(game)
         new_entry = {
             'role': 'user',
             'content': choice
         }
         prompt.append(new_entry)
 
-        response = zhipuai.model_api.sse_invoke(
-            model="chatglm_pro",
-            prompt=prompt,
-            temperature=0.9,
-            top_p=0.7,
-            incremental=True
-        )
-        full_text = ""
-
         # 循环获取大模型生成的内容
-        for event in response.events():
-            if event.event == "add":
-                full_text += event.data
-                # 先把故事内容返回到前端使用
-                if '"content": "' in full_text:
-                    start_index = full_text.index('"content": "') + len('"content": "')
-                    recorded_content = full_text[start_index:]
-                    if '"' not in recorded_content:
-                        yield json.dumps({'status': 'generate', 'content': recorded_content})
-            elif event.event == "finish":
-                # 生成完毕后处理一下字符串转化成json格式
-                json_match = re.search(r'\{.*?\}', full_text, re.DOTALL)
-                json_content = json_match.group(0)
-                # 组装新的prompt history
-                prompt_history = {
-                    'role': 'assistant',
-                    'content': json_content
-                }
-                prompt.append(prompt_history)
-                content.append(json.loads(json_content))
-
-                # 保存新的数据内容到故事数据库
-                result = edit_game(id=game_id, prompt_history=json.dumps(prompt, ensure_ascii=False),
-                                   content=json.dumps(content, ensure_ascii=False))
+        content = ''
+        for status, full_text in stream_next_round(game, prompt, choice):
+            if status == "generate":
+                # 先把故事内容返回到前端使用（产出的是新增部分，前端收到的仍是完整内容）
+                content += full_text
+                yield json.dumps({'status': 'generate', 'content': content})
+            elif status == "finish":
+                # 生成完毕后处理一下字符串转化成json格式（格式有问题时先本地修复）
+                try:
+                    round_data = parse_round_or_reask(full_text, prompt, usage=game_usage(game))
+                except RoundParseError as e:
+                    yield json.dumps({'status': 'error', 'message': str(e)})
+                    return
+
+                # 保存新的回合到故事数据库
+                result = add_game_round(game_id=game_id, round_data=round_data, user_input=new_entry['content'])
+                # 后台预生成下一回合
+                prefetch_next_rounds(result)
                 # 构造要返回的字符串
                 response_str = json.dumps({'status': 'finish', 'game': result})
                 yield response_str
-            elif event.event == "error" or event.event == "interrupted":
+            elif status == "error":
                 yield "error"
             else:
                 yield "unknown"
-    return Response(stream_with_context(generate()), content_type='application/json')
+    # 相同的选择只在故事进度相同时合并，进入下一回合后再选同样的文字会重新生成
+    return story_stream_response(generate, key=content_key('submitAnswerStream', data, game_state(game)))
 
 
 @app.route('/createChoiceStream', methods=['POST'])
 def create_plot_content_stream():
+    # 解析请求体中的 JSON 数据
+    data = request.get_json()
+    # 提取前端传来的参数
+    choice = data.get('choice')
+    game_id = data.get('game_id')
+    game = get_game(id=game_id)
+
     def generate():
-        # 解析请求体中的 JSON 数据
-        data = request.get_json()
-        # 提取前端传来的参数
-        choice = data.get('choice')
-        game_id = data.get('game_id')
-        game = get_game(id=game_id)
-        content = json.loads(game['content'])
-        prompt = json.loads(game['prompt_history'])
+        prompt = get_game_prompt(game)
         new_entry = {
             'role': 'user',
             'content': f'自定义：{choice}'
         }
         prompt.append(new_entry)
-        response = zhipuai.model_api.sse_invoke(
-            model="chatglm_pro",
-            prompt=prompt,
-            temperature=0.9,
-            top_p=0.7,
-            incremental=True
-        )
-        full_text = ""
-
         # 循环获取大模型生成的内容
-        for event in response.events():
-            if event.event == "add":
-                full_text += event.data
-                # 先把故事内容返回到前端使用
-                if '"content": "' in full_text:
-                    start_index = full_text.index('"content": "') + len('"content": "')
-                    recorded_content = full_text[start_index:]
-                    if '"' not in recorded_content:
-                        yield json.dumps({'status': 'generate', 'content': recorded_content})
-            elif event.event == "finish":
-                # 生成完毕后处理一下字符串转化成json格式
-                json_match = re.search(r'\{.*?\}', full_text, re.DOTALL)
-                json_content = json_match.group(0)
-                # 组装新的prompt history
-                prompt_history = {
-                    'role': 'assistant',
-                    'content': json_content
-                }
-                prompt.append(prompt_history)
-                content.append(json.loads(json_content))
-
-                # 保存新的数据内容到故事数据库
-                result = edit_game(id=game_id, prompt_history=json.dumps(prompt, ensure_ascii=False),
-                                   content=json.dumps(content, ensure_ascii=False))
+        content = ''
+        for status, full_text in stream_plot_content(prompt, usage=game_usage(game)):
+            if status == "generate":
+                # 先把故事内容返回到前端使用（产出的是新增部分，前端收到的仍是完整内容）
+                content += full_text
+                yield json.dumps({'status': 'generate', 'content': content})
+            elif status == "finish":
+                # 生成完毕后处理一下字符串转化成json格式（格式有问题时先本地修复）
+                try:
+                    round_data = parse_round_or_reask(full_text, prompt, usage=game_usage(game))
+                except RoundParseError as e:
+                    yield json.dumps({'status': 'error', 'message': str(e)})
+                    return
+
+                # 保存新的回合到故事数据库
+                result = add_game_round(game_id=game_id, round_data=round_data, user_input=new_entry['content'])
+                # 后台预生成下一回合
+                prefetch_next_rounds(result)
                 # 构造要返回的字符串
                 response_str = json.dumps({'status': 'finish', 'game': result})
                 yield response_str
-            elif event.event == "error" or event.event == "interrupted":
+            elif status == "error":
                 yield "error"
             else:
                 yield "unknown"
 
-    return Response(stream_with_context(generate()), content_type='application/json')
+    return story_stream_response(generate, key=content_key('createChoiceStream', data, game_state(game)))
 
 
 @app.route('/testBaiduOcr', methods=['POST'])
@@ -626,59 +731,184 @@ def test_ali_ocr():
     return jsonify(result)
 
 
+class UploadTooLarge(Exception):
+    pass
+
+
+def read_upload_image():
+    """
+    读取上传的图片：multipart 的 image 字段，或请求体直接是图片（Content-Type 为 image/* 或 application/octet-stream）。
+    请求体分块写入临时文件，超过 OCR_UPLOAD_SPOOL_BYTES 时落盘，不在内存中保存完整的原图。
+    :return: 文件对象，没有上传图片时返回 None；超过 OCR_UPLOAD_MAX_BYTES 时抛出 UploadTooLarge
+    """
+    if request.content_length and request.content_length > OCR_UPLOAD_MAX_BYTES:
+        raise UploadTooLarge()
+    if 'image' in request.files:
+        # werkzeug 解析 multipart 时已经把较大的文件写入临时文件
+        return request.files['image'].stream
+    if not (request.mimetype.startswith('image/') or request.mimetype == 'application/octet-stream'):
+        return None
+
+    spooled = tempfile.SpooledTemporaryFile(max_size=OCR_UPLOAD_SPOOL_BYTES)
+    # 没有 Content-Length（分块上传）时边读边检查大小
+    while True:
+        chunk = request.stream.read(64 * 1024)
+        if not chunk:
+            break
+        spooled.write(chunk)
+        if spooled.tell() > OCR_UPLOAD_MAX_BYTES:
+            spooled.close()
+            raise UploadTooLarge()
+    if spooled.tell() == 0:
+        spooled.close()
+        return None
+    spooled.seek(0)
+    return spooled
+
+
+# 上传图片识别文字：图片以二进制上传（multipart 或直接作为请求体），缩小压缩后只编码一次再调用 OCR
+@app.route('/ocrImage', methods=['POST'])
+def ocr_image():
+    try:
+        image = read_upload_image()
+    except UploadTooLarge:
+        return jsonify({'status': 'error', 'message': '图片太大'}), 413
+    if image is None:
+        return jsonify({'status': 'error', 'message': '缺少图片'}), 400
+
+    try:
+        image_base64 = image_to_base64(image)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'图片格式错误: {e}'}), 400
+    finally:
+        image.close()
+
+    try:
+        content, lines = get_orc_text(image_base64)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 502
+    return jsonify({'status': 'success', 'content': content, 'lines': lines})
+
+
 @app.route('/testArticleEvaluate', methods=['POST'])
 def test_article_evaluate():
-    def generate():
-        # 解析请求体中的 JSON 数据
-        data = request.get_json()
+    # 解析请求体中的 JSON 数据
+    data = request.get_json()
 
+    # 默认只返回新增的内容（delta），snapshot 为 true 时兼容旧格式，每次返回完整内容
+    snapshot = str(data.get('snapshot', request.args.get('snapshot', 'false'))).lower() == 'true'
+
+    def generate():
         # 提取前端传来的参数
         article = data.get('article')
 
-        # 构建与大模型交互的prompt
-        prompt = [
-            {"role": "user",
-             "content": "中国小学各年级作文要求如下，请你牢记。"
-                        "一年级：主要是让学生学会运用简单的词语和句子表达自己的思想和感受，培养写作的兴趣。一般要求写句子、短文，内容可以是自己身边的事物、人物，也可以是想象中的事物。"
-                        "二年级：在一年级的基础上，二年级的作文要求学生能够运用更加丰富的词汇和句式进行表达，能写简单的记叙文和说明文。内容可以包括生活琐事、人物、景物等。"
-                        "三年级：三年级的学生需要在掌握基本语法和句式的基础上，学会进行合理的分段和连段成篇。能够写一些简单的记叙文、说明文和应用文，如书信、日记等。"
-                        "四年级：开始学习写作的篇章结构，如开头、结尾的写法，学会使用恰当的过渡语。在内容上，可以尝试写一些观察日记、读书笔记、游记等。"
-                        "五年级：要求学生能够独立构思和写作，能写一些复杂的记叙文、说明文和应用文。此外，还需要学会对文章进行修改和润色。"
-                        "六年级：六年级的作文要求学生能够熟练掌握各种文体的写作方法，如议论文、散文等。此外，还需要提高自己的审美和批判能力，学会对自己和他人的文章进行评价。"},
-            {"role": "assistant",
-             "content": "收到，我已经记住了。请告诉我接下来需要我提供什么帮助。"},
-            {"role": "user",
-             "content": "接下来我会向你提供一篇小学作文，你需要给这篇作为进行评分，给出ABCD四种评分，并说明为什么。然后结合小学作文要求，给这篇作文提供评价及改进方向。你的改进方向需要具体一点"},
-            {"role": "assistant",
-             "content": "收到，我已经明白了，请你把文章发给我。"},
-            {"role": "user",
-             "content": article}]
-
-        # 调用大模型接口实现内容生成
-        response = zhipuai.model_api.sse_invoke(
-            model="chatglm_pro",
-            prompt=prompt,
-            temperature=0.9,
-            top_p=0.7,
-            incremental=True
-        )
+        # 调用大模型接口实现内容生成，相同的作文直接返回缓存的评价
+        seq = 0
+        full_text = ''
+        for status, text in stream_article_evaluation(article):
+            if status == "generate":
+                if snapshot:
+                    full_text += text
+                    yield json.dumps({'status': 'generate', 'content': full_text})
+                elif text:
+                    yield json.dumps({'status': 'generate', 'seq': seq, 'delta': text})
+                    seq += 1
+            elif status == "finish":
+                if snapshot:
+                    yield json.dumps({'status': 'finish', 'content': text})
+                else:
+                    # 客户端拼接 delta 后可用 seq 检查是否缺失，用 checksum 校验完整内容
+                    checksum = hashlib.sha256(text.encode('utf-8')).hexdigest()
+                    yield json.dumps({'status': 'finish', 'seq': seq, 'content': text, 'checksum': checksum})
+            elif status == "error":
+                yield "error"
+            else:
+                yield "unknown"
 
-        # 定义变量记录生成过程的中间内容
-        full_text = ""
+    # 评价结果不保存到数据库，客户端断开后取消生成；评价完整结束（finish）时才写入缓存，取消的评价不缓存
+    return story_stream_response(generate, key=content_key('testArticleEvaluate', data), persist=False)
+
+
+# 拍照评价作文：上传图片，识别文字后立即开始评价，识别结果和评价内容在同一个流中返回
+@app.route('/ocrArticleEvaluate', methods=['POST'])
+def ocr_article_evaluate():
+    # 图片可以用二进制上传（见 read_upload_image），也可以在 JSON 中传 image_base64
+    try:
+        image = read_upload_image()
+    except UploadTooLarge:
+        return jsonify({'status': 'error', 'message': '图片太大'}), 413
+    if image is not None:
+        try:
+            image_base64 = image_to_base64(image)
+        except Exception as e:
+            return jsonify({'status': 'error', 'message': f'图片格式错误: {e}'}), 400
+        finally:
+            image.close()
+    else:
+        image_base64 = (request.get_json(silent=True) or {}).get('image_base64') or request.form.get('image_base64')
+    if not image_base64:
+        return jsonify({'status': 'error', 'message': '缺少图片'}), 400
 
-        # 循环获取大模型生成的内容
-        for event in response.events():
-            if event.event == "add":
-                full_text += event.data
-                yield json.dumps({'status': 'generate', 'content': full_text})
-            elif event.event == "finish":
-                yield json.dumps({'status': 'finish', 'content': full_text})
-            elif event.event == "error" or event.event == "interrupted":
-                yield "error"
+    def generate():
+        start = time.perf_counter()
+        timings = {}
+
+        # 第一阶段：识别文字
+        try:
+            article, lines = get_orc_text(image_base64)
+        except Exception as e:
+            yield json.dumps({'status': 'error', 'stage': 'ocr', 'message': str(e)})
+            return
+        timings['ocr'] = time.perf_counter() - start
+        yield json.dumps({'status': 'ocr', 'content': article, 'lines': lines})
+        if not article.strip():
+            yield json.dumps({'status': 'error', 'stage': 'ocr', 'message': '没有识别到文字'})
+            return
+
+        # 第二阶段：评价作文，与 testArticleEvaluate 的 delta 格式一致
+        evaluate_start = time.perf_counter()
+        seq = 0
+        for status, text in stream_article_evaluation(article):
+            if status == "generate":
+                if 'first_token' not in timings:
+                    timings['first_token'] = time.perf_counter() - evaluate_start
+                if text:
+                    yield json.dumps({'status': 'generate', 'seq': seq, 'delta': text})
+                    seq += 1
+            elif status == "finish":
+                timings['evaluate'] = time.perf_counter() - evaluate_start
+                timings['total'] = time.perf_counter() - start
+                checksum = hashlib.sha256(text.encode('utf-8')).hexdigest()
+                yield json.dumps({'status': 'finish', 'seq': seq, 'content': text, 'checksum': checksum,
+                                  'timings': timings})
+            elif status == "error":
+                yield json.dumps({'status': 'error', 'stage': 'evaluate', 'message': text})
             else:
                 yield "unknown"
 
-    return Response(stream_with_context(generate()), content_type='application/json')
+    # 与 testArticleEvaluate 相同：结果不保存到数据库，客户端断开后取消识别和评价
+    return story_stream_response(generate, key=content_key('ocrArticleEvaluate', image_base64), persist=False)
+
+
+# 批量评价作文，按完成顺序逐行返回结果（NDJSON）
+@app.route('/batchArticleEvaluate', methods=['POST'])
+def batch_article_evaluate():
+    data = request.get_json()
+    articles = data.get('articles') or []
+    if len(articles) > ARTICLE_BATCH_MAX:
+        return jsonify({'status': 'error', 'message': f'最多一次提交 {ARTICLE_BATCH_MAX} 篇作文'}), 400
+
+    # 每篇作文可以是字符串，也可以是 {id, article}，返回结果时带回 id
+    ids = [item.get('id') if isinstance(item, dict) else None for item in articles]
+    texts = [item.get('article') if isinstance(item, dict) else item for item in articles]
+
+    def generate():
+        for result in evaluate_articles(texts):
+            result['id'] = ids[result['index']]
+            yield json.dumps(result) + '\n'
+
+    return story_stream_response(generate, key=content_key('batchArticleEvaluate', data),
+                                 content_type='application/x-ndjson')
 
 
 if __name__ == '__main__':
@@ -1,32 +1,110 @@
 import requests
 import base64
+import io
+import json
 import urllib
 from dotenv import load_dotenv
 import os
+from PIL import Image, ImageOps
+from tools import credentials
+from service.ocr_cache import cached_ocr
 
 load_dotenv()  # 加载 .env 文件中的变量
 API_KEY = os.environ['BAIDU_OCR_KEY']
 SECRET_KEY = os.environ['BAIDU_OCR_SECRET']
 END_POINT = os.environ['BAIDU_OCR_ENDPOINT']
 ACCESS_TOKEN_END_POINT = os.environ['BAIDU_OCR_ACCESS_TOKEN_ENDPOINT']
+# access token 无效或过期的错误码
+TOKEN_ERROR_CODES = (110, 111)
+# 上传给 OCR 的图片最长边（像素）及 JPEG 压缩质量，文字识别不需要手机原图的分辨率
+OCR_IMAGE_MAX_SIDE = int(os.environ.get('OCR_IMAGE_MAX_SIDE') or 2048)
+OCR_JPEG_QUALITY = int(os.environ.get('OCR_JPEG_QUALITY') or 85)
 
 
 def get_orc_content(image_base64):
-    url = END_POINT + get_access_token()
+    """
+    识别图片中的文字，返回接口的响应内容；相同或几乎相同的图片直接返回缓存的结果
+    """
+    return cached_ocr(image_base64, _get_orc_content, _is_success)
+
 
+def _is_success(content):
+    try:
+        return 'error_code' not in json.loads(content)
+    except ValueError:
+        return False
+
+
+def _get_orc_content(image_base64):
     # image_data = base64.b64decode(image_base64)
     # 获取图片
     # image = get_file_content_as_base64(image_url, True)
     payload = 'image=' + urllib.parse.quote(image_base64) + '&detect_direction=false&probability=false'
+
+    response = _request_orc(payload)
+    if response.json().get('error_code') in TOKEN_ERROR_CODES:
+        # token 提前失效时换一个新的 token 重试一次，payload 不需要重新编码
+        credentials.baidu_token.invalidate()
+        response = _request_orc(payload)
+
+    print(response.text)
+    return response.text
+
+
+def _request_orc(payload):
+    url = END_POINT + get_access_token()
     headers = {
         'Content-Type': 'application/x-www-form-urlencoded',
         'Accept': 'application/json'
     }
 
-    response = requests.request("POST", url, headers=headers, data=payload)
+    return requests.request("POST", url, headers=headers, data=payload)
 
-    print(response.text)
-    return response.text
+
+def prepare_image(fp):
+    """
+    把上传的图片缩小到 OCR_IMAGE_MAX_SIDE 以内并重新压缩为 JPEG；
+    已经足够小的 JPEG 直接使用原文件，不重新压缩。
+    :param fp: 图片文件对象
+    :return: 图片内容（bytes）
+    """
+    image = Image.open(fp)
+    if image.format == 'JPEG' and max(image.size) <= OCR_IMAGE_MAX_SIDE and \
+            image.getexif().get(0x0112, 1) == 1:
+        fp.seek(0)
+        return fp.read()
+
+    # thumbnail 对 JPEG 会先按比例缩小解码，不需要解码出完整的原图
+    image.thumbnail((OCR_IMAGE_MAX_SIDE, OCR_IMAGE_MAX_SIDE), Image.LANCZOS)
+    # 按拍摄方向转正，OCR 只识别正向的文字
+    image = ImageOps.exif_transpose(image)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=OCR_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+
+def image_to_base64(fp):
+    """
+    处理上传的图片并进行 base64 编码，结果可直接传给 get_orc_content / get_orc_text
+    """
+    return base64.b64encode(prepare_image(fp)).decode('ascii')
+
+
+def get_orc_text(image_base64):
+    """
+    识别图片中的文字，返回按行拼接的文本。
+    :param image_base64: 图片的base64编码
+    :return: (文本, 行数组)，识别失败时抛出 ValueError
+    """
+    result = json.loads(get_orc_content(image_base64))
+    if 'error_code' in result:
+        raise ValueError(f"OCR failed: {result.get('error_code')} {result.get('error_msg')}")
+
+    lines = [item.get('words', '') for item in result.get('words_result', [])]
+    return '\n'.join(lines), lines
 
 
 def get_file_content_as_base64(path, urlencoded=False):
@@ -45,9 +123,7 @@ def get_file_content_as_base64(path, urlencoded=False):
 
 def get_access_token():
     """
-    使用 AK，SK 生成鉴权签名（Access Token）
-    :return: access_token，或是None(如果错误)
+    使用 AK，SK 生成鉴权签名（Access Token），缓存到过期前并在后台提前刷新
+    :return: access_token，获取失败时抛出异常
     """
-    url = "https://aip.baidubce.com/oauth/2.0/token"
-    params = {"grant_type": "client_credentials", "client_id": API_KEY, "client_secret": SECRET_KEY}
-    return str(requests.post(url, params=params).json().get("access_token"))
+    return credentials.get_baidu_access_token()
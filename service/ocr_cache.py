@@ -0,0 +1,217 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from PIL import Image
+from tools import metrics
+from tools.single_flight import SingleFlight
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# OCR 结果缓存目录及占用磁盘的上限（字节），超出时淘汰最久未使用的结果
+OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR') or 'cache/ocr'
+OCR_CACHE_MAX_BYTES = int(os.environ.get('OCR_CACHE_MAX_BYTES') or 200 * 1024 * 1024)
+# 感知哈希的最大汉明距离（共 256 位），不超过该距离视为同一张照片；为 0 时只按内容完全相同匹配。
+# 不同页面的作文缩小后都很相似，这个值不要调得太大
+OCR_CACHE_MAX_DISTANCE = int(os.environ.get('OCR_CACHE_MAX_DISTANCE') or 8)
+
+# 感知哈希（dHash）的边长：缩小为 (HASH_SIZE + 1) x HASH_SIZE 的灰度图，比较相邻像素得到 HASH_SIZE² 位
+HASH_SIZE = 16
+
+
+def image_dhash(image_bytes: bytes) -> int:
+    """
+    计算图片的差值哈希（dHash），同一页重新拍摄或重新压缩的照片哈希相近。
+    """
+    image = Image.open(io.BytesIO(image_bytes))
+    # JPEG 直接按缩小的尺寸解码
+    image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    pixels = list(image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS).getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+class OcrCache:
+    """
+    OCR 结果的磁盘缓存：每个结果一个 JSON 文件，文件名为 <sha256>_<dhash>.json。
+    先按图片内容的 sha256 精确查找，找不到时在内存索引中按 dHash 汉明距离查找相近的照片。
+    按访问时间淘汰（命中时更新文件的修改时间），重启后从目录恢复索引。
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_distance: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_distance = max_distance
+        # sha256 -> (dhash, 文件大小)，按最近使用的顺序排列
+        self._index = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    def _path(self, sha, dhash):
+        return os.path.join(self.directory, f'{sha}_{dhash:064x}.json')
+
+    def _load(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        entries = []
+        for name in os.listdir(self.directory):
+            sha, _, rest = name.partition('_')
+            if not name.endswith('.json') or not rest:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, sha, int(rest[:-len('.json')], 16), stat.st_size))
+            except (OSError, ValueError):
+                continue
+        for _, sha, dhash, size in sorted(entries):
+            self._index[sha] = (dhash, size)
+            self._size += size
+
+    def get(self, sha: str, load_image=None):
+        """
+        查找缓存的结果，返回 (结果, dhash)；没有命中时结果为 None。
+        只有精确查找未命中时才调用 load_image() 取得图片内容并计算 dHash。
+        """
+        with self._lock:
+            entry = self._index.get(sha)
+        if entry is not None:
+            result = self._read(sha, entry[0])
+            if result is not None:
+                metrics.incr('ocr_cache.hit')
+                return result, entry[0]
+
+        dhash = None
+        if load_image is not None and self.max_distance > 0:
+            try:
+                dhash = image_dhash(load_image())
+            except Exception:
+                dhash = None
+        if dhash is not None:
+            similar = self._find_similar(dhash)
+            if similar is not None:
+                result = self._read(*similar)
+                if result is not None:
+                    metrics.incr('ocr_cache.similar_hit')
+                    return result, dhash
+
+        metrics.incr('ocr_cache.miss')
+        return None, dhash
+
+    def _find_similar(self, dhash):
+        best = None
+        with self._lock:
+            for sha, (other, _) in self._index.items():
+                if not other:
+                    # 没有计算出 dHash 的结果只能精确匹配
+                    continue
+                distance = bin(dhash ^ other).count('1')
+                if distance <= self.max_distance and (best is None or distance < best[0]):
+                    best = (distance, sha, other)
+        return best and best[1:]
+
+    def _read(self, sha, dhash):
+        path = self._path(sha, dhash)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                result = json.load(f)['result']
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            self._remove(sha)
+            return None
+        with self._lock:
+            if sha in self._index:
+                self._index.move_to_end(sha)
+        return result
+
+    def put(self, sha: str, dhash, result: str):
+        dhash = dhash or 0
+        path = self._path(sha, dhash)
+        data = json.dumps({'sha256': sha, 'dhash': f'{dhash:064x}', 'result': result,
+                           'created': int(time.time())}, ensure_ascii=False)
+        # 先写临时文件再改名，读取时不会读到写了一半的文件
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            print('Save OCR cache failed:', e)
+            return
+
+        evicted = []
+        with self._lock:
+            old = self._index.pop(sha, None)
+            if old is not None:
+                self._size -= old[1]
+                if old[0] != dhash:
+                    evicted.append((sha, old[0]))
+            self._index[sha] = (dhash, size)
+            self._size += size
+            while self._size > self.max_bytes and len(self._index) > 1:
+                old_sha, (old_dhash, old_size) = self._index.popitem(last=False)
+                self._size -= old_size
+                evicted.append((old_sha, old_dhash))
+        for old_sha, old_dhash in evicted:
+            if old_sha != sha:
+                metrics.incr('ocr_cache.evicted')
+            try:
+                os.remove(self._path(old_sha, old_dhash))
+            except OSError:
+                pass
+
+    def _remove(self, sha):
+        with self._lock:
+            entry = self._index.pop(sha, None)
+            if entry is not None:
+                self._size -= entry[1]
+
+
+_cache = None
+_cache_lock = threading.Lock()
+# 同一张图片同时提交多次时只识别一次
+_flight = SingleFlight('ocr', ttl=0)
+
+
+def get_cache() -> OcrCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = OcrCache(OCR_CACHE_DIR, OCR_CACHE_MAX_BYTES, OCR_CACHE_MAX_DISTANCE)
+    return _cache
+
+
+def cached_ocr(image_base64: str, recognize, cacheable):
+    """
+    带缓存的文字识别。
+
+    参数:
+    - image_base64: 图片的 base64 编码
+    - recognize: 实际调用 OCR 的函数，参数为 image_base64，返回接口的响应内容
+    - cacheable: 判断响应内容能否缓存的函数（识别失败的结果不缓存）
+    """
+    sha = hashlib.sha256(image_base64.encode('utf-8')).hexdigest()
+
+    def load():
+        cache = get_cache()
+        result, dhash = cache.get(sha, lambda: base64.b64decode(image_base64))
+        if result is not None:
+            return result
+        result = recognize(image_base64)
+        if cacheable(result):
+            cache.put(sha, dhash, result)
+        return result
+
+    return _flight.do(sha, load)
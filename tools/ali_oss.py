@@ -1,15 +1,21 @@
-import oss2
 import os
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from flask import jsonify
+from tools import metrics
+from tools.credentials import get_oss_bucket
 
 load_dotenv()
 
+# 上传图片时是否在本地 out 目录保存一份副本；副本在后台线程写入，不影响上传
+IMAGE_LOCAL_COPY = (os.environ.get('IMAGE_LOCAL_COPY') or 'true').lower() == 'true'
+
+_write_behind = ThreadPoolExecutor(max_workers=1, thread_name_prefix='image-write-behind')
+
 
 def upload_pic(img_name, dir_name):
-    # 首先, 初始化 AccessKeyId, AccessKeySecret, BucketName 和 Endpoint.
-    auth = oss2.Auth(os.environ['OSS_KEY'], os.environ['OSS_SECRET'])
-    bucket = oss2.Bucket(auth, os.environ['OSS_ENDPOINT'], os.environ['OSS_BUCKETNAME'])
+    # 复用进程内共用的 Bucket，不再每次上传都初始化 Auth 和 Bucket
+    bucket = get_oss_bucket()
 
     # 创建模拟的OSS文件夹结构
     oss_object_key = os.path.join(dir_name, img_name).replace('\\', '/')
@@ -21,8 +27,40 @@ def upload_pic(img_name, dir_name):
     result = bucket.put_object_from_file(oss_object_key, local_file_path)
 
     # 生成已上传图片的完整URL
-    image_url = f"https://{os.environ['OSS_BUCKETNAME']}.{os.environ['OSS_ENDPOINT']}/{oss_object_key}"
+    return image_url(oss_object_key)
+
+
+def image_url(oss_object_key):
+    return f"https://{os.environ['OSS_BUCKETNAME']}.{os.environ['OSS_ENDPOINT']}/{oss_object_key}"
+
+
+def upload_bytes(data, oss_object_key, content_type='image/png'):
+    """
+    直接上传内存中的图片内容，不经过本地文件。
+    :param data: 图片内容（bytes，原样传给 put_object，不复制）
+    :param oss_object_key: OSS 中的路径
+    :return: 图片的网络地址
+    """
+    get_oss_bucket().put_object(oss_object_key, data, headers={'Content-Type': content_type})
+    metrics.incr('oss.upload_bytes')
+    return image_url(oss_object_key)
+
 
-    return image_url
+def _write_file(data, path):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+    except OSError as e:
+        metrics.incr('oss.local_copy_error')
+        print('Save local image failed:', e)
+        raise
 
 
+def save_local_copy(data, path):
+    """
+    在后台线程把图片写到本地，返回 Future；IMAGE_LOCAL_COPY 关闭时返回 None。
+    """
+    if not IMAGE_LOCAL_COPY:
+        return None
+    return _write_behind.submit(_write_file, data, path)
@@ -0,0 +1,77 @@
+import json
+import time
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tools.stream_parser import JsonFieldExtractor
+
+# 微基准：对比旧的全量重扫方式与增量提取器在不同输出长度下的单事件耗时，
+# 以及每个事件产出完整内容（extractor.value）与产出新增内容两种写法的耗时
+# 运行方式：python tools/bench_stream_parser.py
+
+
+def build_chunks(content_len, chunk_size=3):
+    text = json.dumps({
+        "round": 1,
+        "chapter": "故事的开端",
+        "content": "冒" * content_len,
+        "choice": ["a.xxx", "b.xxx", "c.xxx"]
+    }, ensure_ascii=False)
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+def rescan(chunks):
+    # main.py 原来的写法：每个事件都拼接并重新扫描整个缓冲区
+    full_text = ""
+    for chunk in chunks:
+        full_text += chunk
+        if '"content": "' in full_text:
+            start_index = full_text.index('"content": "') + len('"content": "')
+            recorded_content = full_text[start_index:]
+            if '"' not in recorded_content:
+                pass
+
+
+def incremental(chunks):
+    extractor = JsonFieldExtractor('content')
+    for chunk in chunks:
+        extractor.feed(chunk)
+
+
+def yield_value(chunks):
+    # 每个事件产出 extractor.value：每次都重新拼接已提取的全部内容
+    extractor = JsonFieldExtractor('content')
+    for chunk in chunks:
+        if extractor.feed(chunk):
+            _ = extractor.value
+
+
+def yield_delta(chunks):
+    # stream_plot_content 的写法：产出 feed() 返回的新增内容，由调用方拼接
+    extractor = JsonFieldExtractor('content')
+    content = ''
+    for chunk in chunks:
+        delta = extractor.feed(chunk)
+        if delta:
+            content += delta
+
+
+def bench(func, chunks, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(chunks)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(chunks) * 1e6
+
+
+if __name__ == '__main__':
+    print(f"{'content_len':>12} {'events':>8} {'rescan us/event':>16} {'incremental us/event':>21} "
+          f"{'yield value us/event':>21} {'yield delta us/event':>21}")
+    for content_len in (80, 800, 8_000, 80_000):
+        chunks = build_chunks(content_len)
+        print(f"{content_len:>12} {len(chunks):>8} {bench(rescan, chunks):>16.3f} {bench(incremental, chunks):>21.3f} "
+              f"{bench(yield_value, chunks):>21.3f} {bench(yield_delta, chunks):>21.3f}")
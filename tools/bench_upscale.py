@@ -0,0 +1,49 @@
+import io
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+from tools.upscale import LocalUpscaler, RemoteUpscaler
+
+# 基准：对比本地放大（不同分块数）与 Stability 放大在 512 -> 1024 图片上的耗时和输出大小
+# 运行方式：python tools/bench_upscale.py [图片路径 ...] [--remote]
+# 不传图片时使用生成的测试图片；--remote 会实际调用 Stability 放大（收费），默认不调用
+
+
+def sample_images(paths):
+    if paths:
+        return [(os.path.basename(path), Image.open(path).convert('RGB')) for path in paths]
+    image = Image.effect_mandelbrot((512, 512), (-2, -1.5, 1, 1.5), 200).convert('RGB')
+    return [('mandelbrot-512', image)]
+
+
+def png_size(image):
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+    return output.tell()
+
+
+def bench(upscaler, image, target_width, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = upscaler.upscale(image, target_width)
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2] * 1000, png_size(result)
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    upscalers = [(f'local x{tiles} tiles', LocalUpscaler(tiles), 5) for tiles in (1, 2, 4, 8)]
+    if '--remote' in sys.argv:
+        upscalers.append(('remote', RemoteUpscaler(), 1))
+
+    print(f"{'image':>16} {'upscaler':>16} {'median ms':>10} {'png KB':>8}")
+    for name, image in sample_images(args):
+        for label, upscaler, repeat in upscalers:
+            elapsed, size = bench(upscaler, image, image.width * 2, repeat)
+            print(f"{name:>16} {label:>16} {elapsed:>10.1f} {size / 1024:>8.1f}")
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+import oss2
+import requests
+from dotenv import load_dotenv
+from tools import metrics
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# access token 在过期前多少秒开始后台刷新；刷新失败后多久内不再重试（秒）
+TOKEN_REFRESH_MARGIN = int(os.environ.get('TOKEN_REFRESH_MARGIN') or 86400)
+TOKEN_RETRY_INTERVAL = int(os.environ.get('TOKEN_RETRY_INTERVAL') or 30)
+# 获取 token 的请求超时时间（秒）
+TOKEN_REQUEST_TIMEOUT = float(os.environ.get('TOKEN_REQUEST_TIMEOUT') or 10)
+
+BAIDU_TOKEN_URL = "https://aip.baidubce.com/oauth/2.0/token"
+
+
+class RefreshingToken:
+    """
+    会过期的 access token：缓存到过期前 TOKEN_REFRESH_MARGIN 秒，进入该区间后由后台线程刷新，
+    请求方继续使用旧 token 不等待；只有没有 token 或已经过期时才同步获取。
+    刷新失败时保留未过期的旧 token，并在 TOKEN_RETRY_INTERVAL 秒后再次尝试。
+
+    参数:
+    - provider: 服务名称，用于 metrics 计数（credentials.<provider>.refresh / .error）
+    - fetch: 获取 token 的函数，返回 (token, 有效期秒数)
+    """
+
+    def __init__(self, provider: str, fetch):
+        self.provider = provider
+        self._fetch = fetch
+        self._token = None
+        self._expires_at = 0
+        self._retry_at = 0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self) -> str:
+        now = time.time()
+        with self._lock:
+            token, expires_at = self._token, self._expires_at
+            background = token is not None and now < expires_at \
+                and now >= expires_at - TOKEN_REFRESH_MARGIN \
+                and now >= self._retry_at and not self._refreshing
+            if background:
+                self._refreshing = True
+
+        if token is not None and now < expires_at:
+            if background:
+                threading.Thread(target=self._background_refresh, daemon=True,
+                                 name=f'token-refresh-{self.provider}').start()
+            return token
+        return self.refresh()
+
+    def refresh(self) -> str:
+        """
+        同步获取新的 token，失败时抛出异常。
+        """
+        try:
+            token, expires_in = self._fetch()
+        except Exception:
+            metrics.incr(f'credentials.{self.provider}.error')
+            with self._lock:
+                self._retry_at = time.time() + TOKEN_RETRY_INTERVAL
+            raise
+        metrics.incr(f'credentials.{self.provider}.refresh')
+        with self._lock:
+            self._token = token
+            self._expires_at = time.time() + expires_in
+            self._retry_at = 0
+        return token
+
+    def invalidate(self):
+        """
+        服务端返回 token 无效时调用，下次 get() 同步获取新的 token。
+        """
+        with self._lock:
+            self._token = None
+            self._expires_at = 0
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print(f'Refresh {self.provider} token failed:', e)
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+def _fetch_baidu_token():
+    params = {"grant_type": "client_credentials",
+              "client_id": os.environ['BAIDU_OCR_KEY'],
+              "client_secret": os.environ['BAIDU_OCR_SECRET']}
+    result = requests.post(BAIDU_TOKEN_URL, params=params, timeout=TOKEN_REQUEST_TIMEOUT).json()
+    if 'access_token' not in result:
+        raise ValueError(f"Baidu access token failed: {result.get('error')} {result.get('error_description')}")
+    # 百度 token 有效期 30 天，以返回的 expires_in 为准
+    return result['access_token'], int(result.get('expires_in', 2592000))
+
+
+baidu_token = RefreshingToken('baidu', _fetch_baidu_token)
+
+_oss_bucket = None
+_clients_lock = threading.Lock()
+
+
+def get_baidu_access_token() -> str:
+    return baidu_token.get()
+
+
+def get_oss_bucket() -> oss2.Bucket:
+    """
+    进程内共用的 OSS Bucket，oss2.Bucket 是线程安全的，复用其中的连接池。
+    """
+    global _oss_bucket
+    if _oss_bucket is None:
+        with _clients_lock:
+            if _oss_bucket is None:
+                try:
+                    auth = oss2.Auth(os.environ['OSS_KEY'], os.environ['OSS_SECRET'])
+                    _oss_bucket = oss2.Bucket(auth, os.environ['OSS_ENDPOINT'], os.environ['OSS_BUCKETNAME'])
+                except Exception:
+                    metrics.incr('credentials.oss.error')
+                    raise
+                metrics.incr('credentials.oss.refresh')
+    return _oss_bucket
@@ -0,0 +1,33 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import app
+from database.models import db
+from controllers.opening_round_controller import get_preset_pairs
+from generate.opening_pool import refill_opening_pool, OPENING_POOL_SIZE
+from generate.qinghua_completions import get_game_rules_template_id, get_game_start_prompt
+
+# 预生成开局回合：把所有预设主题 × 预设角色的开局池补充到 OPENING_POOL_SIZE 个
+# 运行方式：python tools/fill_opening_pool.py（可配置为定时任务）
+
+
+def fill():
+    # 创建 opening_round 表，已存在的表不受影响
+    db.create_all()
+
+    template_id = get_game_rules_template_id()
+    total = 0
+    for theme, protagonist in get_preset_pairs():
+        prompt = get_game_start_prompt(theme, protagonist, template_id)
+        added = refill_opening_pool(theme['id'], protagonist['id'], template_id, prompt)
+        print(f"主题 {theme['id']} × 主角 {protagonist['id']}：新增 {added} 个开局")
+        total += added
+
+    print(f"补充完成：共新增 {total} 个开局，每个组合保留 {OPENING_POOL_SIZE} 个")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        fill()
@@ -0,0 +1,150 @@
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from PIL import Image
+from app_instance import app
+from controllers.image_variant_controller import add_image_variant, get_image_variants
+from tools import metrics
+from tools.ali_oss import upload_bytes, image_url
+from tools.credentials import get_oss_bucket
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 衍生图片的宽度（像素，逗号分隔）、格式（webp / jpeg，逗号分隔）及压缩质量
+IMAGE_VARIANT_WIDTHS = [int(width) for width in (os.environ.get('IMAGE_VARIANT_WIDTHS') or '200,480,960').split(',') if width]
+IMAGE_VARIANT_FORMATS = [fmt.strip().lower() for fmt in (os.environ.get('IMAGE_VARIANT_FORMATS') or 'webp').split(',') if fmt]
+IMAGE_VARIANT_QUALITY = int(os.environ.get('IMAGE_VARIANT_QUALITY') or 80)
+# 图片上传后立即在后台生成衍生图片；关闭时在第一次按尺寸请求时生成
+IMAGE_VARIANT_EAGER = (os.environ.get('IMAGE_VARIANT_EAGER') or 'true').lower() == 'true'
+
+_CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='image-variant')
+# 正在生成衍生图片的 (原图地址, 格式)，避免重复提交
+_pending = set()
+_lock = threading.Lock()
+
+
+def _encode(image, fmt):
+    output = io.BytesIO()
+    if fmt == 'webp':
+        image.save(output, format='WEBP', quality=IMAGE_VARIANT_QUALITY, method=4)
+    else:
+        image.convert('RGB').save(output, format='JPEG', quality=IMAGE_VARIANT_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def build_variants(data: bytes, oss_object_key: str, source_url: str, formats: list = None) -> int:
+    """
+    把原图缩小到 IMAGE_VARIANT_WIDTHS 中比原图小的各个宽度，编码为 formats（默认 IMAGE_VARIANT_FORMATS）中的格式，
+    上传到原图旁边并记录地址和大小。需要在 app context 中调用。
+
+    返回:
+    - 生成的数量
+    """
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+    base, _ = os.path.splitext(oss_object_key)
+    count = 0
+    for width in sorted(IMAGE_VARIANT_WIDTHS):
+        if width >= image.width:
+            break
+        height = max(1, round(image.height * width / image.width))
+        resized = image.resize((width, height), Image.LANCZOS)
+        for fmt in formats or IMAGE_VARIANT_FORMATS:
+            if fmt not in _CONTENT_TYPES:
+                continue
+            encoded = _encode(resized, fmt)
+            url = upload_bytes(encoded, f"{base}_w{width}.{'jpg' if fmt == 'jpeg' else fmt}",
+                               content_type=_CONTENT_TYPES[fmt])
+            add_image_variant(source_url, width, height, fmt, url, len(encoded))
+            metrics.incr('image_variant.created')
+            metrics.incr('image_variant.bytes', len(encoded))
+            count += 1
+    return count
+
+
+def _object_key(source_url: str):
+    prefix = image_url('')
+    return source_url[len(prefix):] if source_url.startswith(prefix) else None
+
+
+def _build_in_background(source_url, formats, data=None, oss_object_key=None):
+    try:
+        if data is None:
+            # 按需生成：从 oss 下载原图
+            oss_object_key = _object_key(source_url)
+            if oss_object_key is None:
+                return
+            data = get_oss_bucket().get_object(oss_object_key).read()
+        with app.app_context():
+            build_variants(data, oss_object_key, source_url, formats)
+    except Exception as e:
+        metrics.incr('image_variant.error')
+        print('Build image variants failed:', e)
+    finally:
+        with _lock:
+            _pending.difference_update((source_url, fmt) for fmt in formats)
+
+
+def schedule_variants(source_url: str, data: bytes = None, oss_object_key: str = None, formats: list = None) -> bool:
+    """
+    在后台生成 formats（默认 IMAGE_VARIANT_FORMATS）格式的衍生图片；已上传的图片可以只传地址，由后台从 oss 下载原图。
+
+    返回:
+    - 是否提交了新的生成任务
+    """
+    with _lock:
+        formats = [fmt for fmt in formats or IMAGE_VARIANT_FORMATS if (source_url, fmt) not in _pending]
+        if not formats:
+            return False
+        _pending.update((source_url, fmt) for fmt in formats)
+    _executor.submit(_build_in_background, source_url, formats, data, oss_object_key)
+    return True
+
+
+def on_upload(data: bytes, oss_object_key: str, source_url: str):
+    """
+    原图上传后调用，IMAGE_VARIANT_EAGER 开启时立即在后台生成衍生图片。
+    """
+    if IMAGE_VARIANT_EAGER:
+        schedule_variants(source_url, data, oss_object_key)
+
+
+def pick_variant(source_url: str, size_hint: int, fmt: str = None):
+    """
+    按需要的宽度选择 fmt 格式（默认 IMAGE_VARIANT_FORMATS 的第一个）的图片：宽度不小于 size_hint 的最小衍生图片，
+    都比 size_hint 小时用原图。还没有该格式的衍生图片时返回原图，并在后台生成；不支持的格式直接返回原图。
+    需要在 app context 中调用。
+
+    返回:
+    - {url, width, format, size}，使用原图时只有 url
+    """
+    if not source_url or not size_hint:
+        return {'url': source_url}
+
+    fmt = (fmt or IMAGE_VARIANT_FORMATS[0]).lower()
+    fmt = 'jpeg' if fmt == 'jpg' else fmt
+    if fmt not in _CONTENT_TYPES:
+        return {'url': source_url}
+
+    variants = get_image_variants(source_url)
+    candidates = [variant for variant in variants if variant['format'] == fmt]
+    if not candidates:
+        # 不用其他格式代替（客户端可能不支持），先返回原图；没有任何衍生图片时连同配置的格式一起生成
+        metrics.incr('image_variant.miss')
+        if _object_key(source_url) is not None:
+            formats = [fmt] if variants else list(dict.fromkeys(IMAGE_VARIANT_FORMATS + [fmt]))
+            schedule_variants(source_url, formats=formats)
+        return {'url': source_url}
+
+    for variant in candidates:
+        if variant['width'] >= size_hint:
+            metrics.incr('image_variant.hit')
+            return variant
+    return {'url': source_url}
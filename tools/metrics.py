@@ -0,0 +1,21 @@
+import threading
+from collections import defaultdict
+
+# 进程内的简单计数器，用于观察缓存命中率等运行情况，通过 /metrics 接口查看
+
+_counters = defaultdict(int)
+_lock = threading.Lock()
+
+
+def incr(name: str, value: int = 1):
+    with _lock:
+        _counters[name] += value
+
+
+def get(name: str) -> int:
+    return _counters.get(name, 0)
+
+
+def snapshot() -> dict:
+    with _lock:
+        return dict(_counters)
@@ -0,0 +1,45 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import inspect, text
+from main import app
+from database.models import db, Game, GameRound
+from controllers.game_controller import backfill_game_rounds
+
+# 数据迁移：把 game.content / game.prompt_history 中的旧数据拆分为 game_round 表的回合记录
+# 运行方式：python tools/migrate_game_rounds.py
+
+
+def migrate():
+    # 创建新增的表（prompt_template、game_round），已存在的表不受影响
+    db.create_all()
+
+    # game 表新增 template_id 字段
+    columns = [column['name'] for column in inspect(db.engine).get_columns('game')]
+    if 'template_id' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE game ADD COLUMN template_id INTEGER NULL'))
+            connection.execute(text('ALTER TABLE game ADD FOREIGN KEY (template_id) REFERENCES prompt_template (id)'))
+
+    migrated = 0
+    skipped = 0
+    # 回填过程中会逐个提交，先取出全部ID再逐个处理
+    game_ids = [game_id for (game_id,) in db.session.query(Game.id).filter(Game.prompt_history.isnot(None)).all()]
+    for game_id in game_ids:
+        if GameRound.query.filter_by(game_id=game_id).first():
+            skipped += 1
+            continue
+        try:
+            backfill_game_rounds(Game.query.get(game_id))
+            migrated += 1
+        except Exception as e:
+            print(f"游戏 {game_id} 迁移失败: {e}")
+
+    print(f"迁移完成：回填 {migrated} 个游戏，跳过 {skipped} 个已有回合记录的游戏")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        migrate()
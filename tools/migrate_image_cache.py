@@ -0,0 +1,20 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import app
+from database.models import db, ImageCache
+
+# 数据迁移：创建图片生成缓存表 image_cache
+# 运行方式：python tools/migrate_image_cache.py
+
+
+def migrate():
+    ImageCache.__table__.create(db.engine, checkfirst=True)
+    print('迁移完成：image_cache 表已创建')
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        migrate()
@@ -0,0 +1,27 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import inspect, text
+from main import app
+from database.models import db
+
+# 数据迁移：image 表新增 shown 字段（换一张预生成的候选图片在取用前为 0），已有图片均视为已展示
+# 运行方式：python tools/migrate_image_candidates.py
+
+
+def migrate():
+    columns = [column['name'] for column in inspect(db.engine).get_columns('image')]
+    if 'shown' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE image ADD COLUMN shown BOOLEAN NOT NULL DEFAULT TRUE'))
+            connection.execute(text('CREATE INDEX ix_image_candidate ON image (game_id, shown)'))
+        print('迁移完成：新增字段 shown')
+    else:
+        print('迁移完成：字段 shown 已存在')
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        migrate()
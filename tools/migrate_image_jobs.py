@@ -0,0 +1,28 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import inspect, text
+from main import app
+from database.models import db, ImageJob
+
+# 数据迁移：创建图片生成任务表 image_job，已有的表新增 owner 字段
+# 运行方式：python tools/migrate_image_jobs.py
+
+
+def migrate():
+    ImageJob.__table__.create(db.engine, checkfirst=True)
+
+    # owner 记录正在执行任务的进程；已有的执行中任务为 NULL，心跳过期后照常回收
+    columns = [column['name'] for column in inspect(db.engine).get_columns('image_job')]
+    if 'owner' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE image_job ADD COLUMN owner VARCHAR(128) NULL'))
+
+    print('迁移完成：image_job 表已创建，已有 owner 字段')
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        migrate()
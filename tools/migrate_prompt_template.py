@@ -0,0 +1,29 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import inspect, text
+from main import app
+from database.models import db, PromptTemplate
+
+# 数据迁移：创建 prompt 模板表 prompt_template，game 表新增 template_id 字段
+# 运行方式：python tools/migrate_prompt_template.py
+
+
+def migrate():
+    PromptTemplate.__table__.create(db.engine, checkfirst=True)
+
+    # game 表新增 template_id 字段，已有的游戏为 NULL，继续使用完整的对话历史
+    columns = [column['name'] for column in inspect(db.engine).get_columns('game')]
+    if 'template_id' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(text('ALTER TABLE game ADD COLUMN template_id INTEGER NULL'))
+            connection.execute(text('ALTER TABLE game ADD FOREIGN KEY (template_id) REFERENCES prompt_template (id)'))
+
+    print('迁移完成：prompt_template 表已创建，game 表已有 template_id 字段')
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        migrate()
@@ -0,0 +1,41 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import inspect, text
+from main import app
+from database.models import db
+
+# 数据迁移：transaction 表新增大模型用量字段，user_id 改为可为空（后台预生成的调用没有归属用户）
+# 运行方式：python tools/migrate_transaction_usage.py
+
+NEW_COLUMNS = [
+    ('game_id', 'INTEGER NULL'),
+    ('model', 'VARCHAR(64) NULL'),
+    ('prompt_tokens', 'INTEGER NULL'),
+    ('completion_tokens', 'INTEGER NULL'),
+    ('total_tokens', 'INTEGER NULL'),
+    ('latency', 'FLOAT NULL'),
+]
+
+
+def migrate():
+    columns = [column['name'] for column in inspect(db.engine).get_columns('transaction')]
+    added = []
+    with db.engine.begin() as connection:
+        for name, column_type in NEW_COLUMNS:
+            if name not in columns:
+                connection.execute(text(f'ALTER TABLE `transaction` ADD COLUMN {name} {column_type}'))
+                added.append(name)
+        if 'game_id' in added:
+            connection.execute(text('ALTER TABLE `transaction` ADD FOREIGN KEY (game_id) REFERENCES game (id)'))
+            connection.execute(text('CREATE INDEX ix_transaction_game_id ON `transaction` (game_id)'))
+        connection.execute(text('ALTER TABLE `transaction` MODIFY user_id INTEGER NULL'))
+
+    print(f"迁移完成：新增字段 {', '.join(added) or '无'}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        migrate()
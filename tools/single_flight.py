@@ -0,0 +1,68 @@
+import hashlib
+import json
+import threading
+from concurrent.futures import Future
+from cachetools import TTLCache
+from tools import metrics
+
+
+def content_key(*parts) -> str:
+    """
+    按内容生成请求的 key：参数序列化后取 sha256。
+    """
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class SingleFlight:
+    """
+    进程内的请求合并：同一个 key 同时只执行一次，并发的相同请求等待并共享同一个结果；
+    执行成功后结果在 ttl 秒内直接返回；返回 None 或执行失败不缓存，等待中的请求收到同样的结果或异常。
+
+    参数:
+    - name: 名称，用于 metrics 计数
+    - ttl: 结果缓存时间（秒），为 0 时只合并进行中的请求
+    - maxsize: 最多缓存的结果数量
+    """
+
+    def __init__(self, name: str, ttl: float, maxsize: int = 1024):
+        self.name = name
+        self._calls = {}
+        self._results = TTLCache(maxsize=maxsize, ttl=ttl) if ttl > 0 else None
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            if self._results is not None and key in self._results:
+                metrics.incr(f'{self.name}.cache_hit')
+                return self._results[key]
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = Future()
+                self._calls[key] = call
+
+        if not leader:
+            metrics.incr(f'{self.name}.shared')
+            return call.result()
+
+        metrics.incr(f'{self.name}.miss')
+        try:
+            value = fn(*args, **kwargs)
+        except BaseException as e:
+            with self._lock:
+                del self._calls[key]
+            call.set_exception(e)
+            raise
+
+        with self._lock:
+            if self._results is not None and value is not None:
+                self._results[key] = value
+            del self._calls[key]
+        call.set_result(value)
+        return value
+
+    def forget(self, key):
+        with self._lock:
+            if self._results is not None:
+                self._results.pop(key, None)
@@ -0,0 +1,217 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from tools import metrics
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+# 每个回合保留的可重放事件数量、回合结束后保留多久（秒）、空闲时发送心跳的间隔（秒）
+SSE_REPLAY_BUFFER_SIZE = int(os.environ.get('SSE_REPLAY_BUFFER_SIZE') or 512)
+SSE_REPLAY_TTL = int(os.environ.get('SSE_REPLAY_TTL') or 120)
+SSE_HEARTBEAT_INTERVAL = float(os.environ.get('SSE_HEARTBEAT_INTERVAL') or 15)
+# 回合执行线程数；相同请求在回合结束后多久内仍复用该回合（秒）；
+# 不保存结果的回合在没有连接后等待多久再取消（秒），留给客户端重连
+TURN_MAX_WORKERS = int(os.environ.get('TURN_MAX_WORKERS') or 32)
+TURN_DEDUPE_TTL = int(os.environ.get('TURN_DEDUPE_TTL') or 10)
+TURN_CANCEL_GRACE = float(os.environ.get('TURN_CANCEL_GRACE') or 5)
+
+
+def format_event(data: str, event_id: str = None, event: str = None) -> str:
+    """
+    组装一条 text/event-stream 事件，多行数据拆成多个 data 字段。
+    """
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    if event is not None:
+        lines.append(f'event: {event}')
+    for line in data.split('\n'):
+        lines.append(f'data: {line}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def parse_event_id(event_id: str):
+    """
+    解析 Last-Event-ID（格式为 <turn_id>:<seq>），返回 (turn_id, seq)，格式不对时返回 (None, -1)。
+    """
+    turn_id, _, seq = (event_id or '').strip().rpartition(':')
+    try:
+        return (turn_id or None), int(seq)
+    except ValueError:
+        return None, -1
+
+
+class Turn:
+    """
+    一个回合的输出：生成在回合执行线程中进行，与 HTTP 请求无关，产出的事件写入有限长度的重放缓冲区，
+    任意数量的连接（包括断线重连）从缓冲区中读取，不会重复调用大模型。
+
+    参数:
+    - key: 请求的 key，相同 key 的请求复用同一个回合
+    - persist: 回合结果是否会保存；会保存的回合即使没有连接也一定执行完，不会保存的回合没有连接时取消
+    """
+
+    def __init__(self, turn_id: str, key: str = None, persist: bool = True, maxlen: int = SSE_REPLAY_BUFFER_SIZE):
+        self.turn_id = turn_id
+        self.key = key
+        self.persist = persist
+        self.finished_at = None
+        self.cancelled = False
+        self._events = deque(maxlen=maxlen)
+        self._next_seq = 0
+        self._subscribers = 0
+        self._idle_since = time.time()
+        self._condition = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def attach(self):
+        with self._condition:
+            self._subscribers += 1
+
+    def detach(self):
+        with self._condition:
+            self._subscribers -= 1
+            if self._subscribers == 0:
+                self._idle_since = time.time()
+
+    def should_cancel(self) -> bool:
+        """
+        取消策略：只有结果不会保存、且已经没有连接超过 TURN_CANCEL_GRACE 秒时才取消上游调用。
+        """
+        with self._condition:
+            return not self.persist and self._subscribers == 0 \
+                and time.time() - self._idle_since > TURN_CANCEL_GRACE
+
+    def append(self, data: str):
+        with self._condition:
+            self._events.append((self._next_seq, data))
+            self._next_seq += 1
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self.finished_at = time.time()
+            self._condition.notify_all()
+
+    def events(self, after_seq: int = -1, heartbeat: float = None):
+        """
+        依次产出 seq 大于 after_seq 的事件 (seq, data)，回合结束后返回。
+        缓冲区已丢弃的旧事件直接跳过；设置了 heartbeat 时，空闲超过该秒数产出 (None, None)。
+        迭代期间计为该回合的一个连接。
+        """
+        self.attach()
+        try:
+            yield from self._events_after(after_seq, heartbeat)
+        finally:
+            self.detach()
+
+    def _events_after(self, after_seq, heartbeat):
+        while True:
+            with self._condition:
+                pending = [(seq, data) for seq, data in self._events if seq > after_seq]
+                if not pending:
+                    if self.done:
+                        return
+                    self._condition.wait(heartbeat)
+                    pending = [(seq, data) for seq, data in self._events if seq > after_seq]
+                    if not pending and not self.done:
+                        if heartbeat is not None:
+                            yield None, None
+                        continue
+            for seq, data in pending:
+                yield seq, data
+                after_seq = seq
+
+
+# 回合执行线程池：生成不依赖 HTTP 请求，请求断开后回合照常执行完并保存结果
+_executor = ThreadPoolExecutor(max_workers=TURN_MAX_WORKERS, thread_name_prefix='turn')
+# turn_id -> Turn，结束超过 SSE_REPLAY_TTL 的回合在新回合开始时清理
+_turns = OrderedDict()
+# 请求 key -> Turn，用于合并重复提交的相同请求
+_turns_by_key = {}
+_lock = threading.Lock()
+
+
+def _cleanup():
+    now = time.time()
+    for turn_id in [turn_id for turn_id, turn in _turns.items()
+                    if turn.done and now - turn.finished_at > SSE_REPLAY_TTL]:
+        turn = _turns.pop(turn_id)
+        if turn.key and _turns_by_key.get(turn.key) is turn:
+            del _turns_by_key[turn.key]
+
+
+def _pump(turn: Turn, produce):
+    generator = produce()
+    try:
+        for data in generator:
+            turn.append(data)
+            if turn.should_cancel():
+                # 关闭生成器，上游的流式请求随之取消
+                turn.cancelled = True
+                generator.close()
+                metrics.incr('turn.cancelled')
+                break
+    except Exception as e:
+        print('Stream producer failed:', e)
+    finally:
+        turn.finish()
+
+
+def start_turn(produce, key: str = None, persist: bool = True) -> Turn:
+    """
+    在回合执行线程中运行 produce()（返回字符串的生成器），输出写入新回合的重放缓冲区。
+    调用方断开连接不影响生成，produce 需要自己准备 app context。
+
+    参数:
+    - produce: 回合的生成函数
+    - key: 请求的 key；进行中或结束不超过 TURN_DEDUPE_TTL 秒的相同请求直接复用已有回合
+    - persist: 回合结果是否会保存，见 Turn
+    """
+    with _lock:
+        _cleanup()
+        if key:
+            existing = _turns_by_key.get(key)
+            if existing and not existing.cancelled and \
+                    (not existing.done or time.time() - existing.finished_at <= TURN_DEDUPE_TTL):
+                metrics.incr('turn.deduplicated')
+                return existing
+        turn = Turn(uuid.uuid4().hex, key=key, persist=persist)
+        _turns[turn.turn_id] = turn
+        if key:
+            _turns_by_key[key] = turn
+
+    metrics.incr('turn.started')
+    _executor.submit(_pump, turn, produce)
+    return turn
+
+
+def get_turn(turn_id: str):
+    with _lock:
+        return _turns.get(turn_id)
+
+
+def iter_sse(turn: Turn, after_seq: int = -1):
+    """
+    按 text/event-stream 格式输出回合事件，事件 id 为 <turn_id>:<seq>，空闲时发送注释行作为心跳。
+    """
+    for seq, data in turn.events(after_seq, heartbeat=SSE_HEARTBEAT_INTERVAL):
+        if seq is None:
+            yield ': keep-alive\n\n'
+        else:
+            yield format_event(data, event_id=f'{turn.turn_id}:{seq}')
+
+
+def iter_raw(turn: Turn):
+    """
+    按旧格式直接输出事件数据，兼容未使用 event-stream 的客户端。
+    """
+    for _, data in turn.events():
+        yield data
@@ -0,0 +1,183 @@
+import inspect
+import os
+import threading
+import time
+import grpc
+from dotenv import load_dotenv
+from stability_sdk import client
+from stability_sdk.interfaces.gooseai.generation import generation_pb2_grpc as generation_grpc
+from tools import metrics
+
+load_dotenv()  # 加载 .env 文件中的变量
+
+STABILITY_HOST = os.environ.get('STABILITY_HOST') or 'grpc.stability.ai:443'
+# 连接数：每个连接是一个独立的 gRPC channel（HTTP/2 连接），请求轮流使用
+STABILITY_CHANNELS = int(os.environ.get('STABILITY_CHANNELS') or 1)
+# 同时进行的生成请求数上限，以及排队等待的最长时间（秒）
+STABILITY_MAX_STREAMS = int(os.environ.get('STABILITY_MAX_STREAMS') or 8)
+STABILITY_ACQUIRE_TIMEOUT = float(os.environ.get('STABILITY_ACQUIRE_TIMEOUT') or 60)
+# 有请求进行时发送 keepalive ping 的间隔（毫秒），用于发现已断开的连接。
+# gRPC 服务端默认不接受 5 分钟内的多次 ping（超出会以 too_many_pings 关闭连接），不要调小；空闲连接不发 ping
+STABILITY_KEEPALIVE_MS = int(os.environ.get('STABILITY_KEEPALIVE_MS') or 300000)
+# 连接异常超过多少秒后丢弃并重新建立（秒）
+STABILITY_UNHEALTHY_GRACE = float(os.environ.get('STABILITY_UNHEALTHY_GRACE') or 10)
+
+# 与 stability_sdk 一致，放宽消息大小限制以传输较大的图片
+MAX_MESSAGE_SIZE = 10 * 1024 * 1024
+
+
+def _open_channel() -> grpc.Channel:
+    options = [
+        ('grpc.max_send_message_length', MAX_MESSAGE_SIZE),
+        ('grpc.max_receive_message_length', MAX_MESSAGE_SIZE),
+        ('grpc.keepalive_time_ms', STABILITY_KEEPALIVE_MS),
+        ('grpc.keepalive_timeout_ms', 20000),
+        ('grpc.keepalive_permit_without_calls', 0),
+        # 每个 channel 使用自己的连接，不与其他 channel 共用
+        ('grpc.use_local_subchannel_pool', 1),
+    ]
+    if STABILITY_HOST.endswith('443'):
+        credentials = grpc.composite_channel_credentials(
+            grpc.ssl_channel_credentials(),
+            grpc.access_token_call_credentials(os.environ['STABILITY_KEY']),
+        )
+        return grpc.secure_channel(STABILITY_HOST, credentials, options=options)
+    return grpc.insecure_channel(STABILITY_HOST, options=options)
+
+
+# StabilityInference 的默认引擎，未指定引擎时使用
+_DEFAULTS = inspect.signature(client.StabilityInference.__init__).parameters
+
+
+class _PooledInference(client.StabilityInference):
+    """
+    使用连接池 stub 的 StabilityInference。StabilityInference.__init__ 总会自己建立一个 channel，
+    这里不调用它，只设置 generate / upscale 用到的属性。
+    """
+
+    def __init__(self, stub, engine: str = None, upscale_engine: str = None, verbose: bool = True):
+        self.verbose = verbose
+        self.engine = engine or _DEFAULTS['engine'].default
+        self.upscale_engine = upscale_engine or _DEFAULTS['upscale_engine'].default
+        self.grpc_args = {'wait_for_ready': _DEFAULTS['wait_for_ready'].default}
+        self.stub = stub
+
+
+class _Channel:
+    """
+    一个 gRPC 连接及其上按引擎创建的 StabilityInference，订阅连接状态用于健康检查和统计握手耗时。
+    """
+
+    def __init__(self):
+        self.channel = _open_channel()
+        self.stub = generation_grpc.GenerationServiceStub(self.channel)
+        self.unhealthy_since = None
+        self._connecting_since = time.time()
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.channel.subscribe(self._on_state, try_to_connect=True)
+
+    def _on_state(self, state):
+        if state == grpc.ChannelConnectivity.CONNECTING:
+            if self._connecting_since is None:
+                self._connecting_since = time.time()
+        elif state == grpc.ChannelConnectivity.READY:
+            if self._connecting_since is not None:
+                metrics.incr('stability_pool.handshake')
+                metrics.incr('stability_pool.handshake_ms', int((time.time() - self._connecting_since) * 1000))
+                self._connecting_since = None
+            self.unhealthy_since = None
+        elif state in (grpc.ChannelConnectivity.TRANSIENT_FAILURE, grpc.ChannelConnectivity.SHUTDOWN):
+            self.mark_unhealthy()
+
+    def mark_unhealthy(self):
+        if self.unhealthy_since is None:
+            self.unhealthy_since = time.time()
+            metrics.incr('stability_pool.unhealthy')
+
+    @property
+    def expired(self) -> bool:
+        return self.unhealthy_since is not None and time.time() - self.unhealthy_since > STABILITY_UNHEALTHY_GRACE
+
+    def client(self, engine, upscale_engine) -> client.StabilityInference:
+        key = (engine, upscale_engine)
+        with self._lock:
+            stability_api = self._clients.get(key)
+            if stability_api is None:
+                stability_api = self._clients[key] = _PooledInference(self.stub, engine, upscale_engine)
+        return stability_api
+
+    def close(self):
+        self.channel.unsubscribe(self._on_state)
+        self.channel.close()
+
+
+class StabilityPool:
+    """
+    进程内共用的 Stability 连接池：文生图、图生图和放大共用 STABILITY_CHANNELS 个长连接，
+    同时进行的生成请求不超过 STABILITY_MAX_STREAMS 个；连接异常超过 STABILITY_UNHEALTHY_GRACE 秒时重新建立。
+    """
+
+    def __init__(self, size: int, max_streams: int):
+        self._channels = [None] * max(size, 1)
+        self._next = 0
+        self._lock = threading.Lock()
+        self._streams = threading.BoundedSemaphore(max_streams)
+
+    def channel(self) -> _Channel:
+        with self._lock:
+            index = self._next
+            self._next = (index + 1) % len(self._channels)
+            channel = self._channels[index]
+            if channel is not None and not channel.expired:
+                metrics.incr('stability_pool.reused')
+                return channel
+            if channel is not None:
+                channel.close()
+                metrics.incr('stability_pool.reconnected')
+            channel = self._channels[index] = _Channel()
+            metrics.incr('stability_pool.connected')
+            return channel
+
+    def call(self, engine, upscale_engine, method, *args, **kwargs):
+        """
+        在连接池上调用 StabilityInference 的方法，迭代结果期间占用一个并发名额。
+        """
+        if not self._streams.acquire(timeout=STABILITY_ACQUIRE_TIMEOUT):
+            metrics.incr('stability_pool.busy')
+            raise RuntimeError('Stability 请求过多，请稍后重试')
+        try:
+            channel = self.channel()
+            try:
+                yield from getattr(channel.client(engine, upscale_engine), method)(*args, **kwargs)
+            except grpc.RpcError as e:
+                if e.code() == grpc.StatusCode.UNAVAILABLE:
+                    channel.mark_unhealthy()
+                metrics.incr('stability_pool.error')
+                raise
+        finally:
+            self._streams.release()
+
+
+class PooledStabilityClient:
+    """
+    与 StabilityInference 用法相同的客户端，generate / upscale 通过连接池执行。
+    """
+
+    def __init__(self, pool: StabilityPool, engine: str = None, upscale_engine: str = None):
+        self._pool = pool
+        self.engine = engine
+        self.upscale_engine = upscale_engine
+
+    def generate(self, *args, **kwargs):
+        return self._pool.call(self.engine, self.upscale_engine, 'generate', *args, **kwargs)
+
+    def upscale(self, *args, **kwargs):
+        return self._pool.call(self.engine, self.upscale_engine, 'upscale', *args, **kwargs)
+
+
+pool = StabilityPool(STABILITY_CHANNELS, STABILITY_MAX_STREAMS)
+
+
+def get_stability_client(engine: str = None, upscale_engine: str = None) -> PooledStabilityClient:
+    return PooledStabilityClient(pool, engine, upscale_engine)
@@ -0,0 +1,180 @@
+import json
+import re
+
+# 状态机的各个状态
+_OUTSIDE = 0  # 在字符串之外
+_IN_STRING = 1  # 在普通字符串（key 或其他 value）内
+_AFTER_KEY = 2  # 刚读完目标 key，等待冒号
+_AFTER_COLON = 3  # 读完冒号，等待目标 value 的引号
+_IN_VALUE = 4  # 在目标 value 字符串内
+_DONE = 5  # 目标 value 已读取完毕
+
+# 目标 value 内需要逐字符处理的位置：引号或反斜杠
+_VALUE_STOP = re.compile(r'["\\\\]')
+
+_ESCAPES = {
+    '"': '"',
+    '\\': '\\',
+    '/': '/',
+    'b': '\b',
+    'f': '\f',
+    'n': '\n',
+    'r': '\r',
+    't': '\t',
+}
+
+
+class JsonFieldExtractor:
+    """
+    增量式 JSON 字段提取器。
+
+    大模型以流的方式返回 json 文本，每次只把新增的片段喂给 feed，
+    提取器只扫描一次新增内容，并返回目标字段（默认 content）新解码出来的字符。
+    支持 key 与冒号之间任意空白、转义引号及 \\uXXXX 转义。
+
+    用法:
+    - extractor = JsonFieldExtractor('content')
+    - delta = extractor.feed(event.data)
+    """
+
+    def __init__(self, field: str = 'content'):
+        self.field = field
+        self.state = _OUTSIDE
+        self._parts = []
+        # 当前普通字符串的前缀，只需保留到比目标 key 多一个字符即可判断
+        self._key_buf = []
+        self._key_overflow = False
+        # 转义状态：None 表示不在转义中，'' 表示刚读到反斜杠，'uXXXX' 表示正在读 unicode 转义
+        self._escape = None
+        # 未配对的高位代理字符
+        self._high_surrogate = None
+
+    @property
+    def done(self) -> bool:
+        return self.state == _DONE
+
+    @property
+    def value(self) -> str:
+        """
+        目前为止已提取到的目标字段完整内容。
+        """
+        return ''.join(self._parts)
+
+    def feed(self, chunk: str) -> str:
+        """
+        喂入新增的文本片段，返回目标字段新增的字符（没有则返回空串）。
+        """
+        if self.state == _DONE or not chunk:
+            return ''
+
+        out = []
+        i = 0
+        length = len(chunk)
+        while i < length:
+            state = self.state
+            # 快速路径：字符串外直接跳到下一个引号，目标 value 内整段产出直到引号或反斜杠
+            if state == _OUTSIDE:
+                j = chunk.find('"', i)
+                if j < 0:
+                    break
+                self.state = _IN_STRING
+                self._key_buf = []
+                self._key_overflow = False
+                i = j + 1
+                continue
+            if state == _IN_VALUE and self._escape is None and self._high_surrogate is None:
+                match = _VALUE_STOP.search(chunk, i)
+                j = match.start() if match else length
+                if j > i:
+                    out.append(chunk[i:j])
+                    i = j
+                    continue
+
+            ch = chunk[i]
+            i += 1
+            if state == _IN_STRING:
+                decoded = self._decode(ch)
+                if decoded is None:
+                    # 字符串结束，判断是否为目标 key
+                    if not self._key_overflow and ''.join(self._key_buf) == self.field:
+                        self.state = _AFTER_KEY
+                    else:
+                        self.state = _OUTSIDE
+                elif decoded and not self._key_overflow:
+                    self._key_buf.append(decoded)
+                    if len(self._key_buf) > len(self.field):
+                        self._key_overflow = True
+            elif state == _AFTER_KEY:
+                if ch == ':':
+                    self.state = _AFTER_COLON
+                elif not ch.isspace():
+                    # 只是一个值恰好等于目标 key 的字符串
+                    self.state = _IN_STRING if ch == '"' else _OUTSIDE
+                    self._key_buf = []
+                    self._key_overflow = False
+            elif state == _AFTER_COLON:
+                if ch == '"':
+                    self.state = _IN_VALUE
+                elif not ch.isspace():
+                    # 目标字段不是字符串类型，继续寻找下一个
+                    self.state = _OUTSIDE
+            elif state == _IN_VALUE:
+                decoded = self._decode(ch)
+                if decoded is None:
+                    self.state = _DONE
+                    break
+                if decoded:
+                    out.append(decoded)
+
+        delta = ''.join(out)
+        if delta:
+            self._parts.append(delta)
+        return delta
+
+    def _decode(self, ch: str):
+        """
+        解码字符串内的一个字符。
+        返回 None 表示字符串结束，返回 '' 表示字符被转义序列吞掉（尚未产出）。
+        """
+        if self._escape is None:
+            if ch == '\\':
+                self._escape = ''
+                return ''
+            if ch == '"':
+                return None
+            return self._join_surrogate(ch)
+
+        if self._escape == '':
+            if ch == 'u':
+                self._escape = 'u'
+                return ''
+            self._escape = None
+            return self._join_surrogate(_ESCAPES.get(ch, ch))
+
+        # \uXXXX
+        self._escape += ch
+        if len(self._escape) < 5:
+            return ''
+        hex_digits = self._escape[1:]
+        self._escape = None
+        try:
+            code = int(hex_digits, 16)
+        except ValueError:
+            return self._join_surrogate('\\u' + hex_digits)
+        return self._join_surrogate(chr(code))
+
+    def _join_surrogate(self, ch: str) -> str:
+        code = ord(ch) if len(ch) == 1 else -1
+        if 0xD800 <= code <= 0xDBFF:
+            pending = self._high_surrogate or ''
+            self._high_surrogate = ch
+            return pending
+        if 0xDC00 <= code <= 0xDFFF and self._high_surrogate:
+            high = self._high_surrogate
+            self._high_surrogate = None
+            return json.loads('"\\u%04x\\u%04x"' % (ord(high), code))
+        if self._high_surrogate:
+            pending = self._high_surrogate
+            self._high_surrogate = None
+            return pending + ch
+        return ch
@@ -1,13 +1,14 @@
 import os
 import io
 import warnings
-from PIL import Image
-from stability_sdk import client
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageFilter
 import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
 from dotenv import load_dotenv
 import random
 from datetime import datetime
-from flask import url_for
+from tools import metrics
+from tools.stability_pool import get_stability_client
 
 # sd参数
 random_seed = random.randint(100_000_000, 999_999_999)
@@ -22,38 +23,129 @@ load_dotenv()
 engine_id = os.environ['UPSCALE_ENGINE_ID']
 api_key = os.environ['STABILITY_KEY']
 
+# 放大质量：high 调用 Stability 放大（效果好、较慢、收费），fast 在本地放大（Lanczos + 锐化）
+UPSCALE_QUALITY = (os.environ.get('UPSCALE_QUALITY') or 'high').lower()
+# 本地放大：同时处理的分块数量（默认为 CPU 核数，最多 4），以及锐化参数
+UPSCALE_LOCAL_TILES = int(os.environ.get('UPSCALE_LOCAL_TILES') or min(os.cpu_count() or 1, 4))
+UPSCALE_SHARPEN_RADIUS = float(os.environ.get('UPSCALE_SHARPEN_RADIUS') or 1.5)
+UPSCALE_SHARPEN_PERCENT = int(os.environ.get('UPSCALE_SHARPEN_PERCENT') or 80)
 
-def upscale_pic(img_url, dir_url):
+# 分块锐化时每块上下多处理的行数，避免分块边缘出现接缝
+_TILE_MARGIN = 8
 
-    stability_api = client.StabilityInference(
-        key=api_key,
-        upscale_engine=engine_id,
-        verbose=True,
-    )
 
+class RemoteUpscaler:
+    """
+    Stability 放大：通过连接池调用放大引擎。
+    """
+    name = 'remote'
+
+    def upscale(self, image: Image.Image, target_width: int) -> Image.Image:
+        stability_api = get_stability_client(upscale_engine=engine_id)
+        answers = stability_api.upscale(
+            init_image=image,
+            width=target_width,
+            prompt=prompt,
+            seed=random_seed,
+            steps=steps,
+            cfg_scale=cfg_scale,
+        )
+
+        for resp in answers:
+            for artifact in resp.artifacts:
+                if artifact.finish_reason == generation.FILTER:
+                    warnings.warn(
+                        "Your request activated the API's safety filters and could not be processed."
+                        "Please submit a different image and try again.")
+                if artifact.type == generation.ARTIFACT_IMAGE:
+                    return Image.open(io.BytesIO(artifact.binary))
+        raise RuntimeError('Stability upscale returned no image')
+
+
+class LocalUpscaler:
+    """
+    本地放大：Lanczos 插值后做 USM 锐化。图片按行切成 UPSCALE_LOCAL_TILES 块在线程池中并行处理，
+    Pillow 的缩放和滤镜会释放 GIL，多块可以同时计算。
+    """
+    name = 'local'
+
+    def __init__(self, tiles: int = UPSCALE_LOCAL_TILES):
+        self.tiles = max(tiles, 1)
+        self._executor = ThreadPoolExecutor(max_workers=self.tiles, thread_name_prefix='upscale-tile')
+
+    def _tile(self, image, target_size, top, bottom):
+        target_width, target_height = target_size
+        scale = image.height / target_height
+        # 多处理上下 _TILE_MARGIN 行，锐化后裁掉，分块边缘与整图处理的结果一致
+        padded_top = max(top - _TILE_MARGIN, 0)
+        padded_bottom = min(bottom + _TILE_MARGIN, target_height)
+        # box 参数按原图坐标缩放指定区域，插值时会用到区域外的像素，分块之间不会有接缝
+        tile = image.resize((target_width, padded_bottom - padded_top), Image.LANCZOS,
+                            box=(0, padded_top * scale, image.width, padded_bottom * scale))
+        tile = tile.filter(ImageFilter.UnsharpMask(radius=UPSCALE_SHARPEN_RADIUS, percent=UPSCALE_SHARPEN_PERCENT,
+                                                   threshold=2))
+        return top, tile.crop((0, top - padded_top, target_width, bottom - padded_top))
+
+    def upscale(self, image: Image.Image, target_width: int) -> Image.Image:
+        image.load()
+        if image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        target_height = round(image.height * target_width / image.width)
+        target_size = (target_width, target_height)
+
+        step = -(-target_height // self.tiles)
+        bands = [(top, min(top + step, target_height)) for top in range(0, target_height, step)]
+        output = Image.new(image.mode, target_size)
+        for top, tile in self._executor.map(lambda band: self._tile(image, target_size, *band), bands):
+            output.paste(tile, (0, top))
+        return output
+
+
+_upscalers = {}
+
+
+def get_upscaler(quality: str = None):
+    """
+    按质量选择放大方式：high 使用 Stability 放大，fast 使用本地放大。
+    """
+    quality = (quality or UPSCALE_QUALITY).lower()
+    name = 'local' if quality == 'fast' else 'remote'
+    if name not in _upscalers:
+        _upscalers[name] = LocalUpscaler() if name == 'local' else RemoteUpscaler()
+    return _upscalers[name]
+
+
+def upscale_image(image: Image.Image, target_width: int = width, quality: str = None) -> Image.Image:
+    """
+    放大图片，Stability 放大失败时改用本地放大。不依赖请求上下文，可以在后台任务中调用。
+    """
+    upscaler = get_upscaler(quality)
+    try:
+        result = upscaler.upscale(image, target_width)
+    except Exception as e:
+        if upscaler.name == 'local':
+            raise
+        metrics.incr('upscale.remote_error')
+        print('Remote upscale failed, using local upscaler:', e)
+        upscaler = get_upscaler('fast')
+        result = upscaler.upscale(image, target_width)
+    metrics.incr(f'upscale.{upscaler.name}')
+    return result
+
+
+def upscale_pic(img_url, dir_url, quality=None):
+    """
+    放大图片并保存为 dir_url 下的 image_upscale.png
+    :param img_url: 原图的本地路径
+    :param dir_url: 保存放大图片的目录
+    :param quality: 放大质量，见 UPSCALE_QUALITY
+    :return: 放大图片的本地路径
+    """
     img = Image.open(img_url)
+    big_img = upscale_image(img, width, quality)
+
+    img_path = 'image_upscale.png'
+    full_img_path = os.path.join(dir_url, img_path)
+    big_img.save(full_img_path)
 
-    answers = stability_api.upscale(
-        init_image=img,
-        width=width,
-        prompt=prompt,
-        seed=random_seed,
-        steps=steps,
-        cfg_scale=cfg_scale,
-    )
-
-    for resp in answers:
-        for artifact in resp.artifacts:
-            if artifact.finish_reason == generation.FILTER:
-                warnings.warn(
-                    "Your request activated the API's safety filters and could not be processed."
-                    "Please submit a different image and try again.")
-            if artifact.type == generation.ARTIFACT_IMAGE:
-                big_img = Image.open(io.BytesIO(artifact.binary))
-                img_path = 'image_upscale.png'
-                full_img_path = os.path.join(dir_url, img_path)
-                big_img.save(full_img_path)
-
-                upscale_img_url = url_for('static', filename=dir_url.split('/')[1]+'/'+img_path)
-
-                return upscale_img_url
+    return full_img_path